@@ -0,0 +1,340 @@
+"""
+Per-athlete columnar cache of the parsed activity files.
+
+./data/athlete_{id}_activities.json keeps every API batch as it was fetched.
+The cache flattens the fields the feature extraction uses into three Arrow IPC
+files per athlete, keyed by activity id:
+    activities.arrow  - one row per activity
+    laps.arrow        - one row per lap (activity_id, lap_index)
+    efforts.arrow     - one row per best effort (activity_id, effort_index)
+plus manifest.json with the latest athlete/zones/stats entries, the batches
+already ingested and the size and mtime of the JSON file they came from.
+
+Files are written uncompressed so reads are memory-mapped and zero-copy;
+read_activities(athlete_id, columns) only touches the requested columns.
+New batches are merged by activity id, so only the activities that arrived
+since the last run are parsed. The cache therefore holds one row per activity
+id, the latest fetched, where the JSON file lists an activity once per batch
+it came in.
+"""
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get('ACTIVITY_CACHE_DIR', './data/activity_cache')
+
+METADATA_TYPES = ['athlete', 'zones', 'stats']
+
+# Bumped whenever the table schemas change; caches of another version are rebuilt
+CACHE_VERSION = 2
+
+ACTIVITY_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('type', pa.string()),
+    ('start_date', pa.string()),
+    ('elapsed_time', pa.float64()),
+    ('distance', pa.float64()),
+    ('average_heartrate', pa.float64()),
+    ('average_cadence', pa.float64()),
+    ('elev_high', pa.float64()),
+    ('elev_low', pa.float64()),
+    ('average_speed', pa.float64()),
+    ('athlete_count', pa.float64()),
+    ('has_errors', pa.bool_())
+])
+
+LAP_SCHEMA = pa.schema([
+    ('activity_id', pa.int64()),
+    ('lap_index', pa.int32()),
+    ('total_elevation_gain', pa.float64()),
+    ('average_speed', pa.float64()),
+    ('average_heartrate', pa.float64())
+])
+
+EFFORT_SCHEMA = pa.schema([
+    ('activity_id', pa.int64()),
+    ('effort_index', pa.int32()),
+    ('effort_activity_id', pa.int64()),
+    ('distance', pa.float64()),
+    ('elapsed_time', pa.float64()),
+    ('start_date', pa.string())
+])
+
+TABLE_SCHEMAS = {'activities': ACTIVITY_SCHEMA, 'laps': LAP_SCHEMA, 'efforts': EFFORT_SCHEMA}
+
+# Counts the API sends as integers, stored as float64 so fractional values are kept
+INTEGRAL_FIELDS = ('elapsed_time', 'athlete_count')
+
+def cache_path(athlete_id: int, name: str) -> str:
+    """Path of one of the athlete's cache files."""
+    return os.path.join(CACHE_DIR, str(athlete_id), name)
+
+def source_signature(filename: str) -> Optional[Dict[str, int]]:
+    """Size and mtime of the JSON file, None if it does not exist."""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def read_manifest(athlete_id: int) -> Optional[dict]:
+    """The athlete's manifest, None if there is no usable cache."""
+    try:
+        with open(cache_path(athlete_id, 'manifest.json'), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return manifest if manifest.get('version') == CACHE_VERSION else None
+
+def clear_tables(athlete_id: int) -> None:
+    """Remove the athlete's cache tables, before rebuilding them from scratch."""
+    for name in TABLE_SCHEMAS:
+        path = cache_path(athlete_id, f'{name}.arrow')
+        if os.path.exists(path):
+            os.remove(path)
+
+def write_atomic(path: str, write) -> None:
+    """Call write(tmp_path) and move the result over path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def write_table(athlete_id: int, name: str, arrow_table: pa.Table) -> None:
+    """Write one cache table as an uncompressed Arrow IPC file."""
+    def write(tmp_path):
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+    write_atomic(cache_path(athlete_id, f'{name}.arrow'), write)
+
+def read_table(athlete_id: int, name: str, columns: Optional[List[str]] = None) -> pa.Table:
+    """Memory-map one cache table, empty if it was never written."""
+    path = cache_path(athlete_id, f'{name}.arrow')
+    if not os.path.exists(path):
+        return TABLE_SCHEMAS[name].empty_table().select(columns or TABLE_SCHEMAS[name].names)
+    arrow_table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return arrow_table.select(columns) if columns else arrow_table
+
+def read_activities(athlete_id: int, columns: Optional[List[str]] = None, name: str = 'activities'):
+    """Cached activity (or 'laps'/'efforts') rows as a DataFrame, only with the given columns."""
+    return read_table(athlete_id, name, columns).to_pandas()
+
+def restore_integers(row: dict) -> dict:
+    """row without its missing values, with whole INTEGRAL_FIELDS back as ints as in the JSON."""
+    row = {k: v for k, v in row.items() if v is not None}
+    for name in INTEGRAL_FIELDS:
+        if isinstance(row.get(name), float) and row[name].is_integer():
+            row[name] = int(row[name])
+    return row
+
+def flatten_activities(activities: List[dict]) -> Dict[str, List[dict]]:
+    """Split raw API activities into activity, lap and best effort rows."""
+    rows = {'activities': [], 'laps': [], 'efforts': []}
+    for activity in activities:
+        if not isinstance(activity, dict) or activity.get('id') is None:
+            continue
+        activity_id = int(activity['id'])
+        row = {name: activity.get(name) for name in ACTIVITY_SCHEMA.names}
+        row['id'] = activity_id
+        row['has_errors'] = bool(activity.get('errors'))
+        rows['activities'].append(row)
+        for i, lap in enumerate(activity.get('laps') or []):
+            rows['laps'].append({
+                **{name: lap.get(name) for name in LAP_SCHEMA.names[2:]},
+                'activity_id': activity_id,
+                'lap_index': i
+            })
+        for i, effort in enumerate(activity.get('best_efforts') or []):
+            rows['efforts'].append({
+                **{name: effort.get(name) for name in EFFORT_SCHEMA.names[3:]},
+                'activity_id': activity_id,
+                'effort_index': i,
+                'effort_activity_id': (effort.get('activity') or {}).get('id')
+            })
+    return rows
+
+def merge_activities(athlete_id: int, activities: List[dict]) -> int:
+    """Add activities to the cache, replacing cached rows with the same id."""
+    rows = flatten_activities(activities)
+    if not rows['activities']:
+        return 0
+    new_ids = pa.array({row['id'] for row in rows['activities']}, pa.int64())
+
+    for name, schema in TABLE_SCHEMAS.items():
+        cached = read_table(athlete_id, name)
+        key = 'id' if name == 'activities' else 'activity_id'
+        kept = cached.filter(pc.invert(pc.is_in(cached[key], value_set=new_ids)))
+        added = pa.Table.from_pylist(rows[name], schema=schema)
+        write_table(athlete_id, name, pa.concat_tables([kept, added]))
+
+    return len(rows['activities'])
+
+def ingest_batches(athlete_id: int, all_data: dict, manifest: dict) -> dict:
+    """Merge the batches of all_data the manifest has not seen; return the updated manifest."""
+    seen = set(manifest['batches'])
+    for timestamp, data in all_data.items():
+        if timestamp in seen:
+            continue
+        if 'detailed' in timestamp:
+            count = merge_activities(athlete_id, data)
+            logger.info(f"Cached {count} activities from batch {timestamp} for athlete {athlete_id}")
+        for data_type in METADATA_TYPES:
+            latest = manifest['latest'].get(data_type)
+            if data_type in timestamp and (latest is None or timestamp >= latest[0]):
+                manifest['latest'][data_type] = [timestamp, data]
+        manifest['batches'].append(timestamp)
+    return manifest
+
+def write_manifest(athlete_id: int, manifest: dict) -> None:
+    """Write the manifest last, once the tables it describes are in place."""
+    manifest['version'] = CACHE_VERSION
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+    write_atomic(cache_path(athlete_id, 'manifest.json'), write)
+
+def update_activity_cache(athlete_id: int, filename: str) -> Optional[dict]:
+    """Bring the cache up to date with the JSON file; return the manifest."""
+    source = source_signature(filename)
+    if source is None:
+        return None
+    manifest = read_manifest(athlete_id)
+    if manifest is not None and manifest['source'] == source:
+        return manifest
+    if manifest is None:
+        clear_tables(athlete_id)
+
+    with open(filename, 'r', encoding='utf-8') as f:
+        all_data = json.load(f)
+    manifest = ingest_batches(athlete_id, all_data, manifest or {'batches': [], 'latest': {}})
+    manifest['source'] = source
+    write_manifest(athlete_id, manifest)
+    return manifest
+
+def append_batch(athlete_id: int, filename: str, timestamp: str, data: list,
+                 previous_source: Optional[Dict[str, int]]) -> None:
+    """Ingest a batch just saved to filename without re-reading the file.
+
+    Only applies when the cache matched the file before the save
+    (previous_source); otherwise the next update_activity_cache catches up.
+    """
+    manifest = read_manifest(athlete_id)
+    if manifest is None and previous_source is None:
+        clear_tables(athlete_id)
+        manifest = {'batches': [], 'latest': {}, 'source': None}
+    if manifest is None or manifest['source'] != previous_source:
+        return
+    manifest = ingest_batches(athlete_id, {timestamp: data}, manifest)
+    manifest['source'] = source_signature(filename)
+    write_manifest(athlete_id, manifest)
+
+class ChildRows:
+    """Rows of the laps or efforts table, located by activity_id.
+    
+    The table is sorted by activity_id once (stably, so an activity's rows
+    keep their order); the rows of some activities are then found with a
+    binary search and read on their own.
+    """
+    
+    def __init__(self, arrow_table: pa.Table):
+        self.table = arrow_table
+        self.order = pc.array_sort_indices(arrow_table['activity_id']).to_numpy()
+        self.sorted_ids = arrow_table['activity_id'].to_numpy()[self.order]
+    
+    def rows(self, activity_ids: List[int], columns: List[str]) -> List[List[dict]]:
+        """The rows of each activity, with only the given columns."""
+        first = np.searchsorted(self.sorted_ids, activity_ids, side='left')
+        counts = np.searchsorted(self.sorted_ids, activity_ids, side='right') - first
+        # first[i], first[i] + 1, ... for counts[i] rows, for each activity in turn
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions = self.order[np.repeat(first, counts) + offsets]
+        flat = self.table.select(columns).take(pa.array(positions, pa.int64())).to_pylist()
+        
+        grouped, start = [], 0
+        for count in counts:
+            grouped.append(flat[start:start + count])
+            start += count
+        return grouped
+
+class CachedActivities:
+    """One athlete's cached activities, turned into dicts a few at a time.
+    
+    The tables stay memory-mapped and only the activities asked for are
+    converted, with the keys the feature extraction reads.
+    """
+    
+    def __init__(self, athlete_id: int):
+        self.activities = read_table(athlete_id, 'activities')
+        self.laps = ChildRows(read_table(athlete_id, 'laps'))
+        self.efforts = ChildRows(read_table(athlete_id, 'efforts'))
+    
+    def __len__(self) -> int:
+        return self.activities.num_rows
+    
+    def transform_order(self) -> List[int]:
+        """Positions of the error-free activities, newest first, in the order of load_cached_athlete_data."""
+        start_dates = pc.fill_null(self.activities['start_date'], '')
+        order = pc.array_sort_indices(start_dates, order='descending')
+        has_errors = pc.fill_null(self.activities['has_errors'], False).to_numpy(zero_copy_only=False)
+        return [position for position in order.to_pylist() if not has_errors[position]]
+    
+    def dicts(self, positions: List[int], laps: bool = True, best_efforts: bool = True) -> List[dict]:
+        """The activities at positions, with their laps and best efforts unless left out."""
+        rows = self.activities.take(pa.array(positions, pa.int64())).to_pylist()
+        activity_ids = [row['id'] for row in rows]
+        activity_laps = self.laps.rows(activity_ids, LAP_SCHEMA.names[2:]) if laps else [[]] * len(rows)
+        activity_efforts = (self.efforts.rows(activity_ids, EFFORT_SCHEMA.names[2:]) if best_efforts
+                            else [[]] * len(rows))
+        
+        activities = []
+        for row, lap_rows, effort_rows in zip(rows, activity_laps, activity_efforts):
+            if row.pop('has_errors'):
+                row['errors'] = True
+            activity = restore_integers(row)
+            if lap_rows:
+                activity['laps'] = [{k: v for k, v in lap.items() if v is not None} for lap in lap_rows]
+            if effort_rows:
+                activity['best_efforts'] = []
+                for effort in effort_rows:
+                    effort['activity'] = {'id': effort.pop('effort_activity_id')}
+                    activity['best_efforts'].append(restore_integers(effort))
+            activities.append(activity)
+        return activities
+
+def cached_activity_dicts(athlete_id: int) -> List[dict]:
+    """Rebuild activity dicts from the cache, with the keys the feature extraction reads."""
+    cached = CachedActivities(athlete_id)
+    return cached.dicts(list(range(len(cached))))
+
+def cached_athlete_metadata(athlete_id: int, filename: str) -> Optional[dict]:
+    """The athlete, zones and stats of load_cached_athlete_data, without the activities."""
+    manifest = update_activity_cache(athlete_id, filename)
+    if manifest is None:
+        return None
+    if not all(data_type in manifest['latest'] for data_type in METADATA_TYPES):
+        return None
+    return {
+        **manifest['latest']['athlete'][1][0],
+        '_Zones': manifest['latest']['zones'][1][0],
+        '_Stats': manifest['latest']['stats'][1][0]
+    }
+
+def load_cached_athlete_data(athlete_id: int, filename: str) -> Optional[dict]:
+    """athlete_data in the load_latest_athlete_data format, served from the cache."""
+    athlete_data = cached_athlete_metadata(athlete_id, filename)
+    if athlete_data is None:
+        return None
+
+    activities = cached_activity_dicts(athlete_id)
+    activities.sort(key=lambda x: x.get('start_date', ''), reverse=True)
+    return {**athlete_data, '_Activities': activities}
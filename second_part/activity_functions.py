@@ -1,7 +1,6 @@
 import numpy
-from statistics import stdev 
 from scipy import signal
-from typing import Dict, List, Tuple, Optional, Union
+from typing import Dict, List, NamedTuple, Tuple, Optional, Union
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,6 +20,65 @@ ACTIVITY_TYPES: Dict[str, int] = {
     'Yoga': 33, 'Other': 34
 }
 
+class ActivityData(NamedTuple):
+    """Basic data common to all activity types."""
+    id: int
+    activity_type: int
+    elapsed_time: Optional[float]
+    distance: Optional[float]
+    mean_hr: Optional[float]
+
+class RunData(NamedTuple):
+    """Running activity data; starts with the fields of ActivityData, in the same order."""
+    id: int
+    activity_type: int
+    elapsed_time: Optional[float]
+    distance: Optional[float]
+    mean_hr: Optional[float]
+    stdev_hr: Optional[float]
+    freq_hr: Optional[float]
+    elevation: float
+    stdev_elevation: Optional[float]
+    freq_elevation: Optional[float]
+    pace: Optional[float]
+    stdev_pace: Optional[float]
+    freq_pace: Optional[float]
+    cadence: Optional[float]
+    athlete_count: float
+    time_in_zones: List[float]
+
+class HREstimator(NamedTuple):
+    """Slope and intercept of a fitted pace-to-HR LinearRegression.
+    
+    Its estimates are the regression's predictions, computed directly rather
+    than through scikit-learn's predict and its per-call input checks.
+    """
+    slope: float
+    intercept: float
+
+    def predict(self, speeds) -> numpy.ndarray:
+        """Estimated heart rate at each of speeds; like predict, rejects missing speeds."""
+        speeds = numpy.asarray(speeds, dtype=float)
+        if not numpy.isfinite(speeds).all():
+            raise ValueError("Cannot estimate heart rate from a missing speed")
+        return speeds * self.slope + self.intercept
+
+def hr_estimator(hr_regressor) -> Optional[HREstimator]:
+    """The regressor's coefficients as an HREstimator; None without a regressor.
+    
+    Read them once per athlete and pass the estimator on in place of the
+    regressor; an HREstimator is returned as it is.
+    """
+    if hr_regressor is None or isinstance(hr_regressor, HREstimator):
+        return hr_regressor
+    return HREstimator(float(hr_regressor.coef_.ravel()[0]), float(numpy.ravel(hr_regressor.intercept_)[0]))
+
+class LapSignals(NamedTuple):
+    """Per-lap signals of a run, as float arrays in lap order."""
+    elevation: numpy.ndarray
+    pace: numpy.ndarray
+    hr: numpy.ndarray
+
 def get_activity_type(activity_name: str) -> int:
     """Convert activity name to type ID."""
     return ACTIVITY_TYPES.get(activity_name, 34)  # Default to 'Other'
@@ -33,32 +91,29 @@ def safe_get(activity: dict, key: str, default: Optional[any] = None) -> any:
     except Exception:
         return default
 
-def calculate_time_in_zones(hr_values: List[float], zones: List[int]) -> List[float]:
+def calculate_time_in_zones(hr_values: numpy.ndarray, zones: List[int]) -> List[float]:
     """Calculate percentage of time spent in each heart rate zone."""
-    time_in_zones = [0] * 5
     total_samples = len(hr_values)
     
     if total_samples == 0:
-        return time_in_zones
-        
-    for hr in hr_values:
-        if hr < zones[0]:
-            time_in_zones[0] += 1
-        elif zones[0] <= hr < zones[1]:
-            time_in_zones[1] += 1
-        elif zones[1] <= hr < zones[2]:
-            time_in_zones[2] += 1
-        elif zones[2] <= hr < zones[3]:
-            time_in_zones[3] += 1
-        else:
-            time_in_zones[4] += 1
+        return [0] * 5
     
-    return [round(count / total_samples, 2) for count in time_in_zones]
+    # Zone of each sample: the first bound it is under, else the top zone
+    hr_values = numpy.asarray(hr_values, dtype=float)
+    zone_index = numpy.select([
+        hr_values < zones[0],
+        (zones[0] <= hr_values) & (hr_values < zones[1]),
+        (zones[1] <= hr_values) & (hr_values < zones[2]),
+        (zones[2] <= hr_values) & (hr_values < zones[3])
+    ], [0, 1, 2, 3], default=4)
+    time_in_zones = numpy.bincount(zone_index, minlength=5)
+    
+    return [round(int(count) / total_samples, 2) for count in time_in_zones]
 
-def calculate_signal_metrics(values: List[float]) -> Tuple[Optional[float], Optional[float]]:
+def calculate_signal_metrics(values: numpy.ndarray) -> Tuple[Optional[float], Optional[float]]:
     """Calculate standard deviation and frequency of peaks in signal."""
     try:
-        std_dev = stdev(values) if len(values) > 1 else None
+        std_dev = float(numpy.std(values, ddof=1)) if len(values) > 1 else None
         peaks = signal.find_peaks(values)[0]
         freq = round(len(peaks) / len(values), 2) if peaks.size > 0 else None
         return std_dev, freq
@@ -66,9 +121,29 @@ def calculate_signal_metrics(values: List[float]) -> Tuple[Optional[float], Opti
         logger.debug(f"Error calculating signal metrics: {e}")
         return None, None
 
-def get_non_run_activity_data(activity: dict, zones: List[int]) -> Tuple:
+def get_lap_signals(laps: List[dict], hr_regressor) -> LapSignals:
+    """Read the elevation gain, pace and heart rate of each lap once.
+    
+    Laps without a heart rate get the regressor's estimate from their speed,
+    estimated for all of them at once; without a regressor they are left
+    out of the heart rate signal.
+    """
+    hr = [safe_get(lap, 'average_heartrate') for lap in laps]
+    missing = [i for i, value in enumerate(hr) if value is None]
+    if missing and hr_regressor is not None:
+        estimated = hr_estimator(hr_regressor).predict([laps[i]['average_speed'] for i in missing])
+        for i, value in zip(missing, estimated):
+            hr[i] = value
+    
+    return LapSignals(
+        elevation=numpy.array([safe_get(lap, 'total_elevation_gain', 0) for lap in laps], dtype=float),
+        pace=numpy.array([safe_get(lap, 'average_speed', 0) for lap in laps], dtype=float),
+        hr=numpy.array([value for value in hr if value is not None], dtype=float)
+    )
+
+def get_non_run_activity_data(activity: dict, zones: List[int]) -> ActivityData:
     """Extract basic activity data common to all activity types."""
-    return (
+    return ActivityData(
         activity['id'],
         get_activity_type(activity.get('type', 'Other')),
         safe_get(activity, 'elapsed_time'),
@@ -76,10 +151,11 @@ def get_non_run_activity_data(activity: dict, zones: List[int]) -> Tuple:
         safe_get(activity, 'average_heartrate')
     )
 
-def get_run_activity_data(activity: dict, zones: List[int], hr_regressor) -> Tuple:
+def get_run_activity_data(activity: dict, zones: List[int], hr_regressor) -> RunData:
     """Extract detailed running activity data including HR zones and signal analysis."""
     # Get basic activity data
-    basic_data = list(get_non_run_activity_data(activity, zones))
+    basic_data = get_non_run_activity_data(activity, zones)
+    mean_hr = basic_data.mean_hr
     
     # Additional running-specific metrics
     additional_data = {
@@ -101,57 +177,42 @@ def get_run_activity_data(activity: dict, zones: List[int], hr_regressor) -> Tup
     try:
         laps = activity.get('laps', [])
         if laps:
-            # Collect lap data
-            lap_data = {
-                'elevation': [],
-                'pace': [],
-                'hr': []
-            }
-            
-            for lap in laps:
-                lap_data['elevation'].append(safe_get(lap, 'total_elevation_gain', 0))
-                lap_data['pace'].append(safe_get(lap, 'average_speed', 0))
-                
-                # Get or estimate heart rate
-                hr = safe_get(lap, 'average_heartrate')
-                if hr is None and hr_regressor is not None:
-                    hr = hr_regressor.predict([[lap['average_speed']]])[0][0]
-                if hr is not None:
-                    lap_data['hr'].append(hr)
+            lap_signals = get_lap_signals(laps, hr_regressor)
             
             # Calculate metrics for each signal type
             for signal_type in ['hr', 'elevation', 'pace']:
-                if lap_data[signal_type]:
-                    signal_metrics[signal_type] = calculate_signal_metrics(lap_data[signal_type])
+                values = getattr(lap_signals, signal_type)
+                if len(values):
+                    signal_metrics[signal_type] = calculate_signal_metrics(values)
             
             # Calculate time in zones if we have heart rate data
-            if lap_data['hr']:
-                time_in_zones = calculate_time_in_zones(lap_data['hr'], zones)
+            if len(lap_signals.hr):
+                time_in_zones = calculate_time_in_zones(lap_signals.hr, zones)
                 # Update mean HR if we estimated it
-                if basic_data[4] is None and hr_regressor is not None:
-                    basic_data[4] = hr_regressor.predict([[additional_data['pace']]])[0][0]
+                if mean_hr is None and hr_regressor is not None:
+                    mean_hr = hr_estimator(hr_regressor).predict(additional_data['pace'])[()]
     
     except Exception as e:
         logger.error(f"Error processing run data: {e}")
     
     # Combine all data
-    return tuple(basic_data + [
-        signal_metrics['hr'][0],      # HR stdev
-        signal_metrics['hr'][1],      # HR frequency
-        additional_data['elevation'],
-        signal_metrics['elevation'][0],  # elevation stdev
-        signal_metrics['elevation'][1],  # elevation frequency
-        additional_data['pace'],
-        signal_metrics['pace'][0],     # pace stdev
-        signal_metrics['pace'][1],     # pace frequency
-        additional_data['cadence'],
-        additional_data['athlete_count'],
-        time_in_zones
-    ])
+    return RunData(
+        *basic_data._replace(mean_hr=mean_hr),
+        stdev_hr=signal_metrics['hr'][0],
+        freq_hr=signal_metrics['hr'][1],
+        elevation=additional_data['elevation'],
+        stdev_elevation=signal_metrics['elevation'][0],
+        freq_elevation=signal_metrics['elevation'][1],
+        pace=additional_data['pace'],
+        stdev_pace=signal_metrics['pace'][0],
+        freq_pace=signal_metrics['pace'][1],
+        cadence=additional_data['cadence'],
+        athlete_count=additional_data['athlete_count'],
+        time_in_zones=time_in_zones
+    )
 
 def get_run_hr_pace(activity: dict, zones: List[int]) -> Tuple[Optional[float], Optional[float]]:
     """Get heart rate and pace data for a running activity."""
-    basic_data = get_non_run_activity_data(activity, zones)
-    return basic_data[4], safe_get(activity, 'average_speed')
+    return get_non_run_activity_data(activity, zones).mean_hr, safe_get(activity, 'average_speed')
 
 
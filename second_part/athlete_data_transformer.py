@@ -10,15 +10,23 @@ import ast
 import numpy as np
 from typing import Dict, List, Optional, Tuple, Union
 import logging
-from sql_methods import write_db_replace, read_db
-from search_functions import get_weeks, get_block
+from sql_methods import write_tables_atomic, read_db, shadow_table_name, WRITE_CHUNK_SIZE
+from search_functions import ActivityIndex, get_weeks
 from running_functions import (
     build_pace_to_hr_regressor, 
-    extract_activity_features,
-    extract_week_features,
-    get_pbs
+    activity_feature_record,
+    extract_weeks_features,
+    get_pbs,
+    run_outlier_counts,
+    OUTLIER_TYPES
 )
-from scipy.stats import linregress
+from activity_functions import hr_estimator
+from week_aggregates import aggregate_weeks
+from frame_dtypes import compact_frame
+from activity_cache import load_cached_athlete_data
+from transform_state import ActivityFeatureMemo, TransformState, load_transform_state, save_transform_state
+from stage_timings import StageTimings
+from weekly_cube import build_weekly_cube
 import os
 import json
 
@@ -31,6 +39,47 @@ MIN_ACTIVITIES_PER_BLOCK = 3
 OTHER_ACTIVITIES = {7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,33,34}
 WALK_HIKE_ACTIVITIES = {4,5}
 
+# Activity types (or groups of them) whose share of a block is compared to the athlete's
+ACTIVITY_TYPE_GROUPS = {
+    'rides': 1,
+    'swims': 3,
+    'walks_hikes': WALK_HIKE_ACTIVITIES,
+    'alpine_ski': 6,
+    'workout': 32,
+    'yoga': 34,
+    'crossfit': 10,
+    'other': OTHER_ACTIVITIES
+}
+
+# The last weeks of a block, compared to the weeks before them
+TAPER_WEEKS = 2
+
+# Metrics whose ramp before the taper and taper factor are computed, by week column
+RAMP_METRICS = {
+    'run_distance': 'f_run_total_distance',
+    'run_time': 'f_run_total_elapsed_time',
+    'mean_hr': 'f_run_mean_hr'
+}
+
+# Weekly averages compared to the athlete's, as (metric name, week column)
+WEEKLY_METRICS = [
+    ('run_distance', 'f_run_total_distance'),
+    ('non_run_distance', 'f_non_run_total_distance'),
+    ('run_time', 'f_run_total_elapsed_time'),
+    ('non_run_time', 'f_non_run_total_elapsed_time'),
+    ('run_elevation', 'f_mean_elevation'),
+    ('athlete_count', 'f_athlete_count')
+]
+
+# Compute all_athlete_weeks/features_weeks with a GROUP BY over the saved activity rows
+WEEK_AGGREGATES_IN_SQL = os.environ.get('WEEK_AGGREGATES_IN_SQL', '').lower() in ('1', 'true')
+
+# Reuse the activity and week features of the previous transform (see transform_state)
+INCREMENTAL_TRANSFORM = os.environ.get('INCREMENTAL_TRANSFORM', '').lower() in ('1', 'true')
+
+# Stream athletes loaded from files through the transform in date order (see streaming_transform)
+STREAM_TRANSFORM = os.environ.get('STREAM_TRANSFORM', '').lower() in ('1', 'true')
+
 def load_file_data(athlete_id: int) -> dict:
     """Load athlete data from file if requested."""
     try:
@@ -47,6 +96,15 @@ def load_latest_athlete_data(athlete_id: int) -> dict:
         if not os.path.exists(filename):
             logger.error(f"No data file found for athlete {athlete_id}")
             return None
+        
+        # Served from the columnar cache, which only parses batches it has not seen
+        try:
+            athlete_data = load_cached_athlete_data(athlete_id, filename)
+            if athlete_data is None:
+                logger.error(f"Missing required data types for athlete {athlete_id}")
+            return athlete_data
+        except Exception as e:
+            logger.warning(f"Activity cache unavailable for athlete {athlete_id}, reading {filename}: {e}")
             
         with open(filename, 'r', encoding='utf-8') as f:
             all_data = json.load(f)
@@ -125,49 +183,109 @@ def process_activity_block(
     athlete_id: str,
     zones: List[int],
     hr_regressor,
-    block_id: str = '0'
+    block_id: str = '0',
+    with_week_features: bool = True,
+    memo: Optional[ActivityFeatureMemo] = None,
+    days: Optional[List[Optional[int]]] = None
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    """Process a block of activities and return activity and week features."""
-    activities_df = pd.DataFrame()
-    weeks_df = pd.DataFrame()
+    """Process a block of activities and return activity and week features.
     
-    weeks = get_weeks(activities, duration_days=0)
+    Feature records are collected first and the activities frame is built
+    once; week features then come from one grouped aggregation over week_id
+    (extract_weeks_features). A week only sees the columns that some activity
+    up to and including it produced, as when the frame was grown one activity
+    at a time.
     
-    for week_num, week in enumerate(weeks):
-        week_id = f"{block_id}_{week_num}"
-        
-        # Process activities in week
+    With with_week_features=False the week frame only holds the week keys, for
+    week_aggregates to fill in from the database. With a memo, activity
+    records (and, for a TransformState, unchanged weeks) are looked up in it
+    rather than extracted again. days are
+    the activities' parsed start days, from the athlete's ActivityIndex.
+    """
+    weeks = get_weeks(activities, duration_days=0, days=days)
+    week_ids = [f"{block_id}_{week_num}" for week_num in range(len(weeks))]
+    feature_record = memo.activity_record if memo is not None else activity_feature_record
+    
+    records = []
+    columns_seen = {}  # column -> None, in order of first appearance
+    week_columns = []
+    for week_id, week in zip(week_ids, weeks):
         for activity in week:
-            activities_df = extract_activity_features(
-                activities_df, 
-                activity, 
-                zones, 
+            features = feature_record(
+                activity,
+                zones,
                 activity['type'],
                 athlete_data['id'],
                 block_id,
                 week_id,
                 hr_regressor
             )
-        
-        # Process week features
-        week_activities = activities_df[activities_df['week_id'] == week_id]
-        week_runs = week_activities[week_activities['activity_type'] == 2]
-        week_non_runs = week_activities[week_activities['activity_type'] != 2]
-        
-        week_features = extract_week_features(
-            week_runs,
-            week_non_runs,
-            athlete_id,
-            block_id,
-            week_id,
-            len(week_runs)
-        )
-        weeks_df = pd.concat([weeks_df, pd.DataFrame([week_features])], ignore_index=True)
+            if features is not None:
+                records.append(features)
+                columns_seen.update(dict.fromkeys(features))
+        week_columns.append(list(columns_seen))
+    
+    activities_df = pd.DataFrame(records)
+    
+    if not with_week_features:
+        weeks_df = pd.DataFrame([{'athlete_id': athlete_id, 'block_id': block_id, 'week_id': week_id}
+                                 for week_id in week_ids])
+        return compact_frame(activities_df), compact_frame(weeks_df)
+    
+    all_week_features = []  # filled by the first week the memo does not have
+    
+    def compute_week_features(week_num: int) -> dict:
+        if not all_week_features:
+            all_week_features.extend(extract_weeks_features(activities_df, week_ids, week_columns, athlete_id, block_id))
+        return all_week_features[week_num]
     
-    return activities_df, weeks_df
+    week_features = []
+    for week_num in range(len(week_ids)):
+        if memo is None:
+            week_features.append(compute_week_features(week_num))
+        else:
+            week_features.append(memo.week_features(
+                block_id,
+                week_num,
+                [activity.get('id') for activity in weeks[week_num]],
+                lambda: compute_week_features(week_num)
+            ))
+    
+    return compact_frame(activities_df), compact_frame(pd.DataFrame(week_features))
 
-def process_pb_blocks(activities: List[dict], athlete_id: str, zones: List[int], hr_regressor) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    """Process personal best blocks and extract features."""
+def pb_block_metadata(significant_pbs: List[List], i: int, athlete_id: str) -> Dict:
+    """metadata_blocks row of the block before the i-th of get_pbs' PBs."""
+    pb = significant_pbs[i]
+    if len(significant_pbs) == 1:
+        vdot_delta = 0 
+    else:
+        # If this is the first PB, delta is 0 ? Maybe better thing to do here
+        if i == 0:
+            vdot_delta = 0
+        # Otherwise, compare this PB to the previous PB
+        else:
+            vdot_delta = significant_pbs[i][0] - significant_pbs[i-1][0]
+    
+    return {
+        'athlete_id': athlete_id,
+        'vdot': pb[0],
+        'vdot_delta': vdot_delta,
+        'predicted_marathon_time': pb[1],
+        'pb_date': pb[2],
+        'block_id': pb[3]
+    }
+
+def process_pb_blocks(activities: List[dict], athlete_id: str, zones: List[int], hr_regressor,
+                      with_week_features: bool = True,
+                      memo: Optional[ActivityFeatureMemo] = None,
+                      index: Optional[ActivityIndex] = None) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Process personal best blocks and extract features.
+    
+    Blocks are looked up in index, the ActivityIndex of activities, and each
+    activity's features are extracted once in memo however many blocks it is in.
+    """
+    index = index or ActivityIndex(activities)
+    memo = memo or ActivityFeatureMemo()
     metadata_blocks = pd.DataFrame()
     features_activities = pd.DataFrame()
     features_weeks = pd.DataFrame()
@@ -176,31 +294,14 @@ def process_pb_blocks(activities: List[dict], athlete_id: str, zones: List[int],
     
     for i, pb in enumerate(significant_pbs):
         activity_date, block_id = pb[2], pb[3]
-        block = get_block(activities, activity_date)
+        block, block_days = index.block(activity_date)
         
         # Skip if the block is too short
         if len(block) < MIN_ACTIVITIES_PER_BLOCK:
             continue
         
-        if len(significant_pbs) == 1:
-            vdot_delta = 0 
-        else:
-            # If this is the first PB, delta is 0 ? Maybe better thing to do here
-            if i == 0:
-                vdot_delta = 0
-            # Otherwise, compare this PB to the previous PB
-            else:
-                vdot_delta = significant_pbs[i][0] - significant_pbs[i-1][0]
-        
         # Add block metadata
-        block_metadata = {
-            'athlete_id': athlete_id,
-            'vdot': pb[0],
-            'vdot_delta': vdot_delta,
-            'predicted_marathon_time': pb[1],
-            'pb_date': pb[2],
-            'block_id': block_id
-        }
+        block_metadata = pb_block_metadata(significant_pbs, i, athlete_id)
         metadata_blocks = pd.concat([metadata_blocks, pd.DataFrame([block_metadata])], ignore_index=True)
         
         # Process activities by week
@@ -210,13 +311,17 @@ def process_pb_blocks(activities: List[dict], athlete_id: str, zones: List[int],
             athlete_id,             # athlete_id
             zones,                  # zones
             hr_regressor,          # hr_regressor
-            block_id               # block_id
+            block_id,              # block_id
+            with_week_features,
+            memo,
+            block_days
         )
         
         features_activities = pd.concat([features_activities, block_activities], ignore_index=True)
         features_weeks = pd.concat([features_weeks, block_weeks], ignore_index=True)
     
-    return metadata_blocks, features_activities, features_weeks
+    # Per-block categories do not survive concat
+    return compact_frame(metadata_blocks), compact_frame(features_activities), compact_frame(features_weeks)
 
 def calculate_activity_proportions(activities_df: pd.DataFrame, activity_type: Union[int, List[int]]) -> float:
     """Calculate proportion of activities of given type(s)."""
@@ -237,25 +342,29 @@ def calculate_relative_proportion(block_prop: float, total_prop: float) -> Optio
     except Exception:
         return None
 
-def get_activity_type_metrics(block_activities: pd.DataFrame, all_activities: pd.DataFrame) -> Dict[str, float]:
-    """Calculate proportions for different activity types."""
-    metrics = {}
+def block_activity_counts(features_activities: pd.DataFrame) -> Dict:
+    """Number of activities of every block, in total and per activity type group, by block_id."""
+    block_ids = features_activities['block_id']
+    counts = {'activities': block_ids.groupby(block_ids, observed=True, sort=False).size()}
+    for activity_name, activity_type in ACTIVITY_TYPE_GROUPS.items():
+        types = [activity_type] if isinstance(activity_type, int) else list(activity_type)
+        is_type = features_activities['activity_type'].isin(types)
+        counts[activity_name] = is_type.groupby(block_ids, observed=True, sort=False).sum()
+    return pd.DataFrame(counts).to_dict('index')
+
+def get_activity_type_metrics(block_counts: Dict[str, int], total_props: Dict[str, float]) -> Dict[str, float]:
+    """Calculate proportions for different activity types.
     
-    # Activity types to analyze
-    activity_types = {
-        'rides': 1,
-        'swims': 3,
-        'walks_hikes': WALK_HIKE_ACTIVITIES,
-        'alpine_ski': 6,
-        'workout': 32,
-        'yoga': 34,
-        'crossfit': 10,
-        'other': OTHER_ACTIVITIES
-    }
+    block_counts is the block's entry of block_activity_counts and total_props
+    the athlete's proportion of each group, computed once per athlete.
+    """
+    metrics = {}
     
-    for activity_name, activity_type in activity_types.items():
-        block_prop = calculate_activity_proportions(block_activities, activity_type)
-        total_prop = calculate_activity_proportions(all_activities, activity_type)
+    for activity_name, total_prop in total_props.items():
+        try:
+            block_prop = round(block_counts.get(activity_name, 0) / block_counts.get('activities', 0), 2)
+        except ZeroDivisionError:
+            block_prop = 0.0
         rel_prop = calculate_relative_proportion(block_prop, total_prop)
         
         metrics.update({
@@ -271,23 +380,31 @@ def get_outlier_metrics(
     all_athlete_activities: pd.DataFrame,
     block_id: str,
     athlete_id: str,
-    block_activities: pd.DataFrame
+    block_size: int,
+    outlier_counts: Optional[Dict[str, pd.DataFrame]] = None
 ) -> Dict[str, float]:
-    """Calculate metrics for outlier activities."""
-    from running_functions import get_run_outliers
+    """Calculate metrics for outlier activities.
+    
+    outlier_counts caches the per-block run_outlier_counts of both frames, so
+    the athlete's runs are labelled once for all of the athlete's blocks.
+    """
+    if outlier_counts is None:
+        outlier_counts = {}
+    if 'total' not in outlier_counts:
+        outlier_counts.update(block=run_outlier_counts(features_activities, athlete_id),
+                              total=run_outlier_counts(all_athlete_activities, athlete_id))
     
     # Get outliers for block and overall
-    f_outliers = get_run_outliers(features_activities, block_id, athlete_id)
-    total_outliers = get_run_outliers(all_athlete_activities, '0', athlete_id)
+    f_outliers = outlier_counts['block'][outlier_counts['block'].index == block_id].sum()
+    total_outliers = outlier_counts['total'][outlier_counts['total'].index == '0'].sum()
     total_activities = len(all_athlete_activities)
     
     metrics = {}
-    outlier_types = ['distance', 'intense', 'varying']
     
-    for i, outlier_type in enumerate(outlier_types):
+    for outlier_type in OUTLIER_TYPES:
         # Calculate block proportions
-        f_prop = round(len(f_outliers[i]) / len(block_activities), 2)
-        total_prop = round(len(total_outliers[i]) / total_activities, 2)
+        f_prop = round(int(f_outliers[outlier_type]) / block_size, 2)
+        total_prop = round(int(total_outliers[outlier_type]) / total_activities, 2)
         rel_prop = calculate_relative_proportion(f_prop, total_prop)
         
         metrics.update({
@@ -298,131 +415,271 @@ def get_outlier_metrics(
     
     return metrics
 
-def calculate_block_metrics(block_weeks: pd.DataFrame, athlete_weeks: pd.DataFrame, 
+def calculate_block_metrics(features_weeks: pd.DataFrame, athlete_weeks: pd.DataFrame, 
                           features_activities: pd.DataFrame, all_athlete_activities: pd.DataFrame,
-                          block_id: str, athlete_id: str) -> Dict:
-    """Calculate all block-level metrics."""
-    metrics = {}
-    
-    # Get run statistics from appropriate column names
-    if block_weeks.empty or 'f_total_runs' not in block_weeks.columns:
-        return metrics
-        
-    # Check for required columns and use correct names
-    run_distance_col = 'f_run_total_distance'
+                          block_id: str, athlete_id: str, cache: Optional[Dict] = None) -> Dict:
+    """Calculate all block-level metrics.
     
-    # Skip blocks without sufficient data
-    if (block_weeks['f_total_runs'].mean() == 0 or 
-        (run_distance_col in block_weeks.columns and block_weeks[run_distance_col][:-2].mean() == 0)):
-        return metrics
+    The weekly statistics, activity counts and outlier counts behind them are
+    computed for all blocks at once on first use and kept in cache, which the
+    caller shares across the athlete's blocks.
+    """
+    if cache is None:
+        cache = {}
+    if 'training' not in cache:
+        cache['training'] = calculate_training_metrics(features_weeks, athlete_weeks)
     
-    # Get base metrics (existing code)
-    metrics.update(calculate_training_metrics(block_weeks, athlete_weeks))
+    # Blocks without weeks get no metrics
+    if block_id not in cache['training']:
+        return {}
+    metrics = dict(cache['training'][block_id])
     
     # Get activity type proportions
-    block_activities = features_activities[features_activities['block_id'] == block_id]
-    metrics.update(get_activity_type_metrics(block_activities, all_athlete_activities))
+    if 'activity_counts' not in cache:
+        cache['activity_counts'] = block_activity_counts(features_activities)
+        cache['activity_props'] = {activity_name: calculate_activity_proportions(all_athlete_activities, activity_type)
+                                   for activity_name, activity_type in ACTIVITY_TYPE_GROUPS.items()}
+    block_counts = cache['activity_counts'].get(block_id, {})
+    metrics.update(get_activity_type_metrics(block_counts, cache['activity_props']))
     
-    # Get outlier metrics
+    # Get outlier metrics; a block without activities fails here and is skipped
     metrics.update(get_outlier_metrics(
         features_activities,
         all_athlete_activities,
         block_id,
         athlete_id,
-        block_activities
+        block_counts.get('activities', 0),
+        cache.setdefault('outliers', {})
     ))
     
     return metrics
 
-def calculate_training_metrics(block_weeks: pd.DataFrame, athlete_weeks: pd.DataFrame) -> Dict:
-    """Calculate training metrics for a block."""
-    metrics = {}
+def taper_split(features_weeks: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Position of each week in its block, its block's number of weeks, and whether it comes before the taper."""
+    groups = features_weeks.groupby('block_id', observed=True, sort=False)
+    week_num = groups.cumcount().to_numpy()
+    n_weeks = groups['block_id'].transform('size').to_numpy()
+    return week_num, n_weeks, week_num < n_weeks - TAPER_WEEKS
+
+def block_means(features_weeks: pd.DataFrame, columns: List[str], mask: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Mean of each column per block, over the weeks in mask if given; NaN for blocks with no such weeks."""
+    values = features_weeks[columns]
+    if mask is not None:
+        values = values.where(pd.Series(mask, index=features_weeks.index), axis=0)
+    return values.groupby(features_weeks['block_id'], observed=True, sort=False).mean()
+
+def before_taper_slopes(features_weeks: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """Least-squares slope of each column against the week number over the weeks before the taper, per block.
     
-    # Map of metrics to their column names
-    metric_mapping = {
-        'run_distance': 'f_run_total_distance',
-        'run_time': 'f_run_total_elapsed_time',
-        'mean_hr': 'f_run_mean_hr'
-    }
+    With the week numbers 0..m-1 centred on their mean, the slope is
+    sum(x * y) / sum(x ** 2) and sum(x ** 2) = m * (m ** 2 - 1) / 12. As with
+    linregress, the slope is NaN if any of the weeks is NaN or m is 1.
+    """
+    week_num, n_weeks, before_taper = taper_split(features_weeks)
+    n_before = n_weeks - TAPER_WEEKS
+    centred = week_num - (n_before - 1) / 2
+    values = features_weeks[columns].to_numpy(dtype='float64')
+    block_ids = features_weeks['block_id'][before_taper]
     
-    # Calculate ramp rates
-    for metric, column_name in metric_mapping.items():
-        values = list(block_weeks[column_name][:-2])
-        if values:
-            slope, *_ = linregress(range(len(values)), values)
-            metrics[f'f_slope_{metric}_before_taper'] = slope
-            
-            mean_value = block_weeks[column_name][:-2].mean()
-            mean_taper = block_weeks[column_name][-2:].mean()
-            metrics[f'f_taper_factor_{metric}'] = mean_taper / mean_value if mean_value else 0
-    
-    # Calculate relative metrics
-    weekly_metrics = [
-        ('run_distance', 'f_run_total_distance'),
-        ('non_run_distance', 'f_non_run_total_distance'),
-        ('run_time', 'f_run_total_elapsed_time'),
-        ('non_run_time', 'f_non_run_total_elapsed_time'),
-        ('run_elevation', 'f_mean_elevation'),
-        ('athlete_count', 'f_athlete_count')
-    ]
-    
-    for metric_name, col_name in weekly_metrics:
-        block_mean = block_weeks[col_name].mean()
-        athlete_mean = athlete_weeks[col_name].mean()
-        metrics[f'f_avg_weekly_{metric_name}'] = block_mean
-        if athlete_mean:
-            metrics[f'r_avg_weekly_{metric_name}'] = block_mean / athlete_mean
-    
-    # Calculate heart rate zones
+    products = pd.DataFrame(centred[:, None] * values, columns=columns)[before_taper]
+    has_nan = pd.DataFrame(np.isnan(values), columns=columns)[before_taper]
+    sums = products.groupby(block_ids.to_numpy(), sort=False).sum()
+    nans = has_nan.groupby(block_ids.to_numpy(), sort=False).any()
+    m = pd.Series(n_before[before_taper], index=block_ids.to_numpy()).groupby(level=0, sort=False).first()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = sums.div(m * (m ** 2 - 1) / 12, axis=0)
+    return slopes.mask(nans)
+
+def calculate_training_metrics(features_weeks: pd.DataFrame, athlete_weeks: pd.DataFrame) -> Dict:
+    """Calculate training metrics for every block with weeks, by block_id.
+    
+    The per-block means and slopes come from grouped operations over all
+    blocks and the athlete means are computed once.
+    """
+    ramp_columns = list(RAMP_METRICS.values())
+    week_num, n_weeks, before_taper = taper_split(features_weeks)
+    pre_taper = block_means(features_weeks, ramp_columns, before_taper).to_dict('index')
+    taper = block_means(features_weeks, ramp_columns, ~before_taper).to_dict('index')
+    slopes = before_taper_slopes(features_weeks, ramp_columns).to_dict('index')
+    
+    # Weekly averages, then the run and non-run time in each HR zone
+    averages = [(f'avg_weekly_{metric_name}', col_name, athlete_weeks[col_name].mean())
+                for metric_name, col_name in WEEKLY_METRICS]
     for zone in range(1, 6):
-        # For runs
         zone_col = f'f_time_in_z{zone}_runs'
-        block_mean = block_weeks[zone_col].mean()
-        athlete_mean = np.nanmean(athlete_weeks[zone_col])
-        metrics[f'f_avg_{zone_col}'] = block_mean
-        if athlete_mean:
-            metrics[f'r_avg_{zone_col}'] = block_mean / athlete_mean
-            
-        # For non-runs
+        averages.append((f'avg_{zone_col}', zone_col, np.nanmean(athlete_weeks[zone_col])))
         non_run_zone_col = f'f_time_in_z{zone}_non_runs'
-        if non_run_zone_col in block_weeks.columns:
-            block_mean = block_weeks[non_run_zone_col].mean()
-            athlete_mean = np.nanmean(athlete_weeks[non_run_zone_col])
-            metrics[f'f_avg_{non_run_zone_col}'] = block_mean
+        if non_run_zone_col in features_weeks.columns:
+            averages.append((f'avg_{non_run_zone_col}', non_run_zone_col, np.nanmean(athlete_weeks[non_run_zone_col])))
+    means = block_means(features_weeks, [col_name for _, col_name, _ in averages]).to_dict('index')
+    
+    metrics = {}
+    for block_id, block_mean in means.items():
+        block_metrics = {}
+        
+        # Calculate ramp rates
+        if block_id in slopes:
+            for metric, column_name in RAMP_METRICS.items():
+                block_metrics[f'f_slope_{metric}_before_taper'] = slopes[block_id][column_name]
+                
+                mean_value = pre_taper[block_id][column_name]
+                mean_taper = taper[block_id][column_name]
+                block_metrics[f'f_taper_factor_{metric}'] = mean_taper / mean_value if mean_value else 0
+        
+        # Calculate relative metrics
+        for name, col_name, athlete_mean in averages:
+            block_metrics[f'f_{name}'] = block_mean[col_name]
             if athlete_mean:
-                metrics[f'r_avg_{non_run_zone_col}'] = block_mean / athlete_mean
+                block_metrics[f'r_{name}'] = block_mean[col_name] / athlete_mean
+        
+        metrics[block_id] = block_metrics
     
     return metrics
 
+def build_features_blocks(metadata_blocks: pd.DataFrame, features_weeks: pd.DataFrame,
+                          all_athlete_weeks: pd.DataFrame, features_activities: pd.DataFrame,
+                          all_athlete_activities: pd.DataFrame, athlete_id) -> pd.DataFrame:
+    """Calculate block-level features for every PB block with enough training data."""
+    if metadata_blocks.empty:
+        return pd.DataFrame()
+    
+    athlete_weeks = all_athlete_weeks[all_athlete_weeks['athlete_id'] == athlete_id]
+    
+    # Skip blocks without sufficient data using correct column names
+    run_distance_col = 'f_run_total_distance' if 'f_run_total_distance' in features_weeks.columns else 'f_total_run_distance'
+    # As float, so a block without weeks gives NaN rather than the NA of an empty Int16 mean
+    total_runs = (features_weeks['f_total_runs'].astype(float)
+                  .groupby(features_weeks['block_id'], observed=True, sort=False).mean().to_dict())
+    run_distance = {}
+    if run_distance_col in features_weeks.columns:
+        *_, before_taper = taper_split(features_weeks)
+        run_distance = block_means(features_weeks, [run_distance_col], before_taper)[run_distance_col].to_dict()
+    
+    records = []
+    cache = {}  # shared by the athlete's blocks, see calculate_block_metrics
+    for _, block in metadata_blocks.iterrows():
+        block_id = block['block_id']
+        if total_runs.get(block_id) == 0 or run_distance.get(block_id) == 0:
+            continue
+        
+        # Calculate block metrics
+        try:
+            block_metrics = calculate_block_metrics(
+                features_weeks=features_weeks, 
+                athlete_weeks=athlete_weeks,
+                features_activities=features_activities,
+                all_athlete_activities=all_athlete_activities,
+                block_id=block_id,
+                athlete_id=athlete_id,
+                cache=cache
+            )
+            
+            block_metrics.update({
+                'athlete_id': athlete_id,
+                'block_id': block_id,
+                'y_vdot_delta': block['vdot_delta'],
+                'y_vdot': block['vdot']
+            })
+            
+            records.append(block_metrics)
+        
+        except Exception as e:
+            logger.error(f"Error calculating metrics for block {block_id}: {e}")
+            continue
+    
+    return compact_frame(records_frame(records))
+
+def records_frame(records: List[Dict]) -> pd.DataFrame:
+    """One row per record, with the columns in first-seen order.
+    
+    Columns holding None in any record stay object, with NaN where a record
+    lacks them, as they would from concatenating one-row frames.
+    """
+    frame = pd.DataFrame(records)
+    none_columns = {col for record in records for col, value in record.items() if value is None}
+    for col in none_columns:
+        frame[col] = pd.Series([record.get(col, np.nan) for record in records], dtype=object)
+    return frame
+
 def merge_with_existing_data(new_data: pd.DataFrame, table_name: str) -> pd.DataFrame:
     """Instead of merging, just return the new data."""
     return new_data
 
-def save_dataframes_to_db(dataframes: Dict[str, pd.DataFrame]) -> None:
-    """Save multiple dataframes to database with proper formatting."""
-    string_only_tables = {'metadata_athletes', 'metadata_blocks'}
+def format_metadata_athletes(metadata_athletes: pd.DataFrame) -> pd.DataFrame:
+    """Match metadata_athletes to its declared columns: string id, numeric weight, zones as JSON."""
+    return metadata_athletes.assign(
+        id=metadata_athletes['id'].astype(str),
+        weight=pd.to_numeric(metadata_athletes['weight'], errors='coerce'),
+        zones=metadata_athletes['zones'].map(lambda zones: zones if isinstance(zones, str) else json.dumps(zones))
+    )
+
+def athlete_metadata(athlete_data: dict) -> pd.DataFrame:
+    """metadata_athletes row of the athlete, updated from the stored one if there is one."""
+    metadata_athletes = pd.DataFrame([{
+        'id': athlete_data['id'],
+        'sex': athlete_data['sex'],
+        'weight': athlete_data['weight'],
+        'zones': athlete_data['_Zones']['heart_rate']['zones']
+    }])
     
-    for table_name, df in dataframes.items():
-        try:
-            if (table_name in string_only_tables):
-                df = df.astype(str)
-            write_db_replace(df, table_name)
-        except Exception as e:
-            logger.error(f"Error saving {table_name} to database: {e}")
-            raise
+    # Check for existing athlete data and update if necessary
+    existing_athletes = read_db('metadata_athletes')
+    if not existing_athletes.empty:
+        existing_athletes = existing_athletes.drop_duplicates(subset=['id'])
+        metadata_athletes = metadata_athletes.drop_duplicates(subset=['id'])
+        existing_athletes.set_index('id', inplace=True)
+        metadata_athletes.set_index('id', inplace=True)
+        metadata_athletes.update(existing_athletes)
+        metadata_athletes.reset_index(inplace=True)
+    return metadata_athletes
 
-def transform_athlete_data(athlete_id: int, athlete_data: dict = None, populate_all_from_files: int = 0) -> None:
-    """Transform athlete data and store in database."""
+def save_dataframes_to_db(dataframes: Dict[str, pd.DataFrame], athlete_id: Optional[int] = None,
+                          chunksize: int = WRITE_CHUNK_SIZE, derive=None, shadow: bool = False) -> None:
+    """Save multiple dataframes to database with proper formatting, in one transaction.
+    
+    With athlete_id set, only that athlete's rows are replaced in each table.
+    derive is passed on to write_tables_atomic. With shadow set the frames go
+    to the shadow tables of a cohort rebuild instead of the live ones.
+    """
+    formatted = dict(dataframes)
+    if not formatted.get('metadata_athletes', pd.DataFrame()).empty:
+        formatted['metadata_athletes'] = format_metadata_athletes(formatted['metadata_athletes'])
+    if shadow:
+        formatted = {shadow_table_name(name): df for name, df in formatted.items()}
+    try:
+        write_tables_atomic(formatted, athlete_id=athlete_id, chunksize=chunksize, derive=derive)
+    except Exception as e:
+        logger.error(f"Error saving {list(dataframes)} to database: {e}")
+        raise
+
+def transform_athlete_data(athlete_id: int, athlete_data: dict = None, populate_all_from_files: int = 0,
+                           shadow: bool = False) -> bool:
+    """Transform athlete data and store in database; False if there was no usable data.
+    
+    With shadow set the rows are written to the shadow tables of a cohort
+    rebuild (see update_data.rebuild_analytics_tables). With
+    PROFILE_TRANSFORM_STAGES set each stage is timed (see stage_timings).
+    With STREAM_TRANSFORM set, athletes read from their files go through
+    streaming_transform instead, in memory bounded by a block's window.
+    """
+    if STREAM_TRANSFORM and (populate_all_from_files or athlete_data is None):
+        from streaming_transform import stream_transform_athlete_data
+        return stream_transform_athlete_data(athlete_id, shadow=shadow)
+    
+    table = shadow_table_name if shadow else str
+    timings = StageTimings(athlete_id)
     try:
         if populate_all_from_files or athlete_data is None:
-            athlete_data = load_latest_athlete_data(athlete_id)
+            with timings.stage('load') as stage:
+                athlete_data = load_latest_athlete_data(athlete_id)
+                stage['rows_out'] = len(athlete_data.get('_Activities', [])) if athlete_data else 0
             if not athlete_data:
-                return
+                return False
         
         # Validate basic data
         if 'sex' not in athlete_data:
             logger.error(f"Invalid data for athlete {athlete_id}")
-            return
+            return False
             
         # Initialize DataFrames
         metadata_athletes = pd.DataFrame()
@@ -439,83 +696,107 @@ def transform_athlete_data(athlete_id: int, athlete_data: dict = None, populate_
         zones = get_athlete_zones(athlete_data)
         
         # Build HR regressor
-        regressor, not_nan_rows = build_pace_to_hr_regressor(activities, athlete_id, zones)
-        if not_nan_rows is not None:
-            average_paces_and_hrs = pd.concat([average_paces_and_hrs, not_nan_rows], ignore_index=True)
+        with timings.stage('hr_regressor', rows_in=len(activities)) as stage:
+            regressor, not_nan_rows = build_pace_to_hr_regressor(activities, athlete_id, zones)
+            # Missing heart rates are estimated from its coefficients, read once here
+            regressor = hr_estimator(regressor)
+            if not_nan_rows is not None:
+                average_paces_and_hrs = compact_frame(pd.concat([average_paces_and_hrs, not_nan_rows], ignore_index=True))
+            stage['rows_out'] = len(average_paces_and_hrs)
         
         # Save athlete metadata
-        metadata_athletes = pd.DataFrame([{
-            'id': athlete_data['id'],
-            'sex': athlete_data['sex'],
-            'weight': athlete_data['weight'],
-            'zones': athlete_data['_Zones']['heart_rate']['zones']
-        }])
+        metadata_athletes = athlete_metadata(athlete_data)
         
-        # Check for existing athlete data and update if necessary
-        existing_athletes = read_db('metadata_athletes')
-        if not existing_athletes.empty:
-            existing_athletes = existing_athletes.drop_duplicates(subset=['id'])
-            metadata_athletes = metadata_athletes.drop_duplicates(subset=['id'])
-            existing_athletes.set_index('id', inplace=True)
-            metadata_athletes.set_index('id', inplace=True)
-            metadata_athletes.update(existing_athletes)
-            metadata_athletes.reset_index(inplace=True)
+        # Activity features are extracted once and shared by every block
+        memo = load_transform_state(athlete_id, zones, regressor) if INCREMENTAL_TRANSFORM else ActivityFeatureMemo()
         
         # Process all activities
         activities.reverse()  # Process in chronological order
-        all_athlete_activities, all_athlete_weeks = process_activity_block(
-            activities, 
-            athlete_data, 
-            athlete_id,
-            zones,
-            regressor
-        )
+        with timings.stage('activity_block', rows_in=len(activities)) as stage:
+            index = ActivityIndex(activities)
+            all_athlete_activities, all_athlete_weeks = process_activity_block(
+                activities, 
+                athlete_data, 
+                athlete_id,
+                zones,
+                regressor,
+                with_week_features=not WEEK_AGGREGATES_IN_SQL,
+                memo=memo,
+                days=index.days
+            )
+            # Running totals of the same weeks, for training-window queries
+            weekly_cube = compact_frame(build_weekly_cube(
+                all_athlete_activities,
+                all_athlete_weeks['week_id'].tolist() if 'week_id' in all_athlete_weeks else [],
+                index.days[0] if activities else None,
+                athlete_id
+            ))
+            stage['rows_out'] = len(all_athlete_activities) + len(all_athlete_weeks)
         
         # Process PB blocks
-        metadata_blocks, features_activities, features_weeks = process_pb_blocks(
-            activities,
-            athlete_id,
-            zones,
-            regressor
-        )
+        with timings.stage('pb_blocks', rows_in=len(activities)) as stage:
+            metadata_blocks, features_activities, features_weeks = process_pb_blocks(
+                activities,
+                athlete_id,
+                zones,
+                regressor,
+                with_week_features=not WEEK_AGGREGATES_IN_SQL,
+                memo=memo,
+                index=index
+            )
+            stage['rows_out'] = len(metadata_blocks) + len(features_activities) + len(features_weeks)
         
-        # Calculate block-level features
-        features_blocks = pd.DataFrame()
-        for _, block in metadata_blocks.iterrows():
-            block_id = block['block_id']
-            block_weeks = features_weeks[features_weeks['block_id'] == block_id]
-            athlete_weeks = all_athlete_weeks[all_athlete_weeks['athlete_id'] == athlete_id]
-            
-            # Skip blocks without sufficient data using correct column names
-            run_distance_col = 'f_run_total_distance' if 'f_run_total_distance' in block_weeks.columns else 'f_total_run_distance'
-            
-            if (block_weeks['f_total_runs'].mean() == 0 or 
-                (run_distance_col in block_weeks.columns and block_weeks[run_distance_col][:-2].mean() == 0)):
-                continue
+        if WEEK_AGGREGATES_IN_SQL:
+            def derive_weekly_tables(conn):
+                """Weekly and block features from the activity rows just written."""
+                athlete_weeks = aggregate_weeks(conn, table('all_athlete_activities'), athlete_id,
+                                                all_athlete_weeks, all_athlete_activities)
+                block_weeks = aggregate_weeks(conn, table('features_activities'), athlete_id,
+                                              features_weeks, features_activities)
+                athlete_weeks = compact_frame(athlete_weeks)
+                block_weeks = compact_frame(block_weeks)
+                with timings.stage('block_metrics', rows_in=len(metadata_blocks)) as stage:
+                    block_features = build_features_blocks(
+                        metadata_blocks,
+                        block_weeks,
+                        athlete_weeks,
+                        features_activities,
+                        all_athlete_activities,
+                        athlete_id
+                    )
+                    stage['rows_out'] = len(block_features)
+                return {
+                    table('all_athlete_weeks'): athlete_weeks,
+                    table('features_weeks'): block_weeks,
+                    table('features_blocks'): block_features
+                }
             
-            # Calculate block metrics
-            try:
-                block_metrics = calculate_block_metrics(
-                    block_weeks=block_weeks, 
-                    athlete_weeks=athlete_weeks,
-                    features_activities=features_activities,
-                    all_athlete_activities=all_athlete_activities,
-                    block_id=block_id,
-                    athlete_id=athlete_id
-                )
-                
-                block_metrics.update({
-                    'athlete_id': athlete_id,
-                    'block_id': block_id,
-                    'y_vdot_delta': block['vdot_delta'],
-                    'y_vdot': block['vdot']
-                })
-                
-                features_blocks = pd.concat([features_blocks, pd.DataFrame([block_metrics])], ignore_index=True)
-                
-            except Exception as e:
-                logger.error(f"Error calculating metrics for block {block_id}: {e}")
-                continue
+            dataframes_to_save = {
+                'metadata_athletes': metadata_athletes,
+                'metadata_blocks': metadata_blocks,
+                'all_athlete_activities': all_athlete_activities,
+                'features_activities': features_activities,
+                'average_paces_and_hrs': average_paces_and_hrs,
+                'athlete_weekly_cube': weekly_cube
+            }
+            with timings.stage('save', rows_in=sum(len(df) for df in dataframes_to_save.values())):
+                save_dataframes_to_db(dataframes_to_save, athlete_id=athlete_id, derive=derive_weekly_tables,
+                                      shadow=shadow)
+                if isinstance(memo, TransformState):
+                    save_transform_state(athlete_id, memo)
+            return True
+        
+        # Calculate block-level features
+        with timings.stage('block_metrics', rows_in=len(metadata_blocks)) as stage:
+            features_blocks = build_features_blocks(
+                metadata_blocks,
+                features_weeks,
+                all_athlete_weeks,
+                features_activities,
+                all_athlete_activities,
+                athlete_id
+            )
+            stage['rows_out'] = len(features_blocks)
         
         # Save directly without merging
         dataframes_to_save = {
@@ -526,15 +807,22 @@ def transform_athlete_data(athlete_id: int, athlete_data: dict = None, populate_
             'features_activities': features_activities,
             'features_weeks': features_weeks,
             'features_blocks': features_blocks,
-            'average_paces_and_hrs': average_paces_and_hrs
+            'average_paces_and_hrs': average_paces_and_hrs,
+            'athlete_weekly_cube': weekly_cube
         }
         
         # Save all dataframes to database directly
-        save_dataframes_to_db(dataframes_to_save)
+        with timings.stage('save', rows_in=sum(len(df) for df in dataframes_to_save.values())):
+            save_dataframes_to_db(dataframes_to_save, athlete_id=athlete_id, shadow=shadow)
+            if isinstance(memo, TransformState):
+                save_transform_state(athlete_id, memo)
         
         # Don't update processing status here anymore
         # The update_data function will handle this
+        return True
         
     except Exception as e:
         logger.error(f"Error transforming athlete data: {e}")
         raise
+    finally:
+        timings.save()
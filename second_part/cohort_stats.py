@@ -0,0 +1,212 @@
+"""
+Cohort statistics over Parquet snapshots of the analytics tables.
+
+The comparison charts need, per feature, the mean over the top and bottom
+10% of blocks by a target, plus one athlete's last block. Instead of loading
+the whole table into every web worker, the table is exported once (in
+chunks) to ./data/snapshots/<table>.parquet and queried with DuckDB, which
+scans only the columns a query names and keeps the top-N in a heap.
+
+A snapshot is re-exported when this process wrote the table since the export
+(sql_methods table versions) or when it is older than the read cache TTL,
+which covers writes made by other processes. Without duckdb installed the
+same results are computed in pandas from cached_read_db.
+"""
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import inspect
+from sql_methods import get_db_connection, cached_read_db, table_version, READ_CACHE_TTL_SECONDS
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', './data/snapshots')
+
+# Rows read from the database per Parquet row group when exporting
+EXPORT_CHUNK_SIZE = 10000
+
+# Share of the cohort in each of the top and bottom groups
+COHORT_FRACTION = 0.1
+
+# table_name -> table version the snapshot was taken at
+_snapshot_versions = {}
+_snapshot_lock = threading.Lock()
+
+def arrow_type_for_column(sql_type) -> pa.DataType:
+    """Arrow type for a reflected column, so every chunk shares one schema."""
+    try:
+        python_type = sql_type.python_type
+    except NotImplementedError:
+        return pa.string()
+    if python_type is bool:
+        return pa.bool_()
+    if python_type is int:
+        return pa.int64()
+    if python_type is float:
+        return pa.float64()
+    if python_type.__name__ in ('datetime', 'date'):
+        return pa.timestamp('us')
+    return pa.string()
+
+def export_snapshot(table_name: str) -> Optional[str]:
+    """Export table_name to its Parquet snapshot; None if the table does not exist."""
+    engine = get_db_connection()
+    inspector = inspect(engine)
+    if table_name not in inspector.get_table_names():
+        logger.info(f"Table {table_name} does not exist yet, no snapshot")
+        return None
+
+    schema = pa.schema([(col['name'], arrow_type_for_column(col['type']))
+                        for col in inspector.get_columns(table_name)])
+    path = os.path.join(SNAPSHOT_DIR, f'{table_name}.parquet')
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+    rows = 0
+    try:
+        with pq.ParquetWriter(tmp_path, schema) as writer, engine.connect() as conn:
+            for chunk in pd.read_sql_table(table_name, conn, chunksize=EXPORT_CHUNK_SIZE):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                rows += len(chunk)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    logger.info(f"Exported {rows} rows of {table_name} to {path}")
+    return path
+
+def snapshot_path(table_name: str) -> Optional[str]:
+    """Path of a current snapshot of table_name, exporting it if needed."""
+    path = os.path.join(SNAPSHOT_DIR, f'{table_name}.parquet')
+    version = table_version(table_name)
+    with _snapshot_lock:
+        try:
+            fresh = time.time() - os.path.getmtime(path) < READ_CACHE_TTL_SECONDS
+        except OSError:
+            fresh = False
+        if fresh and _snapshot_versions.get(table_name, version) == version:
+            _snapshot_versions[table_name] = version
+            return path
+
+        path = export_snapshot(table_name)
+        if path is not None:
+            _snapshot_versions[table_name] = version
+        return path
+
+def query_snapshot(sql: str, params: list) -> pd.DataFrame:
+    """Run sql on a fresh in-memory DuckDB connection."""
+    conn = duckdb.connect()
+    try:
+        return conn.execute(sql, params).df()
+    finally:
+        conn.close()
+
+def quote(name: str) -> str:
+    """Quote a column name for DuckDB."""
+    return '"' + name.replace('"', '""') + '"'
+
+def numeric_columns(path: str) -> List[str]:
+    """Names of the snapshot's numeric columns, read from the Parquet footer."""
+    schema = pq.read_schema(path)
+    return [field.name for field in schema
+            if pa.types.is_integer(field.type) or pa.types.is_floating(field.type)]
+
+def table_row_count(table_name: str) -> int:
+    """Number of rows in table_name, 0 if it does not exist."""
+    if duckdb is None:
+        return len(cached_read_db(table_name))
+    path = snapshot_path(table_name)
+    return pq.ParquetFile(path).metadata.num_rows if path else 0
+
+def athlete_last_block(athlete_id: str) -> Optional[pd.Series]:
+    """The athlete's most recently written features_blocks row, None if there is none."""
+    if duckdb is None:
+        features_blocks = cached_read_db('features_blocks')
+        if features_blocks.empty:
+            return None
+        blocks = features_blocks[features_blocks['athlete_id'].astype(str) == str(athlete_id)]
+        return blocks.iloc[-1] if len(blocks) > 0 else None
+
+    path = snapshot_path('features_blocks')
+    if path is None:
+        return None
+    blocks = query_snapshot(
+        'SELECT * FROM read_parquet(?, file_row_number=true) WHERE CAST(athlete_id AS VARCHAR) = ? '
+        'ORDER BY file_row_number DESC LIMIT 1',
+        [path, str(athlete_id)]
+    )
+    return blocks.drop(columns='file_row_number').iloc[0] if len(blocks) > 0 else None
+
+def block_pb_date(block_id) -> Optional[pd.Timestamp]:
+    """pb_date of the first metadata_blocks row for block_id."""
+    if duckdb is None:
+        metadata_blocks = cached_read_db('metadata_blocks')
+        matches = metadata_blocks[metadata_blocks['block_id'] == block_id] if not metadata_blocks.empty else metadata_blocks
+        return matches.iloc[0]['pb_date'] if len(matches) > 0 else None
+
+    path = snapshot_path('metadata_blocks')
+    if path is None:
+        return None
+    rows = query_snapshot('SELECT pb_date FROM read_parquet(?, file_row_number=true) WHERE block_id = ? '
+                          'ORDER BY file_row_number LIMIT 1',
+                          [path, str(block_id)])
+    return rows['pb_date'].iloc[0] if len(rows) > 0 else None
+
+def cohort_means(target: str, features: List[str], fraction: float = COHORT_FRACTION) -> pd.DataFrame:
+    """Mean of each feature over the top and bottom fraction of features_blocks by target.
+
+    Returns a frame indexed by feature with 'top' and 'bottom' columns. Features
+    the table does not have are left out; features of a table without target
+    values get NaN, as the mean of an empty group.
+    """
+    if duckdb is None:
+        return cohort_means_pandas(cached_read_db('features_blocks'), target, features, fraction)
+
+    path = snapshot_path('features_blocks')
+    if path is None:
+        return pd.DataFrame(columns=['top', 'bottom'])
+    available = numeric_columns(path)
+    present = [feature for feature in features if feature in available]
+    if not present:
+        return pd.DataFrame(columns=['top', 'bottom'])
+    if target not in available:
+        return pd.DataFrame({'top': float('nan'), 'bottom': float('nan')}, index=present)
+
+    valid = query_snapshot(f'SELECT count(*) AS n FROM read_parquet(?) WHERE {quote(target)} IS NOT NULL',
+                           [path])['n'].iloc[0]
+    size = max(1, round(fraction * valid))
+    averages = ', '.join(f'avg({quote(feature)}) AS {quote(feature)}' for feature in present)
+    selected = ', '.join(quote(feature) for feature in present)
+    group = (f"SELECT '{{}}' AS cohort, {averages} FROM (SELECT {selected} FROM read_parquet(?) "
+             f"WHERE {quote(target)} IS NOT NULL ORDER BY {quote(target)} {{}} LIMIT ?)")
+    means = query_snapshot(f"{group.format('top', 'DESC')} UNION ALL {group.format('bottom', 'ASC')}",
+                           [path, size, path, size])
+    logger.info(f"Cohort of {valid} blocks by {target}, {size} in each of the top and bottom groups")
+    return means.set_index('cohort').T.reindex(present)[['top', 'bottom']].astype(float).rename_axis(columns=None)
+
+def cohort_means_pandas(features_blocks: pd.DataFrame, target: str, features: List[str],
+                        fraction: float = COHORT_FRACTION) -> pd.DataFrame:
+    """cohort_means over an in-memory features_blocks frame."""
+    present = [feature for feature in features if feature in features_blocks.columns]
+    if target in features_blocks.columns:
+        valid_blocks = features_blocks[features_blocks[target].notna()]
+    else:
+        valid_blocks = features_blocks.head(0)
+    size = max(1, round(fraction * len(valid_blocks)))
+    top = valid_blocks.sort_values([target], ascending=[False]).head(size) if len(valid_blocks) else valid_blocks
+    bottom = valid_blocks.sort_values([target], ascending=[True]).head(size) if len(valid_blocks) else valid_blocks
+    return pd.DataFrame({
+        'top': [top[feature].mean() for feature in present],
+        'bottom': [bottom[feature].mean() for feature in present]
+    }, index=present)
@@ -21,8 +21,7 @@ An application’s 15-minute limit is reset at natural 15-minute intervals corre
 import os
 import requests
 import logging
-import pandas as pd  # Add pandas import
-from sql_methods import read_db, write_db_replace
+from job_queue import enqueue_athlete, get_status
 
 logger = logging.getLogger(__name__)
 CLIENT_ID = os.environ.get('CLIENT_ID')
@@ -47,21 +46,12 @@ def get_athlete(bearer_token):
 
 def get_athlete_data_status(athlete_id):
     try:
-        processing_status = read_db('processing_status')
-        athlete_id_str = str(athlete_id)
-        
-        if processing_status.empty:
-            logger.info("Processing status table is empty")
+        ingest_status = get_status(athlete_id)
+        if ingest_status is None:
+            logger.info(f"No status found for athlete {athlete_id}")
             return "none"
-            
-        if athlete_id_str in processing_status["athlete_id"].values:
-            mask = processing_status["athlete_id"] == athlete_id_str
-            ingest_status = processing_status.loc[mask, "status"].iloc[0]
-            logger.info(f"Found status '{ingest_status}' for athlete {athlete_id}")
-            return ingest_status
-            
-        logger.info(f"No status found for athlete {athlete_id}")
-        return "none"
+        logger.info(f"Found status '{ingest_status}' for athlete {athlete_id}")
+        return ingest_status
         
     except Exception as e:
         logger.error(f"Error checking athlete status: {e}")
@@ -71,41 +61,11 @@ def queue_athlete_for_processing(athlete_id, bearer_token, refresh_token):
     try:
         logger.info(f"Starting to queue athlete {athlete_id}")
         
-        # Create DataFrame with the new athlete data
-        new_row = pd.DataFrame([{
-            'athlete_id': str(athlete_id),
-            'status': 'none',
-            'bearer_token': bearer_token,
-            'refresh_token': refresh_token
-        }])
-        
-        try:
-            # Try to read existing processing status
-            processing_status = read_db('processing_status')
-            logger.info(f"Current processing status entries: {len(processing_status)}")
-            
-            # Check if athlete already exists
-            if str(athlete_id) in processing_status['athlete_id'].values:
-                mask = processing_status['athlete_id'] == str(athlete_id)
-                processing_status.loc[mask, 'status'] = 'none'
-                processing_status.loc[mask, 'bearer_token'] = bearer_token
-                processing_status.loc[mask, 'refresh_token'] = refresh_token
-                logger.info("Updated existing athlete entry")
-            else:
-                processing_status = pd.concat([processing_status, new_row], ignore_index=True)
-                logger.info("Added new athlete entry")
-                
-        except Exception as e:
-            logger.warning(f"Could not read processing_status table: {e}")
-            logger.info("Creating new processing status table")
-            processing_status = new_row
-        
-        # Write back to database
-        logger.info(f"Writing processing status with {len(processing_status)} entries")
-        write_db_replace(processing_status, 'processing_status')
+        # Single-row upsert: new athletes are added, known ones are reset to 'none'
+        enqueue_athlete(athlete_id, bearer_token, refresh_token)
         logger.info(f"Successfully queued athlete {athlete_id}")
         return "none"
         
     except Exception as e:
         logger.error(f"Error queueing athlete {athlete_id}: {e}", exc_info=True)
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,68 @@
+"""
+dtype policy for the analytics DataFrames.
+
+compact_frame() is applied wherever the transformer or the model builds or
+reads one of the analytics tables:
+    athlete_id, block_id, week_id  - categories, repeated on every row
+    activity_id                    - nullable Int64
+    activity_type and counts       - nullable Int16 (NA where nothing happened)
+    measurements and features      - float32
+    PB values and model targets    - float64, they feed the regression targets
+    cum_* running totals           - float64, windows are differences of them
+                                     (see weekly_cube)
+
+sql_methods.sql_type_for_dtype maps the compact dtypes to matching column
+types, so the database rows shrink along with the frames.
+"""
+import logging
+from typing import Dict
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CATEGORY_COLUMNS = {'athlete_id', 'block_id', 'week_id'}
+
+ID_DTYPES = {'activity_id': 'Int64'}
+
+COUNT_DTYPE = 'Int16'
+COUNT_COLUMNS = {'activity_type', 'f_total_runs'}
+COUNT_PREFIXES = ('f_activity_type_',)
+
+MEASUREMENT_DTYPE = 'float32'
+
+# Kept at full precision
+FLOAT64_COLUMNS = {'vdot', 'vdot_delta', 'predicted_marathon_time', 'y_vdot', 'y_vdot_delta'}
+FLOAT64_PREFIXES = ('cum_',)
+
+def policy_dtype(column: str, dtype):
+    """Return the dtype the policy assigns to column, or None to keep dtype."""
+    if column in CATEGORY_COLUMNS:
+        return 'category'
+    if column in ID_DTYPES:
+        return ID_DTYPES[column]
+    if column in COUNT_COLUMNS or column.startswith(COUNT_PREFIXES):
+        return COUNT_DTYPE
+    if (pd.api.types.is_float_dtype(dtype) and column not in FLOAT64_COLUMNS
+            and not column.startswith(FLOAT64_PREFIXES)):
+        return MEASUREMENT_DTYPE
+    return None
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Return df with the dtype policy applied; columns the policy does not cover are kept."""
+    if df.empty:
+        return df
+
+    converted: Dict[str, pd.Series] = {}
+    for column in df.columns:
+        series = df[column]
+        dtype = policy_dtype(column, series.dtype)
+        if dtype is None or series.dtype == dtype:
+            continue
+        try:
+            if dtype in (COUNT_DTYPE, 'Int64'):
+                series = pd.to_numeric(series)
+            converted[column] = series.astype(dtype)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Keeping {column} as {series.dtype}: {e}")
+
+    return df.assign(**converted) if converted else df
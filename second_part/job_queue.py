@@ -0,0 +1,239 @@
+"""
+Job-queue operations on the processing_status table.
+
+Each athlete has one row. `status` is the pipeline state:
+    none       - queued, activities still to fetch
+    processing - fetched in part, more activities remain
+    processed  - everything fetched and transformed
+
+A worker claims a row by taking a lease (lease_owner, lease_expires_at) and
+keeps it alive with heartbeat(). Leased rows are invisible to other workers
+until they are released or the lease runs out, so a crashed worker's athlete
+is picked up again. Every operation touches a single row through the indexes
+on status, priority and lease_expires_at.
+"""
+import os
+import socket
+import threading
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+from sqlalchemy import and_, func, or_, select, update
+from sql_methods import get_db_connection, upsert_rows
+from models import ProcessingStatus
+
+logger = logging.getLogger(__name__)
+
+STATUS_NONE = 'none'
+STATUS_PROCESSING = 'processing'
+STATUS_PROCESSED = 'processed'
+
+DEFAULT_LEASE_SECONDS = 600
+
+# How often LeaseKeeper extends the leases it holds, well inside a lease
+HEARTBEAT_SECONDS = DEFAULT_LEASE_SECONDS // 3
+
+# Compare-and-set attempts before giving up on a contended claim (SQLite path)
+CLAIM_RETRIES = 5
+
+jobs = ProcessingStatus.__table__
+
+def get_worker_id() -> str:
+    """Identify this worker in lease_owner."""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+def claimable(states: Iterable[str], now: datetime):
+    """Condition for rows in one of states that no live lease holds."""
+    return and_(
+        jobs.c.status.in_(list(states)),
+        jobs.c.athlete_id != '0',
+        or_(jobs.c.lease_owner.is_(None), jobs.c.lease_expires_at < now)
+    )
+
+def enqueue_athlete(athlete_id, bearer_token: str, refresh_token: str, priority: int = 0) -> None:
+    """Insert or reset an athlete's job row with fresh tokens."""
+    now = datetime.utcnow()
+    with get_db_connection().begin() as conn:
+        upsert_rows(conn, 'processing_status', [{
+            'athlete_id': str(athlete_id),
+            'status': STATUS_NONE,
+            'bearer_token': bearer_token,
+            'refresh_token': refresh_token,
+            'priority': priority,
+            'lease_owner': None,
+            'lease_expires_at': None,
+            'updated_at': now
+        }])
+
+def get_status(athlete_id) -> Optional[str]:
+    """Return an athlete's status, or None if the athlete is not queued."""
+    with get_db_connection().connect() as conn:
+        return conn.execute(
+            select(jobs.c.status).where(jobs.c.athlete_id == str(athlete_id))
+        ).scalar()
+
+def list_jobs(states: Iterable[str]) -> List[Dict]:
+    """Return the rows in any of states, highest priority first."""
+    with get_db_connection().connect() as conn:
+        rows = conn.execute(
+            select(jobs)
+            .where(jobs.c.status.in_(list(states)), jobs.c.athlete_id != '0')
+            .order_by(jobs.c.priority.desc(), jobs.c.athlete_id)
+        ).mappings().all()
+    return [dict(row) for row in rows]
+
+def count_jobs(states: Iterable[str]) -> int:
+    """Count the rows in any of states."""
+    with get_db_connection().connect() as conn:
+        return conn.execute(
+            select(func.count())
+            .select_from(jobs)
+            .where(jobs.c.status.in_(list(states)), jobs.c.athlete_id != '0')
+        ).scalar()
+
+def claim_next(states: Iterable[str], worker_id: Optional[str] = None,
+               lease_seconds: int = DEFAULT_LEASE_SECONDS, exclude: Iterable[str] = ()) -> Optional[Dict]:
+    """Atomically lease the highest-priority claimable row and return it, or None.
+
+    MySQL and PostgreSQL lock the candidate with SELECT ... FOR UPDATE SKIP LOCKED,
+    so concurrent workers each get a different row without waiting. SQLite has one
+    writer at a time: the claim takes the write lock with BEGIN IMMEDIATE and a
+    conditional UPDATE acts as the compare-and-set.
+    """
+    worker_id = worker_id or get_worker_id()
+    engine = get_db_connection()
+    exclude = [str(athlete_id) for athlete_id in exclude]
+
+    for _ in range(CLAIM_RETRIES):
+        now = datetime.utcnow()
+        condition = claimable(states, now)
+        if exclude:
+            condition = and_(condition, jobs.c.athlete_id.notin_(exclude))
+        candidate = (
+            select(jobs)
+            .where(condition)
+            .order_by(jobs.c.priority.desc(), jobs.c.updated_at, jobs.c.athlete_id)
+            .limit(1)
+        )
+        lease = {
+            'lease_owner': worker_id,
+            'lease_expires_at': now + timedelta(seconds=lease_seconds),
+            'heartbeat_at': now,
+            'attempts': func.coalesce(jobs.c.attempts, 0) + 1,
+            'updated_at': now
+        }
+
+        with engine.connect() as conn, conn.execution_options(sqlite_begin='IMMEDIATE').begin():
+            if engine.dialect.name in ('mysql', 'postgresql'):
+                row = conn.execute(candidate.with_for_update(skip_locked=True)).mappings().first()
+                if row is None:
+                    return None
+                conn.execute(update(jobs).where(jobs.c.athlete_id == row['athlete_id']).values(lease))
+                return {**row, 'lease_owner': worker_id}
+
+            row = conn.execute(candidate).mappings().first()
+            if row is None:
+                return None
+            result = conn.execute(
+                update(jobs).where(jobs.c.athlete_id == row['athlete_id'], condition).values(lease)
+            )
+            if result.rowcount == 1:
+                return {**row, 'lease_owner': worker_id}
+        logger.debug(f"Lost claim race for athlete {row['athlete_id']}, retrying")
+    return None
+
+def heartbeat(athlete_id, worker_id: str, lease_seconds: int = DEFAULT_LEASE_SECONDS) -> bool:
+    """Extend a held lease. Returns False if the lease was lost to another worker."""
+    now = datetime.utcnow()
+    with get_db_connection().begin() as conn:
+        result = conn.execute(
+            update(jobs)
+            .where(jobs.c.athlete_id == str(athlete_id), jobs.c.lease_owner == worker_id)
+            .values(lease_expires_at=now + timedelta(seconds=lease_seconds), heartbeat_at=now)
+        )
+    if result.rowcount != 1:
+        logger.warning(f"Worker {worker_id} no longer holds the lease for athlete {athlete_id}")
+        return False
+    return True
+
+def release(athlete_id, worker_id: str, status: Optional[str] = None) -> bool:
+    """Drop a held lease, optionally moving the row to a new status."""
+    values = {'lease_owner': None, 'lease_expires_at': None, 'updated_at': datetime.utcnow()}
+    if status is not None:
+        values['status'] = status
+    with get_db_connection().begin() as conn:
+        result = conn.execute(
+            update(jobs)
+            .where(jobs.c.athlete_id == str(athlete_id), jobs.c.lease_owner == worker_id)
+            .values(values)
+        )
+    if result.rowcount != 1:
+        logger.warning(f"Worker {worker_id} lost the lease for athlete {athlete_id} before releasing it")
+        return False
+    return True
+
+class LeaseKeeper:
+    """Keeps a worker's leases alive from a background thread while their jobs run.
+    
+    Used as a context manager around the jobs: hold() an athlete once it is
+    claimed and release() it through the keeper, so no heartbeat lands after
+    the lease is gone. A lease that is lost anyway stops being extended and
+    its release() returns False.
+    """
+    
+    def __init__(self, worker_id: str, lease_seconds: int = DEFAULT_LEASE_SECONDS,
+                 interval: float = HEARTBEAT_SECONDS):
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self.held: Set[str] = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='lease-heartbeat', daemon=True)
+    
+    def __enter__(self) -> 'LeaseKeeper':
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.thread.join()
+    
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                for athlete_id in list(self.held):
+                    try:
+                        if not heartbeat(athlete_id, self.worker_id, self.lease_seconds):
+                            self.held.discard(athlete_id)
+                    except Exception as e:
+                        logger.error(f"Could not extend the lease for athlete {athlete_id}: {e}")
+    
+    def hold(self, athlete_id) -> None:
+        """Start extending the lease on a claimed athlete."""
+        with self.lock:
+            self.held.add(str(athlete_id))
+    
+    def release(self, athlete_id, status: Optional[str] = None) -> bool:
+        """release() the athlete's lease; False if it was lost while the job ran."""
+        with self.lock:
+            self.held.discard(str(athlete_id))
+            return release(athlete_id, self.worker_id, status)
+
+def set_tokens(athlete_id, bearer_token: str, refresh_token: str) -> None:
+    """Store refreshed OAuth tokens for one athlete."""
+    with get_db_connection().begin() as conn:
+        conn.execute(
+            update(jobs)
+            .where(jobs.c.athlete_id == str(athlete_id))
+            .values(bearer_token=bearer_token, refresh_token=refresh_token, updated_at=datetime.utcnow())
+        )
+
+def reset_statuses(status: str = STATUS_NONE) -> int:
+    """Set every row to status and clear all leases, returning the number of rows."""
+    with get_db_connection().begin() as conn:
+        result = conn.execute(
+            update(jobs).values(status=status, lease_owner=None, lease_expires_at=None,
+                                attempts=0, updated_at=datetime.utcnow())
+        )
+    return result.rowcount
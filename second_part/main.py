@@ -1,4 +1,4 @@
-from flask import Flask, session, request, render_template, redirect, send_file
+from flask import Flask, session, request, render_template, redirect, send_file, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_session import Session
 from environs import Env
@@ -7,9 +7,10 @@ import os
 import logging
 import urllib.parse
 from sqlalchemy import inspect, text
-from sql_methods import init_db, db, test_conn_new, read_db, write_db_replace
+from sql_methods import init_db, db, test_conn_new, read_db, cached_read_db, write_db_replace, get_database_url, get_engine_options
 from models import ProcessingStatus, Activity, AthleteStats  # Add this import
 from visualisations import athletevsbest, athletevsbestimprovement
+from job_queue import reset_statuses, STATUS_NONE
 import random
 from train_model import train_model
 
@@ -33,7 +34,9 @@ app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', os.urandom(24))
 Session(app)
 
 # Configure database
-app.config['SQLALCHEMY_DATABASE_URI'] = f'mysql+pymysql://{os.environ.get("DB_USER")}:{os.environ.get("DB_PASS")}@{os.environ.get("DB_HOST")}/{os.environ.get("DB_NAME")}'
+# DATABASE_URL selects the backend, e.g. sqlite:///data/strava.db for a local run
+app.config['SQLALCHEMY_DATABASE_URI'] = get_database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # Initialize the database
@@ -53,6 +56,10 @@ def create_required_tables():
         # Force create all tables from models
         db.create_all()
         
+        # Bring keys and indexes of existing tables up to date
+        from migrations import run_migrations
+        run_migrations(db.engine)
+        
         # Initialize processing_status if empty
         if 'processing_status' in existing_tables:
             with db.engine.connect() as conn:
@@ -233,12 +240,18 @@ def process_stored_data():
     logger.info(f"Data processing result: {res}")
     return str(res), 200
 
+@app.route('/rebuild_analytics')
+def rebuild_analytics():
+    """Rebuild the analytics tables from stored files and swap them in."""
+    from update_data import rebuild_analytics_tables
+    res = rebuild_analytics_tables()
+    logger.info(f"Analytics rebuild result: {res}")
+    return str(res), 200
+
 @app.route('/reset_processing')
 def reset_processing():
     try:
-        processing_status = read_db('processing_status')
-        processing_status['status'] = 'none'
-        write_db_replace(processing_status, 'processing_status')
+        reset_statuses(STATUS_NONE)
         return "Processing status reset successfully", 200
     except Exception as e:
         logger.error(f"Error resetting processing status: {e}")
@@ -247,7 +260,7 @@ def reset_processing():
 @app.route('/view_athletes')
 def view_athletes():
     try:
-        metadata_athletes = read_db('metadata_athletes')
+        metadata_athletes = cached_read_db('metadata_athletes')
         return render_template('view_athletes.html', athletes=metadata_athletes)
     except Exception as e:
         return f"Error retrieving athlete data: {str(e)}"
@@ -297,6 +310,29 @@ def view_stats(athlete_id):
     except Exception as e:
         return f"Error retrieving stats: {str(e)}"
 
+@app.route('/training_window/<athlete_id>')
+def training_window(athlete_id):
+    """Training aggregates of an athlete's last weeks, from the weekly cube.
+    
+    ?weeks=N sets the number of weeks (12 by default) and ?end=YYYY-MM-DD
+    the day whose week the window ends with (the athlete's last week by default).
+    """
+    from datetime import date
+    from weekly_cube import load_weekly_cube
+    try:
+        n_weeks = request.args.get('weeks', 12, type=int)
+        end = request.args.get('end')
+        cube = load_weekly_cube(athlete_id)
+        if cube is None:
+            return "No weekly cube found for this athlete", 404
+        first, last = cube.last_weeks(n_weeks, date.fromisoformat(end) if end else None)
+        return jsonify(cube.window(first, last))
+    except ValueError as e:
+        return f"Error: {str(e)}", 400
+    except Exception as e:
+        logger.error(f"Error reading training window of athlete {athlete_id}: {e}")
+        return f"Error retrieving training window: {str(e)}", 500
+
 @app.route('/reset_activities')
 def reset_activities():
     try:
@@ -306,9 +342,7 @@ def reset_activities():
             db.session.query(AthleteStats).delete()
             
             # Reset processing status to 'none'
-            processing_status = read_db('processing_status')
-            processing_status['status'] = 'none'
-            write_db_replace(processing_status, 'processing_status')
+            reset_statuses(STATUS_NONE)
             
             # Reset API call counter
             daily_limit = read_db('daily_limit')
@@ -383,7 +417,7 @@ def model_results(athlete_id):
     """Display model results and SHAP plots for an athlete."""
     try:
         # Check if model outputs exist
-        model_outputs = read_db('model_outputs')
+        model_outputs = cached_read_db('model_outputs')
         if model_outputs.empty or not any(model_outputs['athlete_id'] == athlete_id):
             # Train model if no results exist
             results = train_model(athlete_id)
@@ -0,0 +1,274 @@
+"""
+Versioned schema migrations.
+
+Each entry in MIGRATIONS is (version, description, function). The function gets
+an open connection and runs inside a single transaction; applied versions are
+recorded in schema_migrations so every migration runs exactly once. Migrations
+are written to be idempotent because MySQL commits DDL implicitly, so a run
+interrupted half way can simply be repeated.
+
+Run with `python migrations.py`, or call run_migrations() at start-up
+(main.create_required_tables does this).
+"""
+import json
+import logging
+from datetime import datetime
+from typing import Callable, List, Tuple
+import pandas as pd
+from sqlalchemy import inspect, text, MetaData, String
+from sql_methods import db, get_db_connection, get_managed_table, ensure_columns, upsert_rows, clear_read_cache
+from models import SchemaMigration, Activity, ActivityPayload, PipelineStageTiming, AthleteWeeklyCube, TableLease
+
+logger = logging.getLogger(__name__)
+
+# Tables rebuilt by the transform, keyed by athlete
+ANALYTICS_TABLES = [
+    'metadata_athletes',
+    'metadata_blocks',
+    'all_athlete_activities',
+    'all_athlete_weeks',
+    'features_activities',
+    'features_weeks',
+    'features_blocks',
+    'average_paces_and_hrs',
+    'athlete_weekly_cube'
+]
+
+# Tables that write_db_replace used to drop and recreate without keys
+LEGACY_TO_SQL_TABLES = ANALYTICS_TABLES + ['processing_status', 'model_outputs']
+
+# Suffixes of the tables recreate_table builds in and retires
+REBUILD_SUFFIX = '__rebuild'
+RETIRED_SUFFIX = '__retired'
+
+def recreate_table(conn, table_name: str, rows: pd.DataFrame) -> None:
+    """Replace table_name by a table created from its declaration, holding rows.
+    
+    The rows are copied into <table>__rebuild first and it is swapped in by a
+    rename only once the copy succeeded, so on MySQL, where every DDL statement
+    commits on its own, a failed copy leaves the old table (without its key)
+    in place and the next run tries again.
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    rebuild_name = f'{table_name}{REBUILD_SUFFIX}'
+    retired_name = f'{table_name}{RETIRED_SUFFIX}'
+    for leftover in (rebuild_name, retired_name):
+        conn.execute(text(f'DROP TABLE IF EXISTS {quote(leftover)}'))
+    
+    # Indexes are created once the table has its name, as index names are global on SQLite and PostgreSQL
+    rebuild = get_managed_table(table_name).to_metadata(MetaData(), name=rebuild_name)
+    for index in list(rebuild.indexes):
+        rebuild.indexes.discard(index)
+    rebuild.create(conn)
+    if not rows.empty:
+        ensure_columns(conn, rebuild_name, rows)
+        rows.to_sql(name=rebuild_name, con=conn, if_exists='append', index=False)
+    
+    if conn.dialect.name == 'mysql':
+        conn.execute(text(f'RENAME TABLE {quote(table_name)} TO {quote(retired_name)}, '
+                          f'{quote(rebuild_name)} TO {quote(table_name)}'))
+        conn.execute(text(f'DROP TABLE {quote(retired_name)}'))
+    else:
+        conn.execute(text(f'DROP TABLE {quote(table_name)}'))
+        conn.execute(text(f'ALTER TABLE {quote(rebuild_name)} RENAME TO {quote(table_name)}'))
+    add_missing_indexes(conn, [table_name])
+
+def rebuild_legacy_tables(conn) -> None:
+    """Recreate tables created by to_sql (no primary key) from their declared schema, keeping the rows."""
+    for table_name in LEGACY_TO_SQL_TABLES:
+        inspector = inspect(conn)
+        if not inspector.has_table(table_name):
+            continue
+        if inspector.get_pk_constraint(table_name).get('constrained_columns'):
+            continue
+
+        table = get_managed_table(table_name)
+        rows = pd.read_sql_table(table_name, conn)
+        pk_columns = [col.name for col in table.primary_key.columns if col.name in rows.columns]
+        if pk_columns:
+            rows = rows.drop_duplicates(subset=pk_columns, keep='last')
+
+        logger.warning(f"Rebuilding legacy table {table_name} with {len(rows)} rows")
+        recreate_table(conn, table_name, rows)
+
+def add_missing_indexes(conn, table_names: List[str]) -> None:
+    """Create declared indexes that are missing from existing tables."""
+    inspector = inspect(conn)
+    for table_name in table_names:
+        table = get_managed_table(table_name)
+        if not inspector.has_table(table_name):
+            continue
+        existing = {tuple(ix['column_names']) for ix in inspector.get_indexes(table_name)}
+        for index in table.indexes:
+            columns = tuple(col.name for col in index.columns)
+            if columns not in existing:
+                index.create(conn)
+                logger.info(f"Created index {index.name} on {table_name}{columns}")
+
+def create_analytics_schema(conn) -> None:
+    """Declare keys and indexes for the analytics tables."""
+    tables = [get_managed_table(name) for name in LEGACY_TO_SQL_TABLES]
+    rebuild_legacy_tables(conn)
+    db.metadata.create_all(conn, tables=tables, checkfirst=True)
+    add_missing_indexes(conn, LEGACY_TO_SQL_TABLES)
+
+# Activities copied per statement when moving payloads out of the activities table
+PAYLOAD_COPY_BATCH_SIZE = 500
+
+def move_activity_payloads(conn) -> None:
+    """Move activities.activity_data JSON into compressed activity_payloads rows."""
+    db.metadata.create_all(conn, tables=[Activity.__table__, ActivityPayload.__table__], checkfirst=True)
+    add_missing_indexes(conn, ['activities'])
+    
+    if 'activity_data' not in {col['name'] for col in inspect(conn).get_columns('activities')}:
+        return
+    
+    copied = 0
+    last_id = None
+    while True:
+        query = 'SELECT id, activity_data FROM activities WHERE activity_data IS NOT NULL'
+        if last_id is not None:
+            query += ' AND id > :last_id'
+        rows = conn.execute(text(query + ' ORDER BY id LIMIT :limit'),
+                            {'last_id': last_id, 'limit': PAYLOAD_COPY_BATCH_SIZE}).all()
+        if not rows:
+            break
+        payloads = []
+        for activity_id, activity_data in rows:
+            if isinstance(activity_data, (str, bytes)):
+                activity_data = json.loads(activity_data)
+            payloads.append({'activity_id': activity_id, 'payload': ActivityPayload.encode(activity_data)})
+        upsert_rows(conn, 'activity_payloads', payloads)
+        copied += len(payloads)
+        last_id = rows[-1][0]
+    
+    logger.info(f"Moved {copied} activity payloads to activity_payloads")
+    conn.execute(text('ALTER TABLE activities DROP COLUMN activity_data'))
+
+def add_missing_columns(conn, table_name: str) -> None:
+    """Add declared columns that are missing from an existing table."""
+    table = get_managed_table(table_name)
+    existing = {col['name'] for col in inspect(conn).get_columns(table_name)}
+    for column in table.columns:
+        if column.name not in existing:
+            col_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {column.name} {col_type}'))
+            logger.info(f"Added column {column.name} to {table_name}")
+
+def add_job_queue_columns(conn) -> None:
+    """Give processing_status priority, lease and heartbeat columns with their indexes."""
+    table = get_managed_table('processing_status')
+    table.create(conn, checkfirst=True)
+    add_missing_columns(conn, 'processing_status')
+    conn.execute(table.update().where(table.c.priority.is_(None)).values(priority=0))
+    conn.execute(table.update().where(table.c.attempts.is_(None)).values(attempts=0))
+    add_missing_indexes(conn, ['processing_status'])
+
+def add_week_aggregate_indexes(conn) -> None:
+    """Index the activity feature tables on (athlete_id, week_id) for the weekly GROUP BY."""
+    add_missing_indexes(conn, ['all_athlete_activities', 'features_activities'])
+
+# Declared columns narrowed to match the frame_dtypes policy
+RETYPED_COLUMNS = {
+    'metadata_athletes': ['weight'],
+    'all_athlete_activities': ['activity_type'],
+    'features_activities': ['activity_type'],
+    'all_athlete_weeks': ['f_total_runs'],
+    'features_weeks': ['f_total_runs']
+}
+
+def retype_columns(conn, table_name: str, column_names: List[str]) -> None:
+    """Change existing columns to their declared type, converting the stored values."""
+    inspector = inspect(conn)
+    if not inspector.has_table(table_name):
+        return
+    table = get_managed_table(table_name)
+    existing = {col['name']: col['type'] for col in inspector.get_columns(table_name)}
+    columns = [table.c[name] for name in column_names if name in existing]
+    text_to_number = [col for col in columns
+                      if isinstance(existing[col.name], String) and not isinstance(col.type, String)]
+
+    # Text that is not a number, e.g. 'None' written by astype(str), becomes NULL
+    key = table.primary_key.columns.values()[0].name
+    for column in text_to_number:
+        rows = conn.execute(text(f'SELECT {key}, {column.name} FROM {table_name}')).all()
+        invalid = [row[0] for row in rows if pd.isna(pd.to_numeric(row[1], errors='coerce'))]
+        if invalid:
+            conn.execute(table.update().where(table.c[key].in_(invalid)).values({column.name: None}))
+
+    if conn.dialect.name == 'sqlite':
+        # Integer widths share one affinity in SQLite; only text to number needs a rebuild
+        if text_to_number:
+            recreate_table(conn, table_name, pd.read_sql_table(table_name, conn))
+        return
+
+    for column in columns:
+        col_type = column.type.compile(dialect=conn.dialect)
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text(f'ALTER TABLE {table_name} ALTER COLUMN {column.name} '
+                              f'TYPE {col_type} USING {column.name}::{col_type}'))
+        else:
+            conn.execute(text(f'ALTER TABLE {table_name} MODIFY COLUMN {column.name} {col_type}'))
+    logger.info(f"Retyped {[col.name for col in columns]} on {table_name}")
+
+def retype_compact_columns(conn) -> None:
+    """Narrow declared columns to the compact dtypes written by the transformer."""
+    for table_name, column_names in RETYPED_COLUMNS.items():
+        retype_columns(conn, table_name, column_names)
+
+def create_stage_timings_table(conn) -> None:
+    """Create pipeline_stage_timings for the transform's per-stage timings."""
+    db.metadata.create_all(conn, tables=[PipelineStageTiming.__table__], checkfirst=True)
+
+def create_weekly_cube_table(conn) -> None:
+    """Create athlete_weekly_cube for training-window queries."""
+    db.metadata.create_all(conn, tables=[AthleteWeeklyCube.__table__], checkfirst=True)
+
+def create_table_leases_table(conn) -> None:
+    """Create table_leases for the writers that hold whole tables, see table_leases."""
+    db.metadata.create_all(conn, tables=[TableLease.__table__], checkfirst=True)
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, 'keys and indexes for analytics tables', create_analytics_schema),
+    (2, 'move activity JSON to compressed activity_payloads', move_activity_payloads),
+    (3, 'job queue columns for processing_status', add_job_queue_columns),
+    (4, 'athlete/week indexes for weekly aggregates', add_week_aggregate_indexes),
+    (5, 'numeric weight and 16-bit counts', retype_compact_columns),
+    (6, 'per-stage transform timings', create_stage_timings_table),
+    (7, 'weekly cube of running totals', create_weekly_cube_table),
+    (8, 'leases on whole tables', create_table_leases_table),
+]
+
+def get_applied_versions(engine) -> set:
+    """Return the set of migration versions already applied."""
+    SchemaMigration.__table__.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        return set(conn.execute(text('SELECT version FROM schema_migrations')).scalars())
+
+def run_migrations(engine=None) -> int:
+    """Apply pending migrations in version order and return how many ran."""
+    engine = engine if engine is not None else get_db_connection()
+    applied = get_applied_versions(engine)
+    count = 0
+
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version}: {description}")
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(SchemaMigration.__table__.insert().values(
+                version=version,
+                description=description,
+                applied_at=datetime.utcnow()
+            ))
+        count += 1
+
+    if count:
+        clear_read_cache()
+    logger.info(f"Schema up to date ({count} migrations applied)")
+    return count
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_migrations()
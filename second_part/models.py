@@ -1,12 +1,25 @@
+import json
+import zlib
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import declared_attr
 from sql_methods import db
 
 class ProcessingStatus(db.Model):
     __tablename__ = 'processing_status'
+    __table_args__ = (
+        db.Index('ix_processing_status_status_priority', 'status', 'priority'),
+    )
     
     athlete_id = db.Column(db.String(100), primary_key=True)
     status = db.Column(db.String(50))
     bearer_token = db.Column(db.String(255))
     refresh_token = db.Column(db.String(255))
+    priority = db.Column(db.Integer, default=0)
+    lease_owner = db.Column(db.String(255))
+    lease_expires_at = db.Column(db.DateTime, index=True)
+    heartbeat_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime)
 
     def __repr__(self):
         return f'<ProcessingStatus {self.athlete_id}>'
@@ -26,7 +39,7 @@ class Activity(db.Model):
     __tablename__ = 'activities'
     
     id = db.Column(db.BigInteger, primary_key=True)
-    athlete_id = db.Column(db.String(100))
+    athlete_id = db.Column(db.String(100), index=True)
     name = db.Column(db.String(255))
     distance = db.Column(db.Float)
     moving_time = db.Column(db.Integer)
@@ -38,17 +51,46 @@ class Activity(db.Model):
     max_speed = db.Column(db.Float)
     average_heartrate = db.Column(db.Float)
     max_heartrate = db.Column(db.Float)
-    activity_data = db.Column(db.JSON)  # Store full activity JSON
+    # Full activity JSON lives in activity_payloads and is only loaded on access
+    payload = db.relationship('ActivityPayload', uselist=False, lazy='select',
+                              cascade='all, delete-orphan', passive_deletes=True)
+    
+    @property
+    def activity_data(self):
+        """Full Strava activity JSON, loaded from activity_payloads."""
+        return self.payload.data if self.payload is not None else None
     
     def __repr__(self):
         return f'<Activity {self.id}>'
 
+class ActivityPayload(db.Model):
+    __tablename__ = 'activity_payloads'
+    
+    activity_id = db.Column(db.BigInteger, db.ForeignKey('activities.id', ondelete='CASCADE'),
+                            primary_key=True, autoincrement=False)
+    payload = db.Column(db.LargeBinary().with_variant(mysql.LONGBLOB(), 'mysql'))  # zlib-compressed JSON
+    
+    @staticmethod
+    def encode(activity_data: dict) -> bytes:
+        return zlib.compress(json.dumps(activity_data, separators=(',', ':')).encode('utf-8'))
+    
+    @staticmethod
+    def decode(payload: bytes) -> dict:
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+    
+    @property
+    def data(self):
+        return self.decode(self.payload) if self.payload is not None else None
+    
+    def __repr__(self):
+        return f'<ActivityPayload {self.activity_id}>'
+
 class FeaturesBlock(db.Model):
     __tablename__ = 'features_blocks'
     
     id = db.Column(db.Integer, primary_key=True)
-    athlete_id = db.Column(db.String(100))
-    block_id = db.Column(db.String(100))
+    athlete_id = db.Column(db.String(100), index=True)
+    block_id = db.Column(db.String(100), index=True)
     y_vdot_delta = db.Column(db.Float)
     y_vdot = db.Column(db.Float)
     f_slope_run_distance = db.Column(db.Float)
@@ -65,12 +107,12 @@ class MetadataBlock(db.Model):
     __tablename__ = 'metadata_blocks'
     
     id = db.Column(db.Integer, primary_key=True)
-    athlete_id = db.Column(db.String(100))
+    athlete_id = db.Column(db.String(100), index=True)
     vdot = db.Column(db.Float)
     vdot_delta = db.Column(db.Float)
     predicted_marathon_time = db.Column(db.Float)
-    pb_date = db.Column(db.DateTime)
-    block_id = db.Column(db.String(100))
+    pb_date = db.Column(db.DateTime, index=True)
+    block_id = db.Column(db.String(100), index=True)
 
     def __repr__(self):
         return f'<MetadataBlock {self.block_id}>'
@@ -84,4 +126,185 @@ class ModelOutput(db.Model):
     importance = db.Column(db.Float)
 
     def __repr__(self):
-        return f'<ModelOutput {self.y_name}_{self.feature_name}>'
\ No newline at end of file
+        return f'<ModelOutput {self.y_name}_{self.feature_name}>'
+
+class MetadataAthlete(db.Model):
+    __tablename__ = 'metadata_athletes'
+    
+    id = db.Column(db.String(100), primary_key=True)
+    sex = db.Column(db.String(10))
+    weight = db.Column(db.Float)
+    zones = db.Column(db.Text)
+
+    def __repr__(self):
+        return f'<MetadataAthlete {self.id}>'
+
+class ActivityFeaturesMixin:
+    """Columns shared by the per-activity feature tables."""
+    
+    @declared_attr
+    def __table_args__(cls):
+        # Serves the GROUP BY athlete_id, week_id in week_aggregates
+        return (db.Index(f'ix_{cls.__tablename__}_athlete_week', 'athlete_id', 'week_id'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    athlete_id = db.Column(db.String(100), index=True)
+    block_id = db.Column(db.String(100), index=True)
+    week_id = db.Column(db.String(100), index=True)
+    activity_type = db.Column(db.SmallInteger)
+    activity_id = db.Column(db.BigInteger, index=True)
+    elapsed_time = db.Column(db.Float)
+    distance = db.Column(db.Float)
+    mean_hr = db.Column(db.Float)
+    stdev_hr = db.Column(db.Float)
+    freq_hr = db.Column(db.Float)
+    time_in_z1 = db.Column(db.Float)
+    time_in_z2 = db.Column(db.Float)
+    time_in_z3 = db.Column(db.Float)
+    time_in_z4 = db.Column(db.Float)
+    time_in_z5 = db.Column(db.Float)
+    elevation = db.Column(db.Float)
+    stdev_elevation = db.Column(db.Float)
+    freq_elevation = db.Column(db.Float)
+    pace = db.Column(db.Float)
+    stdev_pace = db.Column(db.Float)
+    freq_pace = db.Column(db.Float)
+    cadence = db.Column(db.Float)
+    athlete_count = db.Column(db.Float)
+
+class AllAthleteActivity(ActivityFeaturesMixin, db.Model):
+    __tablename__ = 'all_athlete_activities'
+
+    def __repr__(self):
+        return f'<AllAthleteActivity {self.activity_id}>'
+
+class FeaturesActivity(ActivityFeaturesMixin, db.Model):
+    __tablename__ = 'features_activities'
+
+    def __repr__(self):
+        return f'<FeaturesActivity {self.block_id}_{self.activity_id}>'
+
+class WeekFeaturesMixin:
+    """Key columns shared by the weekly feature tables.
+
+    The f_* aggregates depend on the activity mix of the cohort, so they are
+    added as columns on demand by sql_methods.ensure_columns.
+    """
+    
+    id = db.Column(db.Integer, primary_key=True)
+    athlete_id = db.Column(db.String(100), index=True)
+    block_id = db.Column(db.String(100), index=True)
+    week_id = db.Column(db.String(100), index=True)
+    f_total_runs = db.Column(db.SmallInteger)
+
+class AllAthleteWeek(WeekFeaturesMixin, db.Model):
+    __tablename__ = 'all_athlete_weeks'
+
+    def __repr__(self):
+        return f'<AllAthleteWeek {self.week_id}>'
+
+class FeaturesWeek(WeekFeaturesMixin, db.Model):
+    __tablename__ = 'features_weeks'
+
+    def __repr__(self):
+        return f'<FeaturesWeek {self.week_id}>'
+
+class AveragePaceAndHr(db.Model):
+    __tablename__ = 'average_paces_and_hrs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    athlete_id = db.Column(db.String(100), index=True)
+    mean_hr = db.Column(db.Float)
+    pace = db.Column(db.Float)
+
+    def __repr__(self):
+        return f'<AveragePaceAndHr {self.athlete_id}>'
+
+class AthleteWeeklyCube(db.Model):
+    """Running totals of each week of an athlete's block '0', see weekly_cube.
+
+    The cum_type_<activity_type> counts are added as columns on demand by
+    sql_methods.ensure_columns. Totals are double precision, as a window is
+    the difference of two of them.
+    """
+    __tablename__ = 'athlete_weekly_cube'
+    __table_args__ = (
+        db.Index('ix_athlete_weekly_cube_athlete_week', 'athlete_id', 'week_index'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    athlete_id = db.Column(db.String(100), index=True)
+    week_id = db.Column(db.String(100))
+    week_index = db.Column(db.Integer)
+    week_start = db.Column(db.DateTime)
+    cum_run_distance = db.Column(db.Float(precision=53))
+    cum_run_time = db.Column(db.Float(precision=53))
+    cum_non_run_distance = db.Column(db.Float(precision=53))
+    cum_non_run_time = db.Column(db.Float(precision=53))
+    cum_run_distance_sq = db.Column(db.Float(precision=53))
+    cum_run_time_sq = db.Column(db.Float(precision=53))
+    cum_non_run_distance_sq = db.Column(db.Float(precision=53))
+    cum_non_run_time_sq = db.Column(db.Float(precision=53))
+    cum_run_z1_time = db.Column(db.Float(precision=53))
+    cum_run_z2_time = db.Column(db.Float(precision=53))
+    cum_run_z3_time = db.Column(db.Float(precision=53))
+    cum_run_z4_time = db.Column(db.Float(precision=53))
+    cum_run_z5_time = db.Column(db.Float(precision=53))
+    cum_run_hr = db.Column(db.Float(precision=53))
+    cum_run_distance_week_sq = db.Column(db.Float(precision=53))
+    cum_run_distance_week_t = db.Column(db.Float(precision=53))
+    cum_run_time_week_sq = db.Column(db.Float(precision=53))
+    cum_run_time_week_t = db.Column(db.Float(precision=53))
+    cum_non_run_distance_week_sq = db.Column(db.Float(precision=53))
+    cum_non_run_distance_week_t = db.Column(db.Float(precision=53))
+    cum_non_run_time_week_sq = db.Column(db.Float(precision=53))
+    cum_non_run_time_week_t = db.Column(db.Float(precision=53))
+    cum_runs = db.Column(db.BigInteger)
+    cum_non_runs = db.Column(db.BigInteger)
+    cum_run_hr_count = db.Column(db.BigInteger)
+
+    def __repr__(self):
+        return f'<AthleteWeeklyCube {self.athlete_id} {self.week_id}>'
+
+class PipelineStageTiming(db.Model):
+    __tablename__ = 'pipeline_stage_timings'
+    __table_args__ = (
+        db.Index('ix_pipeline_stage_timings_stage_started', 'stage', 'started_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.String(32), index=True)
+    athlete_id = db.Column(db.String(100), index=True)
+    stage = db.Column(db.String(50))
+    started_at = db.Column(db.DateTime)
+    wall_seconds = db.Column(db.Float)
+    cpu_seconds = db.Column(db.Float)
+    rows_in = db.Column(db.Integer)
+    rows_out = db.Column(db.Integer)
+    max_rss_mb = db.Column(db.Float)
+    alloc_peak_mb = db.Column(db.Float)
+
+    def __repr__(self):
+        return f'<PipelineStageTiming {self.athlete_id} {self.stage}>'
+
+class TableLease(db.Model):
+    """A writer's lease on a whole table, see table_leases."""
+    __tablename__ = 'table_leases'
+    
+    table_name = db.Column(db.String(100), primary_key=True)
+    owner = db.Column(db.String(255), primary_key=True)
+    exclusive = db.Column(db.Boolean, default=False)
+    expires_at = db.Column(db.DateTime, index=True)
+
+    def __repr__(self):
+        return f'<TableLease {self.table_name} {self.owner}>'
+
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+    
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255))
+    applied_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<SchemaMigration {self.version}>'
@@ -1,6 +1,6 @@
 import math
 import datetime
-from typing import List, Dict, Tuple, Optional
+from typing import Callable, List, Dict, Tuple, Optional
 import numpy as np
 from scipy import stats
 import pandas as pd
@@ -18,6 +18,39 @@ PB_CONSTANTS = {
     'MIN_DAYS_BETWEEN_PB': 14
 }
 
+# Outlier runs, in the order label_run_outliers returns them
+OUTLIER_TYPES = ['distance', 'intense', 'varying']
+
+# activity_type of runs in the feature records
+RUN_ACTIVITY_TYPE = 2
+
+# Summed, averaged and spread per week, for runs and non-runs
+WEEK_STAT_COLUMNS = ['distance', 'elapsed_time']
+WEEK_STAT_PREFIXES = {'runs': 'f_run', 'non_runs': 'f_non_run'}
+
+# Week feature -> (activity column, aggregation), over the week's runs and non-runs
+WEEK_METRICS = {
+    'runs': {
+        'f_run_mean_hr': ('mean_hr', 'mean'),
+        'f_run_stdev_hr': ('stdev_hr', 'mean'),
+        'f_run_freq_hr': ('freq_hr', 'mean'),
+        'f_sum_elevation': ('elevation', 'sum'),
+        'f_mean_elevation': ('elevation', 'mean'),
+        'f_stdev_elevation': ('stdev_elevation', 'mean'),
+        'f_freq_elevation': ('freq_elevation', 'mean'),
+        'f_pace': ('pace', 'mean'),
+        'f_stdev_pace': ('stdev_pace', 'mean'),
+        'f_freq_pace': ('freq_pace', 'mean'),
+        'f_cadence': ('cadence', 'mean'),
+        'f_athlete_count': ('athlete_count', 'mean')
+    },
+    'non_runs': {
+        'f_non_run_mean_hr': ('mean_hr', 'mean'),
+        'f_non_run_stdev_hr': ('stdev_hr', 'mean'),
+        'f_non_run_freq_hr': ('freq_hr', 'mean')
+    }
+}
+
 def calculate_vdot(distance: float, time_minutes: float) -> Tuple[float, float]:
     """Calculate VDOT and predicted marathon time using Daniels' formula."""
     c = -4.6 + 0.182258 * (distance/time_minutes) + 0.000104 * (distance/time_minutes)**2
@@ -87,10 +120,14 @@ def get_pbs(activities: List[dict]) -> List[List]:
 
     return significant_pbs
 
-def get_run_outliers(all_activities: pd.DataFrame, block_id: int, athlete_id: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    """Identify distance, intensity, and interval outliers in running activities."""
-    runs = all_activities[all_activities['activity_type'] == 2]
-    block_activities = runs[runs['block_id'] == block_id]
+def label_run_outliers(all_activities: pd.DataFrame, athlete_id: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Distance, intensity and interval outlier runs of the athlete, across all blocks.
+    
+    The z-scores, means and thresholds are athlete-wide, so every run is
+    labelled against them in one pass and the outliers are split by block_id
+    afterwards.
+    """
+    runs = all_activities[all_activities['activity_type'] == RUN_ACTIVITY_TYPE]
     athlete_activities = runs[runs['athlete_id'] == athlete_id]
 
     # Initialize empty DataFrames
@@ -103,13 +140,9 @@ def get_run_outliers(all_activities: pd.DataFrame, block_id: int, athlete_id: st
         athlete_mean_distance = athlete_activities['distance'].mean()
         distance_outliers = athlete_activities[
             (np.abs(stats.zscore(athlete_activities["distance"])) >= 1.2) &
-            (athlete_activities["distance"] >= athlete_mean_distance) &
-            (athlete_activities['block_id'] == block_id)
+            (athlete_activities["distance"] >= athlete_mean_distance)
         ]
 
-        # Intensity outliers
-        intensity_outliers = pd.DataFrame()
-        
         # Heart rate based intensity
         if athlete_activities['mean_hr'].sum() != 0:
             hr_activities = athlete_activities[athlete_activities['mean_hr'].notna()]
@@ -117,8 +150,7 @@ def get_run_outliers(all_activities: pd.DataFrame, block_id: int, athlete_id: st
             hr_outliers = hr_activities[
                 (np.abs(stats.zscore(hr_activities["mean_hr"])) >= 1.2) &
                 (hr_activities["distance"] >= athlete_mean_distance) &
-                (hr_activities["mean_hr"] >= athlete_mean_hr) &
-                (hr_activities['block_id'] == block_id)
+                (hr_activities["mean_hr"] >= athlete_mean_hr)
             ]
             intensity_outliers = pd.concat([intensity_outliers, hr_outliers])
 
@@ -129,27 +161,42 @@ def get_run_outliers(all_activities: pd.DataFrame, block_id: int, athlete_id: st
             pace_outliers = pace_activities[
                 (np.abs(stats.zscore(pace_activities["pace"])) >= 1.5) &
                 (pace_activities["distance"] >= 1000) &
-                (pace_activities["pace"] >= athlete_mean_pace) &
-                (pace_activities['block_id'] == block_id)
+                (pace_activities["pace"] >= athlete_mean_pace)
             ]
             intensity_outliers = pd.concat([intensity_outliers, pace_outliers])
 
         # Interval outliers
         if not athlete_activities['stdev_hr'].isna().all():
             stdev_hr_threshold = athlete_activities['stdev_hr'].mean()
-            interval_outliers = block_activities[
-                (block_activities['stdev_hr'].notna()) &
-                (block_activities["distance"] >= 1000) &
-                (block_activities["stdev_hr"] >= stdev_hr_threshold)
+            interval_outliers = runs[
+                (runs['stdev_hr'].notna()) &
+                (runs["distance"] >= 1000) &
+                (runs["stdev_hr"] >= stdev_hr_threshold)
             ]
 
     except Exception as e:
         logger.error(f"Error identifying outliers: {e}")
 
-    return distance_outliers.drop_duplicates(), intensity_outliers.drop_duplicates(), interval_outliers.drop_duplicates()
+    return distance_outliers, intensity_outliers, interval_outliers
 
-def extract_activity_features(
-    activities: pd.DataFrame, 
+def get_run_outliers(all_activities: pd.DataFrame, block_id: int, athlete_id: str) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Identify distance, intensity, and interval outliers in running activities."""
+    return tuple(
+        outliers[outliers['block_id'] == block_id].drop_duplicates() if 'block_id' in outliers.columns else outliers
+        for outliers in label_run_outliers(all_activities, athlete_id)
+    )
+
+def run_outlier_counts(all_activities: pd.DataFrame, athlete_id: str) -> pd.DataFrame:
+    """Number of distinct distance, intense and varying outlier runs per block_id."""
+    counts = {}
+    for outlier_type, outliers in zip(OUTLIER_TYPES, label_run_outliers(all_activities, athlete_id)):
+        if 'block_id' in outliers.columns:
+            counts[outlier_type] = outliers.drop_duplicates().groupby('block_id', observed=True).size()
+        else:
+            counts[outlier_type] = pd.Series(dtype='int64')
+    return pd.DataFrame(counts).fillna(0).astype('int64')
+
+def activity_feature_record(
     activity: dict, 
     zones: List[int], 
     activity_type: str, 
@@ -157,8 +204,11 @@ def extract_activity_features(
     block_id: int, 
     week_id: int, 
     hr_regressor
-) -> pd.DataFrame:
-    """Extract features from an activity and add them to the activities DataFrame."""
+) -> Optional[Dict]:
+    """Extract the features of one activity as a dict, without the values that are missing.
+    
+    Returns None if the activity could not be processed.
+    """
     
     base_features = {
         'athlete_id': athlete_id,
@@ -172,159 +222,158 @@ def extract_activity_features(
             basic_data = get_non_run_activity_data(activity, zones)
             features = {
                 **base_features,
-                'activity_type': basic_data[1],
-                'activity_id': basic_data[0],
-                'elapsed_time': basic_data[2],
-                'distance': basic_data[3],
-                'mean_hr': basic_data[4]
+                'activity_type': basic_data.activity_type,
+                'activity_id': basic_data.id,
+                'elapsed_time': basic_data.elapsed_time,
+                'distance': basic_data.distance,
+                'mean_hr': basic_data.mean_hr
             }
         else:
             # Handle run activities
             run_data = get_run_activity_data(activity, zones, hr_regressor)
             features = {
                 **base_features,
-                'activity_type': run_data[1],
-                'activity_id': run_data[0],
-                'elapsed_time': run_data[2],
-                'distance': run_data[3],
-                'mean_hr': run_data[4],
-                'stdev_hr': run_data[5],
-                'freq_hr': run_data[6],
-                'time_in_z1': run_data[-1][0],
-                'time_in_z2': run_data[-1][1],
-                'time_in_z3': run_data[-1][2],
-                'time_in_z4': run_data[-1][3],
-                'time_in_z5': run_data[-1][4],
-                'elevation': run_data[7],
-                'stdev_elevation': run_data[8],
-                'freq_elevation': run_data[9],
-                'pace': run_data[10],
-                'stdev_pace': run_data[11],
-                'freq_pace': run_data[12],
-                'cadence': run_data[13],
-                'athlete_count': run_data[14]
+                'activity_type': run_data.activity_type,
+                'activity_id': run_data.id,
+                'elapsed_time': run_data.elapsed_time,
+                'distance': run_data.distance,
+                'mean_hr': run_data.mean_hr,
+                'stdev_hr': run_data.stdev_hr,
+                'freq_hr': run_data.freq_hr,
+                **{f'time_in_z{zone}': share for zone, share in enumerate(run_data.time_in_zones, start=1)},
+                'elevation': run_data.elevation,
+                'stdev_elevation': run_data.stdev_elevation,
+                'freq_elevation': run_data.freq_elevation,
+                'pace': run_data.pace,
+                'stdev_pace': run_data.stdev_pace,
+                'freq_pace': run_data.freq_pace,
+                'cadence': run_data.cadence,
+                'athlete_count': run_data.athlete_count
             }
         
-        new_features_df = pd.DataFrame([features]).dropna(axis=1, how='all')
-        return pd.concat([activities, new_features_df], ignore_index=True)
+        return {key: value for key, value in features.items() if not pd.isna(value)}
         
     except Exception as e:
         logger.error(f"Error extracting features from activity: {e}")
-        return activities
-
-def calculate_week_stats(df: pd.DataFrame, columns: List[str]) -> Dict[str, float]:
-    """Calculate basic statistics for a set of columns in a DataFrame."""
-    stats = {}
-    for col in columns:
-        series = df[col]
-        if not series.empty:
-            stats.update({
-                f"total_{col}": series.sum(),
-                f"avg_{col}": series.mean(),
-                f"stdev_{col}": series.std()
-            })
-    return stats
+        return None
 
-def extract_week_features(
-    week_runs: pd.DataFrame, 
-    week_non_runs: pd.DataFrame, 
-    athlete_id: str, 
-    block_id: int, 
-    week_id: int, 
-    total_runs: int
-) -> Dict:
-    """Extract features from a week of training data."""
+def weekly_aggregates(activities: pd.DataFrame, aggregations: Dict[str, Tuple[str, str]]) -> Callable[[str], Dict]:
+    """Named aggregations of activities per week_id, as a function from week_id to the week's values.
     
-    features = {
-        'athlete_id': athlete_id,
-        'block_id': block_id,
-        'week_id': week_id,
-        'f_total_runs': total_runs
-    }
+    Each aggregation ('sum', 'mean', 'std' or 'size') runs once over all of
+    its columns. A week without activities gets the values over no rows, and
+    aggregations over a column activities does not have are left out.
+    """
+    present = {name: (col, how) for name, (col, how) in aggregations.items() if col in activities.columns}
+    grouped = activities.groupby('week_id', sort=False)
     
-    # Calculate run statistics
-    run_stats = calculate_week_stats(week_runs, ['distance', 'elapsed_time'])
-    features.update({f"f_run_{k}": v for k, v in run_stats.items()})
+    columns_by_how = {}
+    for col, how in present.values():
+        columns_by_how.setdefault(how, {})[col] = None
+    results = {how: grouped.size() if how == 'size' else getattr(grouped[list(columns)], how)()
+               for how, columns in columns_by_how.items()}
     
-    # Calculate non-run statistics
-    non_run_stats = calculate_week_stats(week_non_runs, ['distance', 'elapsed_time'])
-    features.update({f"f_non_run_{k}": v for k, v in non_run_stats.items()})
+    rows = {week_id: row for row, week_id in enumerate(grouped.size().index)}
+    values = {name: (results[how] if how == 'size' else results[how][col]).to_numpy()
+              for name, (col, how) in present.items()}
+    # Sums over no rows are 0 of the column's dtype, means and stdevs NaN
+    empty = {name: 0 if how == 'size' else activities[col].dtype.type(0) if how == 'sum' else np.nan
+             for name, (col, how) in present.items()}
     
-    # Calculate heart rate zones for runs and non-runs
-    for activity_type in ['runs', 'non_runs']:
-        df = week_runs if activity_type == 'runs' else week_non_runs
-        for zone in range(1, 6):
-            zone_col = f"time_in_z{zone}"
-            # Only calculate mean if the column exists, otherwise use 0
-            if zone_col in df.columns:
-                features[f"f_time_in_z{zone}_{activity_type}"] = df[zone_col].mean()
-            else:
-                features[f"f_time_in_z{zone}_{activity_type}"] = 0.0
+    def week_values(week_id: str) -> Dict:
+        row = rows.get(week_id)
+        if row is None:
+            return empty
+        return {name: column[row] for name, column in values.items()}
     
-    # Count non-run activity types
-    activity_counts = week_non_runs['activity_type'].value_counts()
-    for activity_type, count in activity_counts.items():
-        features[f"f_activity_type_{int(activity_type)}"] = count
+    return week_values
+
+def weekly_type_counts(non_runs: pd.DataFrame) -> Dict[str, List[Tuple[int, int]]]:
+    """(activity type, count) of each week's non-runs, most frequent first and ties in order of appearance."""
+    positions = pd.DataFrame({
+        'week_id': non_runs['week_id'].to_numpy(),
+        'activity_type': non_runs['activity_type'].to_numpy(),
+        'position': np.arange(len(non_runs))
+    })
+    counts = positions.groupby(['week_id', 'activity_type'], sort=False)['position'].agg(['size', 'min']).reset_index()
+    counts = counts.sort_values(['size', 'min'], ascending=[False, True], kind='stable')
     
-    # Calculate running-specific metrics safely
-    run_metrics = {
-        'run_mean_hr': ('mean_hr', 'mean'),
-        'run_stdev_hr': ('stdev_hr', 'mean'),
-        'run_freq_hr': ('freq_hr', 'mean'),
-        'elevation': ('elevation', ['sum', 'mean']),
-        'stdev_elevation': ('stdev_elevation', 'mean'),
-        'freq_elevation': ('freq_elevation', 'mean'),
-        'pace': ('pace', 'mean'),
-        'stdev_pace': ('stdev_pace', 'mean'),
-        'freq_pace': ('freq_pace', 'mean'),
-        'cadence': ('cadence', 'mean'),
-        'athlete_count': ('athlete_count', 'mean')
-    }
+    type_counts = {}
+    for week_id, activity_type, count in zip(counts['week_id'], counts['activity_type'], counts['size']):
+        type_counts.setdefault(week_id, []).append((int(activity_type), count))
+    return type_counts
+
+def extract_weeks_features(
+    activities: pd.DataFrame,
+    week_ids: List[str],
+    week_columns: List[List[str]],
+    athlete_id: str,
+    block_id: str
+) -> List[Dict]:
+    """Extract features from every week of a block, in one grouped aggregation over its activities.
     
-    # Add non-run metrics
-    non_run_metrics = {
-        'non_run_mean_hr': ('mean_hr', 'mean'),
-        'non_run_stdev_hr': ('stdev_hr', 'mean'),
-        'non_run_freq_hr': ('freq_hr', 'mean')
-    }
+    week_columns holds, per week, the activity columns that some activity up
+    to and including that week produced, as the columns of a frame grown one
+    activity at a time: a feature over a column not among them is 0.0. The
+    distance and time stats are only set for weeks with runs (or non-runs).
+    """
+    is_run = activities['activity_type'] == RUN_ACTIVITY_TYPE
+    groups = {'runs': activities[is_run], 'non_runs': activities[~is_run]}
     
-    # Process run metrics
-    for metric, (col, aggs) in run_metrics.items():
-        if col in week_runs.columns:
-            try:
-                if isinstance(aggs, list):
-                    for agg in aggs:
-                        features[f"f_{agg}_{metric}"] = week_runs[col].agg(agg)
-                else:
-                    features[f"f_{metric}"] = week_runs[col].agg(aggs)
-            except Exception as e:
-                logger.warning(f"Could not calculate {metric}: {e}")
-                # Set default values if calculation fails
-                if isinstance(aggs, list):
-                    for agg in aggs:
-                        features[f"f_{agg}_{metric}"] = 0.0
-                else:
-                    features[f"f_{metric}"] = 0.0
-        else:
-            # Set default values for missing columns
-            if isinstance(aggs, list):
-                for agg in aggs:
-                    features[f"f_{agg}_{metric}"] = 0.0
-            else:
-                features[f"f_{metric}"] = 0.0
+    week_aggregates = {}
+    for suffix, group in groups.items():
+        prefix = WEEK_STAT_PREFIXES[suffix]
+        aggregations = {'count': ('activity_type', 'size')}
+        for col in WEEK_STAT_COLUMNS:
+            aggregations.update({f'{prefix}_total_{col}': (col, 'sum'),
+                                 f'{prefix}_avg_{col}': (col, 'mean'),
+                                 f'{prefix}_stdev_{col}': (col, 'std')})
+        for zone in range(1, 6):
+            aggregations[f'f_time_in_z{zone}_{suffix}'] = (f'time_in_z{zone}', 'mean')
+        aggregations.update(WEEK_METRICS[suffix])
+        week_aggregates[suffix] = weekly_aggregates(group, aggregations)
+    type_counts = weekly_type_counts(groups['non_runs'])
     
-    # Process non-run metrics
-    for metric, (col, aggs) in non_run_metrics.items():
-        if col in week_non_runs.columns:
-            try:
-                features[f"f_{metric}"] = week_non_runs[col].agg(aggs)
-            except Exception as e:
-                logger.warning(f"Could not calculate non-run {metric}: {e}")
-                features[f"f_{metric}"] = 0.0
-        else:
-            features[f"f_{metric}"] = 0.0
+    weeks = []
+    for week_id, columns in zip(week_ids, week_columns):
+        visible = set(columns)
+        missing = [col for col in WEEK_STAT_COLUMNS if col not in visible]
+        if missing:
+            raise KeyError(missing[0])
+        week_values = {suffix: week_aggregates[suffix](week_id) for suffix in groups}
+        
+        features = {
+            'athlete_id': athlete_id,
+            'block_id': block_id,
+            'week_id': week_id,
+            'f_total_runs': week_values['runs'].get('count', 0)
+        }
+        
+        # Distance and time stats of the runs, then the non-runs, for groups the week has
+        for suffix in groups:
+            if week_values[suffix].get('count'):
+                prefix = WEEK_STAT_PREFIXES[suffix]
+                features.update({f'{prefix}_{stat}_{col}': week_values[suffix][f'{prefix}_{stat}_{col}']
+                                 for col in WEEK_STAT_COLUMNS for stat in ['total', 'avg', 'stdev']})
+        
+        # Heart rate zones for runs and non-runs
+        for suffix in groups:
+            for zone in range(1, 6):
+                name = f'f_time_in_z{zone}_{suffix}'
+                features[name] = week_values[suffix][name] if f'time_in_z{zone}' in visible else 0.0
+        
+        # Count non-run activity types
+        for activity_type, count in type_counts.get(week_id, []):
+            features[f'f_activity_type_{activity_type}'] = count
+        
+        # Running-specific metrics, then the non-run ones
+        for suffix in groups:
+            for name, (col, _) in WEEK_METRICS[suffix].items():
+                features[name] = week_values[suffix][name] if col in visible else 0.0
+        
+        weeks.append(features)
     
-    return features
+    return weeks
 
 def build_pace_to_hr_regressor(activities: List[dict], athlete_id: str, zones: List[int]) -> Tuple[Optional[LinearRegression], Optional[pd.DataFrame]]:
     """Build a regression model to predict heart rate from pace."""
@@ -1,7 +1,7 @@
-from datetime import datetime, timedelta
-import math
+from bisect import bisect_left, bisect_right
+from datetime import datetime
 from itertools import dropwhile
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
@@ -25,6 +25,41 @@ def is_valid_activity(activity: Dict) -> bool:
     except (KeyError, TypeError):
         return False
 
+def activity_day(activity: Dict) -> Optional[int]:
+    """Ordinal of the activity's start date (datetime.toordinal), None if it cannot be read."""
+    try:
+        return datetime.strptime(activity['start_date'][:10], '%Y-%m-%d').toordinal()
+    except Exception as e:
+        logger.debug(f"Error processing activity date: {e}")
+        return None
+
+class ActivityIndex:
+    """Activities with their start dates parsed once and sorted by day.
+    
+    Built once per athlete; a block is then found with two bisects over the
+    sorted days instead of parsing every activity's date again.
+    """
+    
+    def __init__(self, activities: List[Dict]):
+        self.activities = activities
+        self.days = [activity_day(activity) for activity in activities]
+        order = sorted((day, position) for position, day in enumerate(self.days)
+                       if day is not None and is_valid_activity(activities[position]))
+        self.sorted_days = [day for day, _ in order]
+        self.positions = [position for _, position in order]
+    
+    def block_positions(self, activity_date: datetime, duration_days: int = 91) -> List[int]:
+        """Positions of the activities in the duration_days up to activity_date, in list order."""
+        last_day = activity_date.toordinal()
+        first = bisect_left(self.sorted_days, last_day - duration_days + 1)
+        last = bisect_right(self.sorted_days, last_day)
+        return sorted(self.positions[first:last])
+    
+    def block(self, activity_date: datetime, duration_days: int = 91) -> Tuple[List[Dict], List[int]]:
+        """get_block's activities, with their days for get_weeks."""
+        positions = self.block_positions(activity_date, duration_days)
+        return [self.activities[p] for p in positions], [self.days[p] for p in positions]
+
 def get_block(
     activities: List[Dict], 
     activity_date: datetime, 
@@ -41,31 +76,12 @@ def get_block(
     Returns:
         List of activities within the specified time period
     """
-    block_activities = []
-    
-    for activity in activities:
-        if not is_valid_activity(activity):
-            continue
-            
-        try:
-            current_date = datetime.strptime(
-                activity['start_date'][:10], 
-                '%Y-%m-%d'
-            )
-            time_diff = (activity_date - current_date).days
-            
-            if 0 <= time_diff < duration_days:
-                block_activities.append(activity)
-                
-        except Exception as e:
-            logger.debug(f"Error processing activity date: {e}")
-            continue
-
-    return block_activities
+    return ActivityIndex(activities).block(activity_date, duration_days)[0]
 
 def get_weeks(
     block_activities: List[Dict], 
-    duration_days: int = 91
+    duration_days: int = 91,
+    days: Optional[List[Optional[int]]] = None
 ) -> List[List[Dict]]:
     """
     Split activities into weeks.
@@ -73,6 +89,7 @@ def get_weeks(
     Args:
         block_activities: List of activities in chronological order
         duration_days: Optional duration to consider (0 means use full range)
+        days: activity_day of each activity, if already parsed (see ActivityIndex)
     
     Returns:
         List of lists, where each inner list contains activities for one week
@@ -80,33 +97,36 @@ def get_weeks(
     try:
         if not block_activities:
             return []
+        if days is None:
+            days = [activity_day(activity) for activity in block_activities]
             
         # Get date range
-        end_date = datetime.strptime(block_activities[-1]['start_date'][:10], '%Y-%m-%d')
+        end_day = days[-1]
+        if end_day is None:
+            raise ValueError(f"Invalid start date in activity {block_activities[-1].get('id')}")
         
         if duration_days > 0:
             # Use specified duration
-            start_date = end_date - timedelta(days=duration_days-1)
+            start_day = end_day - (duration_days - 1)
         else:
             # Use full range of activities
-            start_date = datetime.strptime(block_activities[0]['start_date'][:10], '%Y-%m-%d')
-            duration_days = (end_date - start_date).days
+            start_day = days[0]
+            if start_day is None:
+                raise ValueError(f"Invalid start date in activity {block_activities[0].get('id')}")
+            duration_days = end_day - start_day
         
         # Initialize weeks
         num_weeks = int(duration_days/7)
         weeks = [[] for _ in range(num_weeks)]
         
         # Distribute activities into weeks
-        for activity in block_activities[:-1]:  # Exclude last activity (PB)
-            try:
-                activity_date = datetime.strptime(activity['start_date'][:10], '%Y-%m-%d')
-                current_week = math.floor((activity_date - start_date).days / 7)
-                
-                if 0 <= current_week < num_weeks:
-                    weeks[current_week].append(activity)
-            except Exception as e:
-                logger.debug(f"Error assigning activity to week: {e}")
+        for activity, day in zip(block_activities[:-1], days[:-1]):  # Exclude last activity (PB)
+            if day is None:
                 continue
+            current_week = (day - start_day) // 7
+            
+            if 0 <= current_week < num_weeks:
+                weeks[current_week].append(activity)
         
         # Remove empty weeks from the start
         return list(dropwhile(lambda x: not x, weeks))
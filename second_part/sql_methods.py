@@ -1,18 +1,192 @@
 from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 import pandas as pd
-from sqlalchemy import text, create_engine, inspect
+from sqlalchemy import text, create_engine, event, inspect, select, BigInteger, Boolean, DateTime, Float, MetaData, SmallInteger, Text
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.engine import make_url
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Tuple
 import os
+import sqlite3
+import threading
+import time
 import logging
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 db = SQLAlchemy()
 
+# Rows per multi-row INSERT in upsert_rows; activity rows carry the full JSON payload
+UPSERT_BATCH_SIZE = 100
+
+# Rows per multi-row INSERT when saving analytics frames
+WRITE_CHUNK_SIZE = 1000
+
+# SQLite caps bound parameters per statement (999 before 3.32)
+SQLITE_MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32) else 999
+
+# Column holding the athlete id, where it is not athlete_id
+ATHLETE_KEY_COLUMNS = {'metadata_athletes': 'id'}
+
+# Used when neither DATABASE_URL nor DB_HOST is set
+DEFAULT_SQLITE_PATH = './data/strava.db'
+
+# Applied to every new SQLite connection: WAL lets readers run alongside the
+# writer, NORMAL sync only fsyncs at checkpoints, and the page cache and mmap
+# window are sized for whole-table analytics reads
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,  # KiB, i.e. 64 MB
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 30000,
+    'foreign_keys': 'ON'
+}
+
+# Byte budget for cached_read_db results, evicted least recently used first
+READ_CACHE_MAX_BYTES = int(os.environ.get('READ_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# Entries older than this are re-read, covering writes made by other processes
+READ_CACHE_TTL_SECONDS = 300
+
+# Full-table rewrites are written to <table>__shadow and swapped in by rename
+SHADOW_SUFFIX = '__shadow'
+
+_engines = {}
+
+# Shadow copies of the declared tables, kept off db.metadata so create_all ignores them
+_shadow_metadata = MetaData()
+
+# (table_name, query, params) -> (version, stored_at, nbytes, DataFrame)
+_read_cache = OrderedDict()
+_read_cache_bytes = 0
+_table_versions = defaultdict(int)
+_read_cache_lock = threading.Lock()
+
 def init_db(app):
     db.init_app(app)
+    with app.app_context():
+        configure_sqlite_engine(db.engine)
+
+def get_database_url():
+    """Return the database URL: DATABASE_URL, else MySQL from DB_* variables, else a local SQLite file."""
+    url = os.environ.get('DATABASE_URL') or os.environ.get('SQLALCHEMY_DATABASE_URI')
+    if not url and os.environ.get('DB_HOST'):
+        url = f'mysql+pymysql://{os.environ.get("DB_USER")}:{os.environ.get("DB_PASS")}@{os.environ.get("DB_HOST")}/{os.environ.get("DB_NAME")}'
+    if not url:
+        url = f'sqlite:///{DEFAULT_SQLITE_PATH}'
+    
+    # Resolve SQLite files against the working directory, as Flask-SQLAlchemy
+    # would otherwise put relative paths under the app instance folder
+    parsed = make_url(url)
+    if parsed.get_backend_name() == 'sqlite' and parsed.database and parsed.database != ':memory:':
+        path = os.path.abspath(parsed.database)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        url = parsed.set(database=path).render_as_string(hide_password=False)
+    return url
+
+def get_engine_options(url):
+    """Return create_engine keyword arguments for the backend of url."""
+    if make_url(url).get_backend_name() == 'sqlite':
+        return {'connect_args': {'check_same_thread': False, 'timeout': 30}}
+    return {'pool_pre_ping': True, 'pool_recycle': 3600}
 
 def get_db_connection():
-    return create_engine(f'mysql+pymysql://{os.environ.get("DB_USER")}:{os.environ.get("DB_PASS")}@{os.environ.get("DB_HOST")}/{os.environ.get("DB_NAME")}')
+    """Return the shared engine for the configured database URL."""
+    url = get_database_url()
+    if url not in _engines:
+        _engines[url] = create_engine(url, **get_engine_options(url))
+        configure_sqlite_engine(_engines[url])
+    return _engines[url]
+
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Apply SQLITE_PRAGMAS and hand transaction control to SQLAlchemy."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    # pysqlite only opens transactions before DML, so DDL and batched writes
+    # would otherwise run in autocommit; BEGIN is emitted in begin_sqlite_transaction
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {pragma}={value}')
+    cursor.close()
+
+def begin_sqlite_transaction(conn):
+    """Start a real SQLite transaction whenever SQLAlchemy begins one.
+
+    Pass execution_options(sqlite_begin='IMMEDIATE') to take the write lock up front,
+    for read-then-write transactions that would otherwise fail to upgrade under contention.
+    """
+    if conn.dialect.name == 'sqlite':
+        conn.exec_driver_sql(f"BEGIN {conn.get_execution_options().get('sqlite_begin', '')}".strip())
+
+def configure_sqlite_engine(engine):
+    """Attach the SQLite connection and transaction hooks to engine, once.
+
+    They are attached per engine rather than to every Engine in the process,
+    so other engines (tests, tools, a second import of this module) are left
+    alone and no transaction gets a second BEGIN.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    for identifier, hook in (('connect', configure_sqlite_connection), ('begin', begin_sqlite_transaction)):
+        if not event.contains(engine, identifier, hook):
+            event.listen(engine, identifier, hook)
+
+def get_managed_table(table_name):
+    """Return the declared SQLAlchemy table for table_name, or None if it is unmanaged.
+    
+    Shadow names resolve to a copy of the live declaration whose indexes carry
+    the shadow suffix, as index names are global on SQLite and PostgreSQL.
+    """
+    import models  # noqa: F401 - registers the declared tables on db.metadata
+    if not table_name.endswith(SHADOW_SUFFIX):
+        return db.metadata.tables.get(table_name)
+    
+    if table_name not in _shadow_metadata.tables:
+        live = db.metadata.tables.get(live_table_name(table_name))
+        if live is None:
+            return None
+        shadow = live.to_metadata(_shadow_metadata, name=table_name)
+        for index in shadow.indexes:
+            index.name = f'{index.name}{SHADOW_SUFFIX}'
+    return _shadow_metadata.tables[table_name]
+
+def shadow_table_name(table_name):
+    """Name of the table a full rewrite of table_name is built in."""
+    return f'{table_name}{SHADOW_SUFFIX}'
+
+def live_table_name(table_name):
+    """table_name without the shadow suffix."""
+    return table_name[:-len(SHADOW_SUFFIX)] if table_name.endswith(SHADOW_SUFFIX) else table_name
+
+def sql_type_for_dtype(dtype):
+    """Map a pandas dtype to the column type used for on-demand columns."""
+    if isinstance(dtype, pd.CategoricalDtype):
+        return sql_type_for_dtype(dtype.categories.dtype)
+    if pd.api.types.is_bool_dtype(dtype):
+        return Boolean()
+    if pd.api.types.is_integer_dtype(dtype):
+        # frame_dtypes keeps counts in 16 bits
+        return SmallInteger() if dtype.itemsize <= 2 else BigInteger()
+    if pd.api.types.is_float_dtype(dtype):
+        return Float()
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return DateTime()
+    return Text()
+
+def ensure_columns(conn, table_name, df):
+    """Add any DataFrame columns missing from an existing table."""
+    existing = {col['name'] for col in inspect(conn).get_columns(table_name)}
+    missing = [col for col in df.columns if col not in existing]
+    quote = conn.dialect.identifier_preparer.quote
+    for col in missing:
+        col_type = sql_type_for_dtype(df[col].dtype).compile(dialect=conn.dialect)
+        conn.execute(text(f'ALTER TABLE {quote(table_name)} ADD COLUMN {quote(col)} {col_type}'))
+    if missing:
+        logger.info(f"Added columns {missing} to {table_name}")
+    return missing
 
 def read_db(table_name):
     try:
@@ -33,6 +207,62 @@ def read_db(table_name):
         # Return empty DataFrame instead of raising error
         return pd.DataFrame()
 
+def bump_table_version(*table_names):
+    """Invalidate cached reads of table_names; call after every write to them."""
+    global _read_cache_bytes
+    with _read_cache_lock:
+        for table_name in table_names:
+            _table_versions[table_name] += 1
+        for key in [key for key in _read_cache if key[0] in table_names]:
+            _read_cache_bytes -= _read_cache.pop(key)[2]
+
+def table_version(table_name):
+    """Current version of table_name, bumped on every write made by this process."""
+    with _read_cache_lock:
+        return _table_versions[table_name]
+
+def clear_read_cache():
+    """Drop every cached read and invalidate reads still in flight."""
+    global _read_cache_bytes
+    with _read_cache_lock:
+        for table_name in {key[0] for key in _read_cache} | set(_table_versions):
+            _table_versions[table_name] += 1
+        _read_cache.clear()
+        _read_cache_bytes = 0
+
+def cached_read_db(table_name, query: Optional[str] = None, params: Optional[Dict] = None):
+    """Read-through cache over read_db, or over query when given, keyed by table and query.
+    
+    The table version is taken before reading, so a write that lands while the
+    read is running leaves the result stale and it is never served. Callers get
+    a copy and may modify it freely.
+    """
+    global _read_cache_bytes
+    key = (table_name, query, tuple(sorted((params or {}).items())))
+    with _read_cache_lock:
+        version = _table_versions[table_name]
+        entry = _read_cache.get(key)
+        if entry is not None and entry[0] == version and time.monotonic() - entry[1] < READ_CACHE_TTL_SECONDS:
+            _read_cache.move_to_end(key)
+            logger.debug(f"Read cache hit for {table_name}")
+            return entry[3].copy()
+    
+    if query is None:
+        df = read_db(table_name)
+    else:
+        df = pd.read_sql(text(query), get_db_connection(), params=params)
+    
+    nbytes = int(df.memory_usage(deep=True).sum())
+    with _read_cache_lock:
+        if version == _table_versions[table_name] and nbytes <= READ_CACHE_MAX_BYTES:
+            if key in _read_cache:
+                _read_cache_bytes -= _read_cache.pop(key)[2]
+            _read_cache[key] = (version, time.monotonic(), nbytes, df)
+            _read_cache_bytes += nbytes
+            while _read_cache_bytes > READ_CACHE_MAX_BYTES:
+                _read_cache_bytes -= _read_cache.popitem(last=False)[1][2]
+    return df.copy()
+
 def write_db_replace(df, table_name):
     """Write DataFrame to database, creating table if needed."""
     try:
@@ -140,38 +370,303 @@ def write_db_replace(df, table_name):
             for col, dtype in default_schemas[table_name].items():
                 df[col] = pd.Series(dtype=dtype)
         
-        # Convert DataFrame to SQL
-        df.to_sql(
-            name=table_name,
-            con=engine,
-            if_exists='replace',
-            index=False
-        )
-        
-        # Verify write
-        with engine.connect() as conn:
-            count = conn.execute(text(f"SELECT COUNT(*) FROM {table_name}")).scalar()
-            logger.info(f"Written {count} rows to {table_name}")
+        # Built in a shadow table and swapped in, so readers never see it half written
+        if get_managed_table(table_name) is not None:
+            publish_tables({table_name: df})
+        else:
+            df.to_sql(
+                name=shadow_table_name(table_name),
+                con=engine,
+                if_exists='replace',
+                index=False
+            )
+            swap_shadow_tables([table_name])
         
+        logger.info(f"Written {len(df)} rows to {table_name}")
         return True
     except Exception as e:
         logger.error(f"Error writing to database: {e}", exc_info=True)
         raise
 
+def get_chunk_size(conn, df, chunksize=WRITE_CHUNK_SIZE):
+    """Limit rows per multi-row INSERT so SQLite stays under its bound parameter cap."""
+    if conn.dialect.name == 'sqlite':
+        return max(1, min(chunksize, SQLITE_MAX_VARIABLES // max(1, len(df.columns))))
+    return chunksize
+
+def clear_rows(conn, table_name, athlete_id=None):
+    """Delete the rows of a declared table, or one athlete's rows, inside an open transaction."""
+    table = get_managed_table(table_name)
+    delete = table.delete()
+    if athlete_id is not None:
+        key_column = table.c[ATHLETE_KEY_COLUMNS.get(live_table_name(table_name), 'athlete_id')]
+        delete = delete.where(key_column == str(athlete_id))
+    conn.execute(delete)
+
+def append_frame(conn, df, table_name, chunksize=WRITE_CHUNK_SIZE, method='multi'):
+    """Insert the rows of df into a table inside an open transaction.
+    
+    method='multi' sends multi-row INSERTs, compiled once per call; None
+    sends one single-row INSERT through executemany, which the drivers batch.
+    """
+    if not df.empty:
+        df.to_sql(
+            name=table_name,
+            con=conn,
+            if_exists='append',
+            index=False,
+            method=method,
+            chunksize=get_chunk_size(conn, df, chunksize) if method == 'multi' else chunksize
+        )
+
+def write_frame(conn, df, table_name, athlete_id=None, chunksize=WRITE_CHUNK_SIZE):
+    """Replace the rows of a declared table, or one athlete's rows, inside an open transaction."""
+    clear_rows(conn, table_name, athlete_id)
+    append_frame(conn, df, table_name, chunksize)
+
+def write_tables_atomic(dataframes, athlete_id=None, chunksize=WRITE_CHUNK_SIZE, derive=None):
+    """Write several DataFrames to declared tables in a single transaction.
+    
+    With athlete_id set only that athlete's rows are replaced, so the rest of
+    the cohort is untouched. Readers see either the previous rows or the new
+    ones, never a half-written athlete.
+    
+    derive, if given, is called with the open connection once the frames are
+    written and returns more {table_name: DataFrame} computed from them in SQL;
+    those are written in the same transaction.
+    """
+    engine = get_db_connection()
+    written = list(dataframes)
+    
+    # Schema changes go first and on their own: MySQL commits DDL implicitly
+    with engine.begin() as conn:
+        for table_name, df in dataframes.items():
+            table = get_managed_table(table_name)
+            if table is None:
+                raise ValueError(f"{table_name} is not a declared table")
+            table.create(conn, checkfirst=True)
+            ensure_columns(conn, table_name, df)
+    
+    try:
+        with engine.begin() as conn:
+            for table_name, df in dataframes.items():
+                write_frame(conn, df, table_name, athlete_id, chunksize)
+            if derive is not None:
+                for table_name, df in derive(conn).items():
+                    written.append(table_name)
+                    get_managed_table(table_name).create(conn, checkfirst=True)
+                    # Derived columns are only known here; on MySQL a new one commits early
+                    ensure_columns(conn, table_name, df)
+                    write_frame(conn, df, table_name, athlete_id, chunksize)
+    finally:
+        bump_table_version(*written)
+    
+    logger.info(f"Saved {sum(len(df) for df in dataframes.values())} rows across "
+                f"{len(written)} tables in one transaction")
+    return True
+
+@contextmanager
+def stream_tables_atomic(table_names, athlete_id=None, chunksize=WRITE_CHUNK_SIZE):
+    """Write declared tables a chunk at a time, in a single transaction.
+    
+    Yields write(table_name, df), which appends df to one of table_names.
+    Frames are buffered per table and inserted once about chunksize rows
+    have built up, so memory holds at most that many rows of each table.
+    Each insert compiles its statement again, so rather than a multi-row
+    INSERT per chunk it is a single-row one sent with executemany. The
+    tables' rows (only athlete_id's, if set) are deleted first, and all the
+    chunks become visible together when the block exits without an error;
+    otherwise none of them do. Columns a chunk brings are added as it is
+    inserted, which on MySQL commits early, as for derive in
+    write_tables_atomic.
+    """
+    engine = get_db_connection()
+    
+    with engine.begin() as conn:
+        for table_name in table_names:
+            table = get_managed_table(table_name)
+            if table is None:
+                raise ValueError(f"{table_name} is not a declared table")
+            table.create(conn, checkfirst=True)
+    
+    buffered = defaultdict(list)   # table_name -> frames not inserted yet
+    written = defaultdict(int)
+    try:
+        with engine.begin() as conn:
+            for table_name in table_names:
+                clear_rows(conn, table_name, athlete_id)
+            
+            def insert(table_name):
+                df = pd.concat(buffered.pop(table_name), ignore_index=True)
+                ensure_columns(conn, table_name, df)
+                append_frame(conn, df, table_name, chunksize, method=None)
+                written[table_name] += len(df)
+            
+            def write(table_name, df):
+                if table_name not in table_names:
+                    raise ValueError(f"{table_name} was not opened for writing")
+                if df.empty:
+                    return
+                buffered[table_name].append(df)
+                if sum(len(frame) for frame in buffered[table_name]) >= chunksize:
+                    insert(table_name)
+            
+            yield write
+            
+            for table_name in list(buffered):
+                insert(table_name)
+    finally:
+        bump_table_version(*table_names)
+    
+    logger.info(f"Saved {sum(written.values())} rows across {len(table_names)} tables in one transaction")
+
+def create_shadow_tables(table_names):
+    """Create empty shadow tables for the declared table_names, replacing leftovers."""
+    engine = get_db_connection()
+    with engine.begin() as conn:
+        for table_name in table_names:
+            shadow = get_managed_table(shadow_table_name(table_name))
+            if shadow is None:
+                raise ValueError(f"{table_name} is not a declared table")
+            shadow.drop(conn, checkfirst=True)
+            shadow.create(conn)
+            if conn.dialect.name == 'sqlite':
+                # Built at swap time instead, SQLite cannot rename indexes
+                for index in shadow.indexes:
+                    index.drop(conn)
+    logger.info(f"Created shadow tables for {list(table_names)}")
+
+def swap_index_names(conn, table_name):
+    """Give the indexes of a just swapped-in table their declared names."""
+    live = get_managed_table(table_name)
+    if live is None:
+        return
+    quote = conn.dialect.identifier_preparer.quote
+    for index in live.indexes:
+        shadow_index = f'{index.name}{SHADOW_SUFFIX}'
+        if conn.dialect.name == 'sqlite':
+            index.create(conn)
+        elif conn.dialect.name == 'mysql':
+            conn.execute(text(f'ALTER TABLE {quote(table_name)} RENAME INDEX {quote(shadow_index)} TO {quote(index.name)}'))
+        else:
+            conn.execute(text(f'ALTER INDEX {quote(shadow_index)} RENAME TO {quote(index.name)}'))
+
+def swap_shadow_tables(table_names):
+    """Replace each table with its shadow in one transaction.
+    
+    Readers keep the table they started with until the swap commits and see
+    the complete new one after it. MySQL commits DDL implicitly, so there the
+    swap of all the tables is one atomic RENAME TABLE statement instead.
+    """
+    engine = get_db_connection()
+    try:
+        with engine.begin() as conn:
+            quote = conn.dialect.identifier_preparer.quote
+            existing = set(inspect(conn).get_table_names())
+            replaced = [table_name for table_name in table_names if table_name in existing]
+            if conn.dialect.name == 'mysql':
+                # Renamed left to right: the live tables move aside before the shadows take their names
+                renames = ([(table_name, f'{table_name}__retired') for table_name in replaced]
+                           + [(shadow_table_name(table_name), table_name) for table_name in table_names])
+                conn.execute(text('RENAME TABLE ' + ', '.join(f'{quote(a)} TO {quote(b)}' for a, b in renames)))
+                for table_name in replaced:
+                    conn.execute(text(f'DROP TABLE {quote(table_name + "__retired")}'))
+            else:
+                for table_name in table_names:
+                    if table_name in replaced:
+                        conn.execute(text(f'DROP TABLE {quote(table_name)}'))
+                    conn.execute(text(f'ALTER TABLE {quote(shadow_table_name(table_name))} RENAME TO {quote(table_name)}'))
+            for table_name in table_names:
+                swap_index_names(conn, table_name)
+    finally:
+        bump_table_version(*table_names)
+    logger.info(f"Swapped in shadow tables for {list(table_names)}")
+
+def drop_shadow_tables(table_names):
+    """Drop the shadow tables of an abandoned rebuild."""
+    engine = get_db_connection()
+    with engine.begin() as conn:
+        for table_name in table_names:
+            get_managed_table(shadow_table_name(table_name)).drop(conn, checkfirst=True)
+
+def publish_tables(dataframes, chunksize=WRITE_CHUNK_SIZE):
+    """Replace whole declared tables: write each frame to a shadow table, then swap them all in.
+    
+    The tables are held exclusively meanwhile (see table_leases), so no other
+    writer drops the shadows or writes rows the swap would discard.
+    """
+    from table_leases import HeldTables, LEASE_WAIT_SECONDS  # imports this module
+    with HeldTables(dataframes, exclusive=True, wait_seconds=LEASE_WAIT_SECONDS):
+        create_shadow_tables(list(dataframes))
+        try:
+            write_tables_atomic({shadow_table_name(name): df for name, df in dataframes.items()}, chunksize=chunksize)
+        except Exception:
+            drop_shadow_tables(list(dataframes))
+            raise
+        swap_shadow_tables(list(dataframes))
+    return True
+
 def write_db_insert(df, table_name):
     try:
         engine = get_db_connection()
+        if get_managed_table(table_name) is not None and inspect(engine).has_table(table_name):
+            with engine.begin() as conn:
+                ensure_columns(conn, table_name, df)
         df.to_sql(name=table_name, con=engine, if_exists='append', index=False)
+        bump_table_version(table_name)
         return True
     except Exception as e:
         logger.error(f"Error inserting into database: {e}")
         raise
 
+def build_upsert(table, rows: List[Dict], dialect_name: str):
+    """Build one multi-row INSERT that updates rows whose primary key already exists."""
+    key_columns = [col.name for col in table.primary_key.columns]
+    value_columns = [col for col in rows[0] if col not in key_columns]
+    
+    if dialect_name == 'mysql':
+        stmt = mysql.insert(table).values(rows)
+        return stmt.on_duplicate_key_update({col: stmt.inserted[col] for col in value_columns})
+    if dialect_name in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect_name == 'sqlite' else postgresql.insert
+        stmt = insert(table).values(rows)
+        return stmt.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={col: stmt.excluded[col] for col in value_columns}
+        )
+    raise NotImplementedError(f"No upsert statement for dialect {dialect_name}")
+
+def upsert_rows(conn, table_name: str, rows: List[Dict], batch_size: int = UPSERT_BATCH_SIZE) -> Tuple[int, int]:
+    """Insert or update rows of a single-key table in batches, returning (inserted, updated).
+    
+    Each batch costs one SELECT of the keys already present and one multi-row
+    upsert, instead of a SELECT and an INSERT per row as with session.merge.
+    conn can be a Connection or a Session; the caller commits.
+    """
+    table = get_managed_table(table_name)
+    key = table.primary_key.columns.values()[0]
+    dialect_name = conn.get_bind().dialect.name if hasattr(conn, 'get_bind') else conn.dialect.name
+    inserted = updated = 0
+    
+    for start in range(0, len(rows), batch_size):
+        # Later rows win when a key appears twice in the same batch
+        batch = list({row[key.name]: row for row in rows[start:start + batch_size]}.values())
+        keys = [row[key.name] for row in batch]
+        existing = set(conn.execute(select(key).where(key.in_(keys))).scalars())
+        conn.execute(build_upsert(table, batch, dialect_name))
+        bump_table_version(table_name)
+        updated += len(existing)
+        inserted += len(batch) - len(existing)
+    
+    logger.info(f"Upserted {len(rows)} rows into {table_name}: {inserted} inserted, {updated} updated")
+    return inserted, updated
+
 def delete_rows(df_name):    
     try:
         with current_app.app_context():
             with db.engine.connect() as connection:
                 result = connection.execute(text(f'DELETE FROM {df_name};'))
+                bump_table_version(df_name)
                 return True
     except Exception as e:
         logger.error(f"Error deleting rows from {df_name}: {e}")
@@ -189,11 +684,14 @@ def test_conn_new():
 def reset_database():
     """Safely reset all tables"""
     try:
-        db.session.execute(text('SET FOREIGN_KEY_CHECKS = 0'))
-        db.session.commit()
+        is_mysql = db.engine.dialect.name == 'mysql'
+        if is_mysql:
+            db.session.execute(text('SET FOREIGN_KEY_CHECKS = 0'))
+            db.session.commit()
         
         # List of tables to truncate
         tables = [
+            'activity_payloads',
             'activities',
             'athlete_stats',
             'metadata_athletes',
@@ -204,6 +702,7 @@ def reset_database():
             'features_weeks',
             'features_blocks',
             'average_paces_and_hrs',
+            'athlete_weekly_cube',
             'processing_status',
             'daily_limit'
         ]
@@ -211,7 +710,9 @@ def reset_database():
         # Truncate all tables
         for table in tables:
             try:
-                db.session.execute(text(f'TRUNCATE TABLE {table}'))
+                # SQLite has no TRUNCATE; an unqualified DELETE is its equivalent
+                statement = f'TRUNCATE TABLE {table}' if is_mysql else f'DELETE FROM {table}'
+                db.session.execute(text(statement))
                 logger.info(f"Truncated table: {table}")
             except Exception as e:
                 logger.warning(f"Could not truncate {table}: {e}")
@@ -219,8 +720,10 @@ def reset_database():
         # Reinitialize daily_limit with 0
         db.session.execute(text("INSERT INTO daily_limit (daily) VALUES (0)"))
         
-        db.session.execute(text('SET FOREIGN_KEY_CHECKS = 1'))
+        if is_mysql:
+            db.session.execute(text('SET FOREIGN_KEY_CHECKS = 1'))
         db.session.commit()
+        clear_read_cache()
         logger.info("Database reset completed successfully")
         return True
     except Exception as e:
@@ -0,0 +1,134 @@
+"""
+Per-stage timings of the athlete transform.
+
+With PROFILE_TRANSFORM_STAGES=1, transform_athlete_data measures each of its
+stages and stores one row per stage in pipeline_stage_timings:
+    run_id        - shared by the stages of one transform
+    athlete_id    - the athlete transformed
+    stage         - load, hr_regressor, activity_block, pb_blocks,
+                    block_metrics, save, or total for the whole transform;
+                    a streamed transform has pbs and stream instead of
+                    activity_block and pb_blocks (see streaming_transform)
+    started_at    - when the stage started (UTC)
+    wall_seconds  - elapsed time
+    cpu_seconds   - CPU time of the process
+    rows_in       - activities or rows the stage was given
+    rows_out      - rows it produced
+    max_rss_mb    - peak resident memory of the process after the stage
+    alloc_peak_mb - peak memory allocated during the stage, above what was
+                    allocated when it started; only with TRACE_STAGE_MEMORY=1,
+                    as tracemalloc slows the transform down several times
+With WEEK_AGGREGATES_IN_SQL the block metrics run inside the save, so they
+are counted in both. Each athlete's rows are also logged as one JSON
+line. Without the flag nothing is measured or written.
+"""
+import json
+import logging
+import os
+import resource
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional
+from sql_methods import get_db_connection, get_managed_table
+
+logger = logging.getLogger(__name__)
+
+# Measure the stages of every transform and store them in pipeline_stage_timings
+PROFILE_TRANSFORM_STAGES = os.environ.get('PROFILE_TRANSFORM_STAGES', '').lower() in ('1', 'true')
+
+# Also trace Python allocations per stage
+TRACE_STAGE_MEMORY = os.environ.get('TRACE_STAGE_MEMORY', '').lower() in ('1', 'true')
+
+def max_rss_mb() -> float:
+    """Peak resident memory of this process so far."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+class StageTimings:
+    """The stage records of one athlete's transform."""
+
+    def __init__(self, athlete_id, enabled: bool = PROFILE_TRANSFORM_STAGES,
+                 trace_memory: bool = TRACE_STAGE_MEMORY):
+        self.athlete_id = str(athlete_id)
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.run_id = uuid.uuid4().hex
+        self.records: List[Dict] = []
+        self.open_peaks: List[int] = []  # traced peak so far of each open stage, outermost first
+        self.started_at = datetime.utcnow()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str, rows_in: Optional[int] = None) -> Iterator[Dict]:
+        """Measure the block as stage name; set 'rows_out' on the yielded record."""
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        if not self.enabled:
+            yield record
+            return
+
+        started_at = datetime.utcnow()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        if self.trace_memory:
+            start_traced = self.enter_traced_stage()
+        try:
+            yield record
+        finally:
+            record.update(
+                started_at=started_at,
+                wall_seconds=round(time.perf_counter() - start_wall, 4),
+                cpu_seconds=round(time.process_time() - start_cpu, 4),
+                max_rss_mb=max_rss_mb(),
+                alloc_peak_mb=(round((self.exit_traced_stage() - start_traced) / 2 ** 20, 1)
+                               if self.trace_memory else None)
+            )
+            self.records.append(record)
+
+    def enter_traced_stage(self) -> int:
+        """Start a stage's peak, keeping the peaks of the stages it is nested in; returns the traced size."""
+        current, peak = tracemalloc.get_traced_memory()
+        self.open_peaks = [max(open_peak, peak) for open_peak in self.open_peaks] + [current]
+        tracemalloc.reset_peak()
+        return current
+
+    def exit_traced_stage(self) -> int:
+        """The peak traced size of the innermost open stage, which is closed."""
+        peak = max(self.open_peaks.pop(), tracemalloc.get_traced_memory()[1])
+        self.open_peaks = [max(open_peak, peak) for open_peak in self.open_peaks]
+        return peak
+
+    def rows(self) -> List[Dict]:
+        """The stage records and a 'total' record for the whole transform, as table rows."""
+        total = {
+            'stage': 'total',
+            'rows_in': None,
+            'rows_out': None,
+            'started_at': self.started_at,
+            'wall_seconds': round(time.perf_counter() - self.start_wall, 4),
+            'cpu_seconds': round(time.process_time() - self.start_cpu, 4),
+            'max_rss_mb': max_rss_mb(),
+            'alloc_peak_mb': max((r['alloc_peak_mb'] for r in self.records
+                                  if r['alloc_peak_mb'] is not None), default=None)
+        }
+        return [{'run_id': self.run_id, 'athlete_id': self.athlete_id, **record}
+                for record in self.records + [total]]
+
+    def save(self) -> None:
+        """Log the records as one JSON line and store them; never raises."""
+        if not self.enabled:
+            return
+        if self.started_tracing:
+            tracemalloc.stop()
+        rows = self.rows()
+        logger.info(f"Stage timings: {json.dumps(rows, default=str)}")
+        try:
+            with get_db_connection().begin() as conn:
+                conn.execute(get_managed_table('pipeline_stage_timings').insert(), rows)
+        except Exception as e:
+            logger.error(f"Could not store stage timings of athlete {self.athlete_id}: {e}")
@@ -0,0 +1,365 @@
+"""
+Bounded-memory transform for athletes with long histories.
+
+With STREAM_TRANSFORM=1, transform_athlete_data reads an athlete loaded from
+files through the activity cache, a few activities at a time, instead of
+holding every activity and feature frame until the final save:
+    1. A first pass over the activities without their laps fits the
+       pace-to-HR regressor and finds the PBs.
+    2. A second pass reads them with their laps in date order. Block '0' is
+       written STREAM_CHUNK_WEEKS weeks at a time, once a later activity has
+       closed them, and each PB block as soon as the stream passes the PB's
+       day. Only the activities of the last BLOCK_DAYS days are kept, with
+       their feature records, for the PB blocks still to come.
+    3. The block features compare each block to athlete-wide means and
+       z-scores, so they are computed at the end, from the weeks of the PB
+       blocks and a few narrow columns of every week and activity
+       (SLIM_WEEK_COLUMNS, SLIM_ACTIVITY_COLUMNS).
+Peak memory is set by one block's window and the chunk sizes rather than by
+the length of the history. What still grows with it are the narrow columns,
+the pace/HR pairs the regressor is fitted on and the weekly totals of the
+weekly cube, a few dozen bytes per activity or week next to the laps and
+feature frames the default transform keeps.
+
+The rows are those of the default transform, written in one transaction
+(sql_methods.stream_tables_atomic), so readers never see a half-written
+athlete. Every activity is extracted again on each run: INCREMENTAL_TRANSFORM
+does not apply, and the week features are computed here even with
+WEEK_AGGREGATES_IN_SQL. Athletes whose activity cache cannot be read get the
+default transform.
+"""
+import logging
+import os
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+import pandas as pd
+from activity_cache import CachedActivities, cached_athlete_metadata
+from activity_functions import hr_estimator
+from athlete_data_transformer import (
+    MIN_ACTIVITIES_PER_BLOCK, WEEKLY_METRICS, athlete_metadata, build_features_blocks, format_metadata_athletes,
+    get_athlete_zones, load_latest_athlete_data, pb_block_metadata, process_activity_block, transform_athlete_data
+)
+from frame_dtypes import compact_frame
+from running_functions import build_pace_to_hr_regressor, extract_weeks_features, get_pbs
+from search_functions import activity_day, is_valid_activity
+from sql_methods import shadow_table_name, stream_tables_atomic
+from stage_timings import StageTimings
+from transform_state import ActivityFeatureMemo
+from weekly_cube import cumulative_cube, week_totals
+
+logger = logging.getLogger(__name__)
+
+# Activities converted from the cache at a time
+STREAM_READ_ACTIVITIES = 200
+
+# Weeks of block '0' extracted and written at a time, one PB block's worth
+STREAM_CHUNK_WEEKS = 13
+
+# Days up to and including its PB that a PB block covers, as in ActivityIndex.block
+BLOCK_DAYS = 91
+
+# What build_features_blocks reads of every week and activity
+SLIM_WEEK_COLUMNS = (['athlete_id', 'block_id']
+                     + [col_name for _, col_name in WEEKLY_METRICS]
+                     + [f'f_time_in_z{zone}_{group}' for zone in range(1, 6) for group in ['runs', 'non_runs']])
+SLIM_ACTIVITY_COLUMNS = ['athlete_id', 'block_id', 'activity_id', 'activity_type', 'distance', 'mean_hr', 'pace', 'stdev_hr']
+
+# Every table transform_athlete_data writes
+STREAMED_TABLES = [
+    'metadata_athletes',
+    'metadata_blocks',
+    'all_athlete_activities',
+    'all_athlete_weeks',
+    'features_activities',
+    'features_weeks',
+    'features_blocks',
+    'average_paces_and_hrs',
+    'athlete_weekly_cube'
+]
+
+def stream_activities(cached: CachedActivities, positions: List[int],
+                      laps: bool = True, best_efforts: bool = True) -> Iterator[dict]:
+    """The cached activities at positions, in that order, converted STREAM_READ_ACTIVITIES at a time."""
+    for start in range(0, len(positions), STREAM_READ_ACTIVITIES):
+        yield from cached.dicts(positions[start:start + STREAM_READ_ACTIVITIES], laps, best_efforts)
+
+def slim_frame(frames: List[pd.DataFrame], columns: List[str]) -> pd.DataFrame:
+    """The frames concatenated, with only those of columns that any of them has."""
+    present = [[col for col in columns if col in df.columns] for df in frames]
+    frames = [df[cols] for df, cols in zip(frames, present) if not df.empty]
+    return compact_frame(pd.concat(frames, ignore_index=True)) if frames else pd.DataFrame()
+
+class StreamedBlock:
+    """Block '0' of process_activity_block, from activities arriving in date order.
+
+    Weeks are numbered from the first activity's day up to the last
+    activity's, which is left out, as in get_weeks. The closed weeks are
+    extracted and written STREAM_CHUNK_WEEKS at a time; the columns each week
+    sees carry over from the chunks before it.
+    """
+
+    def __init__(self, athlete_data: dict, athlete_id: str, zones: List[int], hr_regressor,
+                 memo: ActivityFeatureMemo, first_day: int, last_day: int, write: Callable):
+        self.athlete_data = athlete_data
+        self.athlete_id = athlete_id
+        self.zones = zones
+        self.hr_regressor = hr_regressor
+        self.memo = memo
+        self.write = write
+        self.start_day = first_day
+        self.num_weeks = (last_day - first_day) // 7
+        self.first_week = None   # week of the first activity, empty weeks before it are dropped
+        self.open_week = None
+        self.columns_seen = {}   # column -> None, in order of first appearance
+        self.records = []        # of the closed weeks not written yet, then of the open week
+        self.week_ids = []
+        self.week_columns = []
+        # SLIM_ACTIVITY_COLUMNS and SLIM_WEEK_COLUMNS of the written chunks, merged as they come
+        self.activities = pd.DataFrame()
+        self.weeks = pd.DataFrame()
+        self.totals = []         # week_totals of the written chunks, for the weekly cube
+
+    def add(self, activity: dict, day: int) -> None:
+        """Place an activity, other than the last one, in its week."""
+        week = (day - self.start_day) // 7
+        if not 0 <= week < self.num_weeks:
+            return
+        if self.first_week is None:
+            self.first_week = self.open_week = week
+        self.close_weeks(week)
+        if len(self.week_ids) >= STREAM_CHUNK_WEEKS:
+            self.flush()
+
+        features = self.memo.activity_record(
+            activity,
+            self.zones,
+            activity['type'],
+            self.athlete_data['id'],
+            '0',
+            f"0_{week - self.first_week}",
+            self.hr_regressor
+        )
+        if features is not None:
+            self.records.append(features)
+            self.columns_seen.update(dict.fromkeys(features))
+
+    def close_weeks(self, week: int) -> None:
+        """Close the open week and the empty ones after it, up to week."""
+        while self.open_week < week:
+            self.week_ids.append(f"0_{self.open_week - self.first_week}")
+            self.week_columns.append(list(self.columns_seen))
+            self.open_week += 1
+
+    def flush(self) -> None:
+        """Extract and write the closed weeks and their activities."""
+        # Columns seen in earlier chunks are all-NaN here, as in the full frame
+        activities_df = pd.DataFrame(self.records).reindex(columns=list(self.columns_seen))
+        weeks = extract_weeks_features(activities_df, self.week_ids, self.week_columns, self.athlete_id, '0')
+        activities_df = compact_frame(activities_df)
+        weeks_df = compact_frame(pd.DataFrame(weeks))
+
+        self.write('all_athlete_activities', activities_df)
+        self.write('all_athlete_weeks', weeks_df)
+        self.totals.append(week_totals(activities_df, self.week_ids))
+        self.activities = slim_frame([self.activities, activities_df], SLIM_ACTIVITY_COLUMNS)
+        self.weeks = slim_frame([self.weeks, weeks_df], SLIM_WEEK_COLUMNS)
+        self.records, self.week_ids, self.week_columns = [], [], []
+
+    def finish(self) -> None:
+        """Close the remaining weeks and write them."""
+        if self.first_week is not None:
+            self.close_weeks(self.first_week + self.num_weeks)
+        self.flush()
+
+    def weekly_cube(self) -> pd.DataFrame:
+        """athlete_weekly_cube rows of the written weeks."""
+        totals = [df for df in self.totals if not df.empty]
+        if not totals:
+            return pd.DataFrame()
+        return compact_frame(cumulative_cube(pd.concat(totals), self.start_day, self.athlete_id))
+
+class StreamedPBBlocks:
+    """process_pb_blocks over activities arriving in date order.
+
+    Keeps the activities of the last BLOCK_DAYS days. A PB's block is
+    processed and written once an activity after the PB's day arrives, or at
+    the end; activities older than any block still to come are dropped, with
+    their feature records.
+    """
+
+    def __init__(self, significant_pbs: List[List], athlete_id: str, zones: List[int], hr_regressor,
+                 memo: ActivityFeatureMemo, write: Callable):
+        self.significant_pbs = significant_pbs
+        self.athlete_id = athlete_id
+        self.zones = zones
+        self.hr_regressor = hr_regressor
+        self.memo = memo
+        self.write = write
+        self.pending = deque(range(len(significant_pbs)))
+        self.window: Deque[Tuple[int, dict]] = deque()  # (day, activity)
+        self.metadata = []
+        self.activities = []     # SLIM_ACTIVITY_COLUMNS of the written blocks
+        self.weeks = []          # the written blocks' weeks
+
+    def add(self, activity: dict, day: int) -> None:
+        """Process the blocks of the PBs before day, then keep the activity for the ones after it."""
+        self.close_blocks(day)
+        while self.window and self.window[0][0] <= day - BLOCK_DAYS:
+            _, activity_out = self.window.popleft()
+            self.memo.forget(activity_out.get('id'))
+        self.window.append((day, activity))
+
+    def close_blocks(self, day: Optional[int] = None) -> None:
+        """Process the blocks of the PBs before day, or all of them."""
+        while self.pending and (day is None or self.significant_pbs[self.pending[0]][2].toordinal() < day):
+            self.process_block(self.pending.popleft())
+
+    def process_block(self, i: int) -> None:
+        """Process and write the block of the i-th PB, unless it is too short."""
+        pb_day = self.significant_pbs[i][2].toordinal()
+        block = [(day, activity) for day, activity in self.window if pb_day - BLOCK_DAYS < day <= pb_day]
+
+        # Skip if the block is too short
+        if len(block) < MIN_ACTIVITIES_PER_BLOCK:
+            return
+
+        block_metadata = pb_block_metadata(self.significant_pbs, i, self.athlete_id)
+        block_activities, block_weeks = process_activity_block(
+            [activity for _, activity in block],
+            {'id': self.athlete_id},
+            self.athlete_id,
+            self.zones,
+            self.hr_regressor,
+            block_metadata['block_id'],
+            memo=self.memo,
+            days=[day for day, _ in block]
+        )
+        self.metadata.append(block_metadata)
+        self.write('features_activities', block_activities)
+        self.write('features_weeks', block_weeks)
+        self.activities.append(slim_frame([block_activities], SLIM_ACTIVITY_COLUMNS))
+        self.weeks.append(block_weeks)
+
+def stream_blocks(cached: CachedActivities, positions: List[int], athlete_data: dict, athlete_id: str,
+                  zones: List[int], hr_regressor, significant_pbs: List[List],
+                  write: Callable) -> Tuple[StreamedBlock, StreamedPBBlocks]:
+    """Stream the activities at positions, oldest first, through block '0' and the PB blocks."""
+    if not positions:
+        raise ValueError(f"No activities for athlete {athlete_id}")
+    first, = cached.dicts(positions[:1], laps=False, best_efforts=False)
+    last, = cached.dicts(positions[-1:], laps=False, best_efforts=False)
+    first_day, last_day = activity_day(first), activity_day(last)
+    if first_day is None or last_day is None:
+        raise ValueError(f"Invalid start date in activity {(last if last_day is None else first).get('id')}")
+
+    memo = ActivityFeatureMemo()
+    block = StreamedBlock(athlete_data, athlete_id, zones, hr_regressor, memo, first_day, last_day, write)
+    pb_blocks = StreamedPBBlocks(significant_pbs, athlete_id, zones, hr_regressor, memo, write)
+
+    previous_day = first_day
+    for position, activity in enumerate(stream_activities(cached, positions)):
+        day = activity_day(activity)
+        if day is None:
+            continue
+        if day < previous_day:
+            raise ValueError(f"Activity {activity.get('id')} is out of date order")
+        previous_day = day
+
+        if is_valid_activity(activity):
+            pb_blocks.add(activity, day)
+        if position < len(positions) - 1:  # Exclude last activity (PB)
+            block.add(activity, day)
+
+    pb_blocks.close_blocks()
+    block.finish()
+    return block, pb_blocks
+
+def stream_transform_athlete_data(athlete_id: int, shadow: bool = False) -> bool:
+    """transform_athlete_data for an athlete loaded from files, streamed in date order."""
+    filename = f'./data/athlete_{athlete_id}_activities.json'
+    if not os.path.exists(filename):
+        logger.error(f"No data file found for athlete {athlete_id}")
+        return False
+
+    timings = StageTimings(athlete_id)
+    with timings.stage('load') as stage:
+        try:
+            athlete_data = cached_athlete_metadata(athlete_id, filename)
+            cached = CachedActivities(athlete_id)
+            stage['rows_out'] = len(cached)
+        except Exception as e:
+            logger.warning(f"Activity cache unavailable for athlete {athlete_id}, transforming in memory: {e}")
+            cached = None
+    if cached is None:
+        athlete_data = load_latest_athlete_data(athlete_id)
+        return bool(athlete_data) and transform_athlete_data(athlete_id, athlete_data, shadow=shadow)
+
+    try:
+        if athlete_data is None:
+            logger.error(f"Missing required data types for athlete {athlete_id}")
+            return False
+        if 'sex' not in athlete_data:
+            logger.error(f"Invalid data for athlete {athlete_id}")
+            return False
+
+        zones = get_athlete_zones(athlete_data)
+        newest_first = cached.transform_order()
+        oldest_first = newest_first[::-1]
+
+        with timings.stage('hr_regressor', rows_in=len(newest_first)) as stage:
+            regressor, not_nan_rows = build_pace_to_hr_regressor(
+                stream_activities(cached, newest_first, laps=False, best_efforts=False), athlete_id, zones)
+            regressor = hr_estimator(regressor)
+            average_paces_and_hrs = (compact_frame(not_nan_rows.reset_index(drop=True))
+                                     if not_nan_rows is not None else pd.DataFrame())
+            stage['rows_out'] = len(average_paces_and_hrs)
+
+        with timings.stage('pbs', rows_in=len(oldest_first)) as stage:
+            significant_pbs = get_pbs(stream_activities(cached, oldest_first, laps=False))
+            stage['rows_out'] = len(significant_pbs)
+
+        metadata_athletes = athlete_metadata(athlete_data)
+        table = shadow_table_name if shadow else str
+        rows_written: Dict[str, int] = {}
+
+        with stream_tables_atomic([table(name) for name in STREAMED_TABLES], athlete_id=athlete_id) as write_table:
+            def write(table_name: str, df: pd.DataFrame) -> None:
+                write_table(table(table_name), df)
+                rows_written[table_name] = rows_written.get(table_name, 0) + len(df)
+
+            with timings.stage('stream', rows_in=len(oldest_first)) as stage:
+                block, pb_blocks = stream_blocks(cached, oldest_first, athlete_data, athlete_id,
+                                                 zones, regressor, significant_pbs, write)
+                stage['rows_out'] = sum(rows_written.values())
+
+            metadata_blocks = compact_frame(pd.DataFrame(pb_blocks.metadata))
+            with timings.stage('block_metrics', rows_in=len(metadata_blocks)) as stage:
+                features_blocks = build_features_blocks(
+                    metadata_blocks,
+                    compact_frame(pd.concat(pb_blocks.weeks, ignore_index=True)) if pb_blocks.weeks else pd.DataFrame(),
+                    block.weeks,
+                    slim_frame(pb_blocks.activities, SLIM_ACTIVITY_COLUMNS),
+                    block.activities,
+                    athlete_id
+                )
+                stage['rows_out'] = len(features_blocks)
+
+            remaining = {
+                'metadata_athletes': format_metadata_athletes(metadata_athletes),
+                'metadata_blocks': metadata_blocks,
+                'features_blocks': features_blocks,
+                'average_paces_and_hrs': average_paces_and_hrs,
+                'athlete_weekly_cube': block.weekly_cube()
+            }
+            with timings.stage('save', rows_in=sum(len(df) for df in remaining.values())):
+                for table_name, df in remaining.items():
+                    write(table_name, df)
+
+        logger.info(f"Streamed athlete {athlete_id}: {rows_written}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error streaming athlete data: {e}")
+        raise
+    finally:
+        timings.save()
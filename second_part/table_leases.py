@@ -0,0 +1,153 @@
+"""
+Leases on whole tables, in the table_leases table.
+
+Per-athlete transforms write the analytics tables in place and hold them
+shared, so any number of them run side by side. Writers that replace whole
+tables through their shadows (update_data.rebuild_analytics_tables,
+sql_methods.publish_tables) hold them exclusively: the swap discards rows
+written to the old tables meanwhile, and the shadow names are fixed, so two
+such writers would drop each other's shadows.
+
+A holder has one row per table, renewed like a job lease (see job_queue) and
+ignored once it runs out, so a crashed holder keeps the tables for one lease
+at most. An exclusive request shuts out new holders as soon as it is made and
+is granted once the shared holders already in have left; they see it through
+HeldTables.contended() and stop taking on work.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+from sqlalchemy import and_, delete, select, update
+from job_queue import DEFAULT_LEASE_SECONDS, HEARTBEAT_SECONDS, get_worker_id
+from models import TableLease
+from sql_methods import build_upsert, get_db_connection
+
+logger = logging.getLogger(__name__)
+
+GRANTED = 'granted'
+QUEUED = 'queued'     # exclusive request waiting for the shared holders to leave
+REFUSED = 'refused'   # another holder has or waits for one of the tables exclusively
+
+# How long a writer waits for its tables, time for a crashed holder's lease to run out
+LEASE_WAIT_SECONDS = DEFAULT_LEASE_SECONDS
+
+# How often a waiting request is made again
+LEASE_POLL_SECONDS = 5
+
+leases = TableLease.__table__
+
+# Every request updates this row first, so on MySQL and PostgreSQL they queue on its lock
+REQUEST_ROW = {'table_name': '', 'owner': '', 'exclusive': False, 'expires_at': None}
+
+class TablesBusy(RuntimeError):
+    """Leases on tables were not granted in time."""
+
+def held_by_others(table_names: List[str], owner: str, now: datetime):
+    """Condition for the live leases on table_names of holders other than owner."""
+    return and_(
+        leases.c.table_name.in_(table_names),
+        leases.c.owner != owner,
+        leases.c.owner != '',
+        leases.c.expires_at >= now
+    )
+
+def request_tables(table_names: Iterable[str], owner: str, exclusive: bool = False,
+                   lease_seconds: int = DEFAULT_LEASE_SECONDS) -> str:
+    """Ask for leases on table_names and return GRANTED, QUEUED or REFUSED.
+
+    Requests are serialised like claims in job_queue: SQLite takes the write
+    lock with BEGIN IMMEDIATE, MySQL and PostgreSQL the lock of REQUEST_ROW.
+    A queued exclusive request keeps its rows; make it again until it is
+    granted, or withdraw it with release_tables().
+    """
+    table_names = sorted(set(table_names))
+    now = datetime.utcnow()
+    engine = get_db_connection()
+    leases.create(engine, checkfirst=True)
+
+    with engine.connect() as conn, conn.execution_options(sqlite_begin='IMMEDIATE').begin():
+        if engine.dialect.name != 'sqlite':
+            conn.execute(build_upsert(leases, [REQUEST_ROW], engine.dialect.name))
+        held = conn.execute(select(leases.c.exclusive).where(held_by_others(table_names, owner, now))).scalars().all()
+        if any(held):
+            return REFUSED
+        conn.execute(build_upsert(leases, [
+            {'table_name': table_name, 'owner': owner, 'exclusive': exclusive,
+             'expires_at': now + timedelta(seconds=lease_seconds)}
+            for table_name in table_names
+        ], engine.dialect.name))
+    return QUEUED if exclusive and held else GRANTED
+
+def renew_tables(table_names: Iterable[str], owner: str, lease_seconds: int = DEFAULT_LEASE_SECONDS) -> bool:
+    """Extend owner's leases on table_names. Returns False if any of them was gone."""
+    table_names = sorted(set(table_names))
+    with get_db_connection().begin() as conn:
+        result = conn.execute(
+            update(leases)
+            .where(leases.c.table_name.in_(table_names), leases.c.owner == owner)
+            .values(expires_at=datetime.utcnow() + timedelta(seconds=lease_seconds))
+        )
+    return result.rowcount == len(table_names)
+
+def release_tables(table_names: Iterable[str], owner: str) -> None:
+    """Drop owner's leases or queued request on table_names."""
+    with get_db_connection().begin() as conn:
+        conn.execute(delete(leases).where(leases.c.table_name.in_(list(table_names)), leases.c.owner == owner))
+
+def tables_contended(table_names: Iterable[str], owner: str) -> bool:
+    """Whether a holder other than owner has or waits for one of table_names exclusively."""
+    with get_db_connection().connect() as conn:
+        return conn.execute(
+            select(leases.c.table_name)
+            .where(held_by_others(sorted(set(table_names)), owner, datetime.utcnow()), leases.c.exclusive)
+            .limit(1)
+        ).first() is not None
+
+class HeldTables:
+    """Holds leases on tables for a with block, renewing them from a background thread.
+
+    Entering makes the request every LEASE_POLL_SECONDS until it is granted,
+    and raises TablesBusy if that takes longer than wait_seconds.
+    """
+
+    def __init__(self, table_names: Iterable[str], exclusive: bool = False, wait_seconds: float = 0,
+                 owner: Optional[str] = None, lease_seconds: int = DEFAULT_LEASE_SECONDS,
+                 interval: float = HEARTBEAT_SECONDS):
+        self.table_names = sorted(set(table_names))
+        self.exclusive = exclusive
+        self.wait_seconds = wait_seconds
+        self.owner = owner or get_worker_id()
+        self.lease_seconds = lease_seconds
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='table-lease-heartbeat', daemon=True)
+
+    def __enter__(self) -> 'HeldTables':
+        deadline = time.monotonic() + self.wait_seconds
+        while (state := request_tables(self.table_names, self.owner, self.exclusive, self.lease_seconds)) != GRANTED:
+            if time.monotonic() >= deadline:
+                release_tables(self.table_names, self.owner)
+                mode = 'exclusive' if self.exclusive else 'shared'
+                raise TablesBusy(f"No {mode} lease on {self.table_names} after {self.wait_seconds}s: {state}")
+            time.sleep(min(LEASE_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.thread.join()
+        release_tables(self.table_names, self.owner)
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                if not renew_tables(self.table_names, self.owner, self.lease_seconds):
+                    logger.warning(f"Lease of {self.owner} on {self.table_names} ran out before it was renewed")
+            except Exception as e:
+                logger.error(f"Could not renew the lease on {self.table_names}: {e}")
+
+    def contended(self) -> bool:
+        """Whether another writer has asked for the tables exclusively."""
+        return tables_contended(self.table_names, self.owner)
@@ -8,11 +8,21 @@ from datetime import date
 import logging
 import os
 from sql_methods import write_db_replace, read_db
+from frame_dtypes import compact_frame
 from typing import Tuple, Optional, Dict
 import matplotlib.pyplot as plt
 
 logger = logging.getLogger(__name__)
 
+# Key and target columns of features_blocks, every other column is a feature
+NON_FEATURE_COLUMNS = ['id', 'athlete_id', 'block_id', 'y_vdot_delta', 'y_vdot']
+OPTIONAL_FEATURE_COLUMNS = ['r_proportion_alpine_ski', 'r_proportion_crossfit']
+
+def get_feature_columns(features_blocks: pd.DataFrame) -> list:
+    """Return the model feature columns of a features_blocks frame."""
+    columns = [col for col in features_blocks.columns if col not in NON_FEATURE_COLUMNS]
+    return columns + [col for col in OPTIONAL_FEATURE_COLUMNS if col not in columns]
+
 def prepare_features(features_blocks: pd.DataFrame, athlete_id: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """Prepare features for model training."""
     try:
@@ -27,32 +37,27 @@ def prepare_features(features_blocks: pd.DataFrame, athlete_id: Optional[str] =
                 athlete_data = features_blocks  # Fall back to using all data
             features_blocks = athlete_data
             
-        # Get feature columns (excluding athlete_id, block_id, and target variables)
-        feature_cols = features_blocks.columns[2:-2]
+        # Add missing columns if they don't exist
+        features_blocks = features_blocks.copy()
+        for col in OPTIONAL_FEATURE_COLUMNS:
+            if col not in features_blocks.columns:
+                features_blocks[col] = 0
+        
+        # Get feature columns (excluding keys and target variables)
+        feature_cols = get_feature_columns(features_blocks)
         
         # Convert features to numeric, replacing non-numeric values with NaN
         X = features_blocks[feature_cols].apply(pd.to_numeric, errors='coerce')
-        
-        # Add missing columns if they don't exist
-        if 'r_proportion_alpine_ski' not in X.columns:
-            X['r_proportion_alpine_ski'] = 0
-        if 'r_proportion_crossfit' not in X.columns:
-            X['r_proportion_crossfit'] = 0
             
-        # Fill NaN values with 0 or column mean
-        for col in X.columns:
-            col_mean = X[col].mean()
-            if pd.isna(col_mean):  # If entire column is NaN
-                X[col] = X[col].fillna(0)
-            else:
-                X[col] = X[col].fillna(col_mean)
+        # Fill NaN values with the column mean, or 0 where the entire column is NaN
+        X = X.fillna(X.mean()).fillna(0)
         
-        # Convert to numpy array
-        X = X.to_numpy()
+        # Convert to numpy array; the forest splits on float32 either way
+        X = X.to_numpy(dtype=np.float32)
         
         # Convert target variables to numeric and handle NaN
-        y_absolute = pd.to_numeric(features_blocks.iloc[:, -2], errors='coerce').fillna(0)
-        y_change = pd.to_numeric(features_blocks.iloc[:, -1], errors='coerce').fillna(0)
+        y_absolute = pd.to_numeric(features_blocks['y_vdot'], errors='coerce').fillna(0)
+        y_change = pd.to_numeric(features_blocks['y_vdot_delta'], errors='coerce').fillna(0)
         
         return X, y_absolute, y_change
     except Exception as e:
@@ -141,13 +146,13 @@ def train_model(athlete_id: Optional[str] = None) -> Dict:
     """Train model for a specific athlete or all athletes."""
     try:
         # Read features data
-        features_blocks = read_db('features_blocks')
+        features_blocks = compact_frame(read_db('features_blocks'))
         if features_blocks.empty:
             raise ValueError("No features data available in database")
             
         # Prepare features and targets
         X, y_absolute, y_change = prepare_features(features_blocks, athlete_id)
-        feature_names = list(features_blocks.columns.values[2:-2])
+        feature_names = get_feature_columns(features_blocks)
         
         model_outputs = pd.DataFrame()
         results = {}
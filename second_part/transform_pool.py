@@ -0,0 +1,127 @@
+"""
+Transform athletes in parallel over a pool of worker processes.
+
+Each athlete's transform is CPU-bound pandas/scipy work, so with
+TRANSFORM_WORKERS > 1 athletes are spread over worker processes. The caller
+is usually a threaded Flask handler with a lease heartbeat running, so
+workers are not forked from it (a fork copies locks other threads may hold)
+but from a forkserver: a single-threaded process that imports this module
+once and forks each worker from that clean state. The server also imports
+the main module, so scripts that transform in parallel keep their top level
+under if __name__ == '__main__'. Workers open their own database
+connections and each writes its athlete's rows itself; the parent only
+hands out athlete ids, collects one report per athlete and, as each comes
+back, invalidates its own cached reads of the tables the worker wrote:
+    athlete_id   - the athlete
+    transformed  - what transform_athlete_data returned
+    error        - the exception message if the transform raised, else None
+    seconds      - wall time of the transform
+    max_rss_mb   - peak resident memory of the process that ran it
+
+Memory is bounded by recycling the pool: after TRANSFORM_ATHLETES_PER_WORKER
+athletes per worker the processes exit and fresh ones are started. A worker
+that dies (e.g. killed for memory) breaks its pool: the athletes still
+running in it fail, and the rest go to a new pool.
+"""
+import logging
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, Iterator, List
+from athlete_data_transformer import transform_athlete_data
+from migrations import ANALYTICS_TABLES
+from sql_methods import bump_table_version, shadow_table_name
+
+logger = logging.getLogger(__name__)
+
+# Worker processes for the transform; 1 transforms athletes in this process
+TRANSFORM_WORKERS = int(os.environ.get('TRANSFORM_WORKERS', '1'))
+
+# Athletes a worker process transforms before it is replaced
+TRANSFORM_ATHLETES_PER_WORKER = int(os.environ.get('TRANSFORM_ATHLETES_PER_WORKER', '20'))
+
+def transform_report(athlete_id: int, shadow: bool = False) -> Dict:
+    """Transform one athlete and report how it went, without raising."""
+    start_time = time.time()
+    report = {'athlete_id': athlete_id, 'transformed': False, 'error': None}
+    try:
+        report['transformed'] = bool(transform_athlete_data(athlete_id, populate_all_from_files=1, shadow=shadow))
+    except Exception as e:
+        logger.error(f"Error transforming athlete {athlete_id}: {e}")
+        report['error'] = str(e)
+    report['seconds'] = round(time.time() - start_time, 2)
+    report['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    return report
+
+def published(report: Dict, shadow: bool) -> Dict:
+    """report, once this process's cached reads of the tables a worker wrote are invalidated.
+    
+    Workers bump table versions in their own process only, so the parent
+    bumps them for every report that comes back, transformed or not.
+    """
+    bump_table_version(*(shadow_table_name(name) if shadow else name for name in ANALYTICS_TABLES))
+    return report
+
+def worker_context():
+    """The forkserver context the worker pools start their processes from."""
+    context = multiprocessing.get_context('forkserver')
+    # Imported once in the server rather than in every worker
+    context.set_forkserver_preload(['__main__', 'transform_pool'])
+    return context
+
+def transform_reports(athlete_ids: Iterable[int], shadow: bool = False,
+                      workers: int = TRANSFORM_WORKERS) -> Iterator[Dict]:
+    """Transform each athlete of athlete_ids and yield its report as it finishes.
+    
+    athlete_ids is consumed lazily, one id per free worker, so it can claim
+    jobs as it goes and see the reports yielded so far.
+    """
+    athlete_ids = iter(athlete_ids)
+    if workers <= 1:
+        for athlete_id in athlete_ids:
+            yield transform_report(athlete_id, shadow)
+        return
+    
+    context = worker_context()
+    exhausted = False
+    while not exhausted:
+        budget = workers * TRANSFORM_ATHLETES_PER_WORKER
+        broken = False
+        running = {}
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            while True:
+                while len(running) < workers and budget > 0 and not broken and not exhausted:
+                    athlete_id = next(athlete_ids, None)
+                    if athlete_id is None:
+                        exhausted = True
+                        break
+                    running[pool.submit(transform_report, athlete_id, shadow)] = athlete_id
+                    budget -= 1
+                if not running:
+                    break
+                
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    athlete_id = running.pop(future)
+                    try:
+                        yield published(future.result(), shadow)
+                    except Exception as e:
+                        # A worker that died takes the pool with it; the next round starts a new one
+                        broken = broken or isinstance(e, BrokenProcessPool)
+                        logger.error(f"Worker failed while transforming athlete {athlete_id}: {e}")
+                        yield published({'athlete_id': athlete_id, 'transformed': False,
+                                         'error': f'worker failed: {e}', 'seconds': None, 'max_rss_mb': None},
+                                        shadow)
+
+def format_reports(reports: List[Dict], slowest: int = 5) -> str:
+    """Slowest athletes and failures, for the processing summaries."""
+    lines = [f"Athlete {r['athlete_id']}: {r['seconds']}s, {r['max_rss_mb']} MB peak"
+             for r in sorted((r for r in reports if r['seconds'] is not None),
+                             key=lambda r: r['seconds'], reverse=True)[:slowest]]
+    lines += [f"Athlete {r['athlete_id']} failed: {r['error']}" if r['error'] else
+              f"Athlete {r['athlete_id']} skipped: no usable data"
+              for r in reports if r['error'] or not r['transformed']]
+    return '\n    '.join(lines)
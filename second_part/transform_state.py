@@ -0,0 +1,182 @@
+"""
+Per-activity features shared within a transform and kept between transforms.
+
+Within one transform, ActivityFeatureMemo extracts each activity's features
+once and serves them to every block the activity falls in.
+
+An incremental transform (INCREMENTAL_TRANSFORM=1) reuses what the previous
+run computed instead of rebuilding it from the full history:
+    - the feature record of each activity, keyed by activity id and a hash
+      of the activity, so only new or changed activities are extracted again.
+      Runs whose heart rate was estimated by the pace-to-HR regressor are
+      extracted again when the regressor's coefficients change.
+    - the features of each week of each block, keyed by the ids of the week's
+      activities. Since a week's features depend on the columns seen in the
+      weeks before it, a block's weeks are reused up to the first week that
+      has a new or changed activity; that week and the ones after it are
+      recomputed.
+The PB list, block metadata and block features are cheap next to these and
+depend on athlete-wide means and z-scores, so they are always recomputed.
+
+The state is pickled to <activity cache>/<athlete_id>/transform_state.pkl
+after a successful save and dropped when its version or the zones differ.
+"""
+import hashlib
+import json
+import logging
+import pickle
+from typing import Callable, Dict, List, Optional, Tuple
+from activity_cache import cache_path, write_atomic
+from activity_functions import hr_estimator
+from running_functions import activity_feature_record
+
+logger = logging.getLogger(__name__)
+
+# Bump when feature extraction changes, so older states are not reused
+TRANSFORM_STATE_VERSION = 3
+
+LABEL_COLUMNS = ('athlete_id', 'block_id', 'week_id')
+
+def activity_fingerprint(activity: dict) -> str:
+    """Stable hash of an activity's content."""
+    content = json.dumps(activity, sort_keys=True, default=str)
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+def uses_hr_regressor(activity: dict, activity_type: str) -> bool:
+    """Whether the activity's features may include a regressor HR estimate."""
+    if activity_type not in ['Run', 'TrailRun'] or not activity.get('laps'):
+        return False
+    return (activity.get('average_heartrate') is None
+            or any(lap.get('average_heartrate') is None for lap in activity['laps']))
+
+def regressor_signature(hr_regressor) -> Optional[Tuple[float, ...]]:
+    """Coefficients of the pace-to-HR regressor, None without one."""
+    estimator = hr_estimator(hr_regressor)
+    return None if estimator is None else (estimator.slope, estimator.intercept)
+
+class ActivityFeatureMemo:
+    """Feature records computed once per activity per transform.
+    
+    PB blocks overlap, so the same activity shows up in block '0' and in every
+    PB window around it; its record is extracted once and only the block and
+    week labels are attached per block.
+    """
+
+    def __init__(self):
+        self.records = {}   # activity id -> record without labels, None if extraction failed
+
+    def activity_record(self, activity: dict, zones: List[int], activity_type: str, athlete_id: str,
+                        block_id: str, week_id: str, hr_regressor) -> Optional[Dict]:
+        """activity_feature_record, looked up by activity id."""
+        activity_id = activity.get('id')
+        if activity_id is None:
+            return activity_feature_record(activity, zones, activity_type, athlete_id, block_id, week_id, hr_regressor)
+        if activity_id not in self.records:
+            self.records[activity_id] = self.compute_record(activity, zones, activity_type, hr_regressor)
+        stored = self.records[activity_id]
+        if stored is None:
+            return None
+        return {'athlete_id': athlete_id, 'block_id': block_id, 'week_id': week_id, **stored}
+
+    def compute_record(self, activity: dict, zones: List[int], activity_type: str, hr_regressor) -> Optional[Dict]:
+        """The activity's record without labels."""
+        features = activity_feature_record(activity, zones, activity_type, None, None, None, hr_regressor)
+        return None if features is None else {k: v for k, v in features.items() if k not in LABEL_COLUMNS}
+
+    def forget(self, activity_id: int) -> None:
+        """Drop an activity's record once no block still to come can include it."""
+        self.records.pop(activity_id, None)
+    
+    def week_features(self, block_id: str, week_num: int, activity_ids: List[int],
+                      compute: Callable[[], dict]) -> dict:
+        """Features of a block's week; computed every time here."""
+        return compute()
+
+class TransformState(ActivityFeatureMemo):
+    """Feature records and week features of one athlete, reused across transforms."""
+
+    def __init__(self, zones: List[int], hr_regressor, previous: Optional[dict] = None):
+        super().__init__()
+        self.zones = list(zones)
+        self.regressor = regressor_signature(hr_regressor)
+        previous = previous or {}
+        self.previous_records = previous.get('records', {})
+        self.previous_fingerprints = previous.get('fingerprints', {})
+        self.previous_weeks = previous.get('weeks', {})
+        self.previous_regressor = previous.get('regressor')
+        self.fingerprints = {}  # activity id -> (content hash, uses regressor)
+        self.weeks = {}         # block id -> [(activity ids, week features)]
+        self.changed = set()
+        self.reusing = {}       # block id -> whether all earlier weeks of the block were reused
+        self.reused_records = 0
+        self.reused_weeks = 0
+
+    def compute_record(self, activity: dict, zones: List[int], activity_type: str, hr_regressor) -> Optional[Dict]:
+        """The previous run's record if the activity is unchanged, else a fresh one."""
+        activity_id = activity['id']
+        fingerprint = activity_fingerprint(activity)
+        depends = uses_hr_regressor(activity, activity_type)
+        self.fingerprints[activity_id] = (fingerprint, depends)
+        
+        if (self.previous_fingerprints.get(activity_id, (None,))[0] == fingerprint
+                and not (depends and self.previous_regressor != self.regressor)):
+            self.reused_records += 1
+            return self.previous_records[activity_id]
+        
+        stored = super().compute_record(activity, zones, activity_type, hr_regressor)
+        if activity_id not in self.previous_records or self.previous_records[activity_id] != stored:
+            self.changed.add(activity_id)
+        return stored
+
+    def week_features(self, block_id: str, week_num: int, activity_ids: List[int],
+                      compute: Callable[[], dict]) -> dict:
+        """The week's features from the previous run if nothing up to this week changed, else compute()."""
+        previous = self.previous_weeks.get(block_id, [])
+        reusable = (self.reusing.get(block_id, True)
+                    and week_num < len(previous)
+                    and previous[week_num][0] == activity_ids
+                    and not self.changed.intersection(activity_ids))
+        self.reusing[block_id] = reusable
+        if reusable:
+            features = previous[week_num][1]
+            self.reused_weeks += 1
+        else:
+            features = compute()
+        self.weeks.setdefault(block_id, []).append((activity_ids, features))
+        return features
+
+    def to_dict(self) -> dict:
+        """What the next run needs: this run's records and weeks."""
+        return {
+            'version': TRANSFORM_STATE_VERSION,
+            'zones': self.zones,
+            'regressor': self.regressor,
+            'records': self.records,
+            'fingerprints': self.fingerprints,
+            'weeks': self.weeks
+        }
+
+def load_transform_state(athlete_id: int, zones: List[int], hr_regressor) -> TransformState:
+    """The athlete's state from the previous run, or an empty one if it cannot be reused."""
+    previous = None
+    try:
+        with open(cache_path(athlete_id, 'transform_state.pkl'), 'rb') as f:
+            previous = pickle.load(f)
+        if previous.get('version') != TRANSFORM_STATE_VERSION or previous.get('zones') != list(zones):
+            logger.info(f"Transform state of athlete {athlete_id} is out of date, starting over")
+            previous = None
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Could not read transform state of athlete {athlete_id}: {e}")
+        previous = None
+    return TransformState(zones, hr_regressor, previous)
+
+def save_transform_state(athlete_id: int, state: TransformState) -> None:
+    """Pickle the state for the next incremental transform."""
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state.to_dict(), f, protocol=pickle.HIGHEST_PROTOCOL)
+    write_atomic(cache_path(athlete_id, 'transform_state.pkl'), write)
+    logger.info(f"Athlete {athlete_id}: reused {state.reused_records} of {len(state.records)} activity records "
+                f"and {state.reused_weeks} of {sum(len(w) for w in state.weeks.values())} weeks")
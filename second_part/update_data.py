@@ -1,11 +1,21 @@
-from sql_methods import write_db_replace, write_db_insert, read_db, db
-from athlete_data_transformer import transform_athlete_data
+from sql_methods import (
+    write_db_replace, write_db_insert, read_db, db, upsert_rows, create_shadow_tables, swap_shadow_tables,
+    drop_shadow_tables, UPSERT_BATCH_SIZE
+)
+from transform_pool import transform_reports, format_reports
+from activity_cache import append_batch, source_signature
+from migrations import ANALYTICS_TABLES
 import requests
 import pandas as pd
 import time
 import os
 import logging
-from models import Activity, AthleteStats
+from models import Activity, ActivityPayload, AthleteStats
+from job_queue import (
+    claim_next, count_jobs, get_worker_id, heartbeat, list_jobs, release, set_tokens, LeaseKeeper,
+    STATUS_NONE, STATUS_PROCESSING, STATUS_PROCESSED
+)
+from table_leases import HeldTables, TablesBusy, LEASE_WAIT_SECONDS
 from datetime import datetime
 from flask import current_app
 import json
@@ -17,25 +27,20 @@ ACTIVITIES_LIMIT = 1 if DEBUG_MODE else 90
 
 def refresh_tokens():    
     try:
-        processing_status = read_db('processing_status')
-        
-        for index, row in processing_status.iterrows():
-            if row['athlete_id'] != 0 and row['status'] == "none":
-                params = {
-                    "client_id": os.environ.get('CLIENT_ID'),
-                    "client_secret": os.environ.get('CLIENT_SECRET'),
-                    "refresh_token": row['refresh_token'],
-                    "grant_type": "refresh_token"
-                }
+        for row in list_jobs([STATUS_NONE]):
+            params = {
+                "client_id": os.environ.get('CLIENT_ID'),
+                "client_secret": os.environ.get('CLIENT_SECRET'),
+                "refresh_token": row['refresh_token'],
+                "grant_type": "refresh_token"
+            }
                 
-                r = requests.post("https://www.strava.com/oauth/token", data=params)
-                r.raise_for_status()
-                response_data = r.json()
+            r = requests.post("https://www.strava.com/oauth/token", data=params)
+            r.raise_for_status()
+            response_data = r.json()
                 
-                processing_status.at[index,'bearer_token'] = response_data['access_token']
-                processing_status.at[index,'refresh_token'] = response_data['refresh_token']
+            set_tokens(row['athlete_id'], response_data['access_token'], response_data['refresh_token'])
         
-        write_db_replace(processing_status, 'processing_status')
         return 0
     except Exception as e:
         logger.error(f"Error refreshing tokens: {e}")
@@ -51,6 +56,42 @@ def get_unprocessed_activities(activity_list, existing_ids, limit=ACTIVITIES_LIM
             new_activities.append(activity)
     return new_activities
 
+def build_activity_row(athlete_id: int, activity: dict) -> dict:
+    """Build an activities table row from a detailed Strava activity."""
+    return {
+        'id': activity['id'],
+        'athlete_id': str(athlete_id),
+        'name': activity.get('name'),
+        'distance': activity.get('distance'),
+        'moving_time': activity.get('moving_time'),
+        'elapsed_time': activity.get('elapsed_time'),
+        'total_elevation_gain': activity.get('total_elevation_gain'),
+        'type': activity.get('type'),
+        'start_date': datetime.strptime(activity.get('start_date'), '%Y-%m-%dT%H:%M:%SZ'),
+        'average_speed': activity.get('average_speed'),
+        'max_speed': activity.get('max_speed'),
+        'average_heartrate': activity.get('average_heartrate'),
+        'max_heartrate': activity.get('max_heartrate')
+    }
+
+def build_payload_row(activity: dict) -> dict:
+    """Build an activity_payloads row holding the compressed activity JSON."""
+    return {'activity_id': activity['id'], 'payload': ActivityPayload.encode(activity)}
+
+def store_activities(rows: list, payload_rows: list = None) -> tuple:
+    """Upsert activity rows and their payloads in one transaction and return (inserted, updated) counts."""
+    if not rows:
+        return 0, 0
+    try:
+        counts = upsert_rows(db.session, 'activities', rows)
+        if payload_rows:
+            upsert_rows(db.session, 'activity_payloads', payload_rows)
+        db.session.commit()
+        return counts
+    except Exception:
+        db.session.rollback()
+        raise
+
 def save_activity_data(athlete_id: int, activities: list, timestamp: str = None) -> None:
     """Save activities to a JSON file with timestamp."""
     if timestamp is None:
@@ -63,6 +104,8 @@ def save_activity_data(athlete_id: int, activities: list, timestamp: str = None)
     
     filename = f'{data_dir}/athlete_{athlete_id}_activities.json'
     
+    previous_source = source_signature(filename)
+    
     # Load existing data if file exists
     existing_data = {}
     if os.path.exists(filename):
@@ -80,6 +123,11 @@ def save_activity_data(athlete_id: int, activities: list, timestamp: str = None)
         json.dump(existing_data, f, indent=2)
     
     logger.info(f"Saved {len(activities)} activities to {filename}")
+    
+    try:
+        append_batch(athlete_id, filename, timestamp, activities, previous_source)
+    except Exception as e:
+        logger.warning(f"Could not update activity cache for athlete {athlete_id}: {e}")
 
 def fetch_strava_data():
     """Fetch data from Strava API and store in files and activity table."""
@@ -96,25 +144,24 @@ def fetch_strava_data():
         logger.error("API LIMIT EXCEEDED")
         return "api limit exceeded"
     
-    processing_status = read_db('processing_status')
-    athletes_to_process = len(processing_status[processing_status['status'] == 'none'])
+    athletes_to_process = count_jobs([STATUS_NONE])
     logger.info(f"Found {athletes_to_process} athletes to process")
     
     current_api_calls = initial_api_calls
+    worker_id = get_worker_id()
     
-    for index, row in processing_status.iterrows():
+    # Each claim leases one athlete, so several fetchers can run side by side
+    while (row := claim_next([STATUS_NONE], worker_id)) is not None:
         with current_app.app_context():  # Add application context
             athlete_id = int(row['athlete_id'])
             
-            if athlete_id != 0 and row['status'] == "none":
+            if athlete_id != 0:
                 athlete_start_time = time.time()
                 logger.info(f"Processing athlete {athlete_id}")
                 
                 bearer_token = row['bearer_token']            
                 print ('processing athlete ' + str(athlete_id))
                 headers = {"Authorization": "Bearer " + bearer_token}
-            
-                processing_status.at[index, 'status'] = 'processing'
                 
                 try:
                     
@@ -204,6 +251,8 @@ def fetch_strava_data():
                     # Store what we found, even if zero new activities
                     activities = []
                     new_activities_count = 0
+                    pending_rows, pending_payloads = [], []
+                    inserted_count = updated_count = 0
                     
                     if len(unprocessed) > 0:
                         """
@@ -220,29 +269,22 @@ def fetch_strava_data():
                             activities.append(this_response)
                             current_api_calls += 1
                             new_activities_count += 1
+                            heartbeat(athlete_id, worker_id)
                             
-                            # Store activity in database
+                            # Queue activity row, written in batches below
                             try:
-                                activity = Activity(
-                                    id=this_response['id'],
-                                    athlete_id=str(athlete_id),
-                                    name=this_response.get('name'),
-                                    distance=this_response.get('distance'),
-                                    moving_time=this_response.get('moving_time'),
-                                    elapsed_time=this_response.get('elapsed_time'),
-                                    total_elevation_gain=this_response.get('total_elevation_gain'),
-                                    type=this_response.get('type'),
-                                    start_date=datetime.strptime(this_response.get('start_date'), '%Y-%m-%dT%H:%M:%SZ'),
-                                    average_speed=this_response.get('average_speed'),
-                                    max_speed=this_response.get('max_speed'),
-                                    average_heartrate=this_response.get('average_heartrate'),
-                                    max_heartrate=this_response.get('max_heartrate'),
-                                    activity_data=this_response
-                                )
-                                db.session.merge(activity)
+                                activity_row = build_activity_row(athlete_id, this_response)
+                                pending_rows.append(activity_row)
+                                pending_payloads.append(build_payload_row(this_response))
                             except Exception as e:
                                 logger.error(f"Error storing activity {activity_id}: {e}")
                                 continue
+                            
+                            if len(pending_rows) >= UPSERT_BATCH_SIZE:
+                                inserted, updated = store_activities(pending_rows, pending_payloads)
+                                inserted_count += inserted
+                                updated_count += updated
+                                pending_rows, pending_payloads = [], []
                                 
                             # Rate limiting
                             end = time.time()
@@ -251,11 +293,13 @@ def fetch_strava_data():
                                 time.sleep(remain)
                         
                         try:
-                            db.session.commit()
-                            logger.info(f"Successfully stored {new_activities_count} new activities")
+                            inserted, updated = store_activities(pending_rows, pending_payloads)
+                            inserted_count += inserted
+                            updated_count += updated
+                            logger.info(f"Successfully stored {new_activities_count} new activities "
+                                        f"({inserted_count} inserted, {updated_count} updated)")
                         except Exception as e:
                             logger.error(f"Error committing activities to database: {e}")
-                            db.session.rollback()
                             raise
                     else:
                         logger.info(f"No new activities to process for athlete {athlete_id}")
@@ -284,19 +328,17 @@ def fetch_strava_data():
                         logger.error(f"Error in data processing: {e}")
                         daily_limit.at[0, 'daily'] = current_api_calls
                         write_db_replace(daily_limit,'daily_limit')                                
-                        processing_status.at[index, 'status'] = 'none'
+                        release(athlete_id, worker_id, STATUS_NONE)
                         return f'failure processing athlete {athlete_id}: {str(e)}'
                     
                 except Exception as ex:                    
                     daily_limit.at[0, 'daily'] = current_api_calls
                     write_db_replace(daily_limit,'daily_limit')                                
-                    processing_status.at[index, 'status'] = 'none'
+                    release(athlete_id, worker_id, STATUS_NONE)
                     return ('failure processing athlete ' + str(row['athlete_id']) + ': ' + str(ex))          
                                                 
                 # Only update status to processed if no more activities to fetch
-                if not has_more_activities:
-                    processing_status.at[index, 'status'] = 'processed'
-                write_db_replace(processing_status, 'processing_status')
+                release(athlete_id, worker_id, STATUS_PROCESSING if has_more_activities else STATUS_PROCESSED)
                 
                 daily_limit.at[0, 'daily'] = current_api_calls
                 write_db_replace(daily_limit, 'daily_limit')       
@@ -345,31 +387,95 @@ def fetch_strava_data():
     return summary
 
 def process_stored_data():
-    """Process stored data files into analytics tables."""
-    start_time = time.time()
-    total_activities_processed = 0
-    athletes_processed = 0
+    """Process stored data files into analytics tables.
     
-    processing_status = read_db('processing_status')
-    athletes_to_process = len(processing_status[processing_status['status'] == 'none'])
+    With TRANSFORM_WORKERS > 1 the claimed athletes are transformed in
+    parallel worker processes (see transform_pool). The analytics tables are
+    held shared meanwhile (see table_leases): nothing is processed while a
+    rebuild has them, and no more athletes are claimed once one asks for them.
+    """
+    start_time = time.time()
+    worker_id = get_worker_id()
+    failed = set()
+    lost = []
     
-    for index, row in processing_status.iterrows():
-        athlete_id = int(row['athlete_id'])
-        if athlete_id != 0 and row['status'] in ["none", "processing"]:
-            try:
-                transform_athlete_data(athlete_id, populate_all_from_files=1)
-                athletes_processed += 1
-                # Only mark as processed if transform was successful
-                processing_status.at[index, 'status'] = 'processed'
-                write_db_replace(processing_status, 'processing_status')
-            except Exception as e:
-                logger.error(f"Error processing athlete {athlete_id}: {e}")
-                continue
+    reports = []
+    try:
+        with HeldTables(ANALYTICS_TABLES, owner=worker_id) as tables, LeaseKeeper(worker_id) as leases:
+            # Leases are extended while the transforms run, however long they take
+            def claimed_athletes():
+                while (not tables.contended()
+                       and (row := claim_next([STATUS_NONE, STATUS_PROCESSING], worker_id, exclude=failed)) is not None):
+                    leases.hold(row['athlete_id'])
+                    yield int(row['athlete_id'])
+            
+            for report in transform_reports(claimed_athletes()):
+                reports.append(report)
+                athlete_id = report['athlete_id']
+                if report['error'] is None:
+                    # Only mark as processed if transform was successful
+                    released = leases.release(athlete_id, STATUS_PROCESSED)
+                else:
+                    logger.error(f"Error processing athlete {athlete_id}: {report['error']}")
+                    released = leases.release(athlete_id)
+                    failed.add(str(athlete_id))
+                if not released:
+                    logger.error(f"Lease on athlete {athlete_id} was lost during its transform; "
+                                 f"its status was left to the worker that took it over")
+                    lost.append(athlete_id)
+    except TablesBusy as e:
+        logger.info(f"Processing skipped, the analytics tables are being rebuilt: {e}")
+        return 'Processing skipped, the analytics tables are being rebuilt'
     
     summary = f"""
     Processing Complete:
     ===================
-    Athletes processed: {athletes_processed}
+    Athletes processed: {len(reports) - len(failed)}
+    Athletes failed: {len(failed)}
+    Leases lost: {lost}
+    Total processing time: {time.time() - start_time:.2f} seconds
+    {format_reports(reports)}
+    """
+    return summary
+
+def rebuild_analytics_tables():
+    """Recompute the analytics tables for every processed athlete and publish them at once.
+    
+    Each athlete is transformed into the shadow tables, which are swapped in
+    only when none of them raised, so the live tables keep serving the
+    previous cohort for the whole rebuild. Athletes without usable data are
+    skipped. The tables are held exclusively from before the athletes are
+    listed until the swap (see table_leases), so no per-athlete transform
+    writes rows the swap would discard, and no other rebuild or
+    publish_tables drops the shadow tables.
+    """
+    start_time = time.time()
+    try:
+        with HeldTables(ANALYTICS_TABLES, exclusive=True, wait_seconds=LEASE_WAIT_SECONDS):
+            athlete_ids = [int(row['athlete_id']) for row in list_jobs([STATUS_PROCESSED])]
+            
+            create_shadow_tables(ANALYTICS_TABLES)
+            reports = list(transform_reports(athlete_ids, shadow=True))
+            failed = [r['athlete_id'] for r in reports if r['error']]
+            # Processed athletes without usable data (no file, no profile) have no rows to rebuild
+            skipped = [r['athlete_id'] for r in reports if not r['error'] and not r['transformed']]
+            
+            if failed:
+                drop_shadow_tables(ANALYTICS_TABLES)
+                return f'Rebuild abandoned, {len(failed)} of {len(athlete_ids)} athletes failed: {failed}'
+            
+            swap_shadow_tables(ANALYTICS_TABLES)
+    except TablesBusy as e:
+        logger.error(f"Rebuild not started: {e}")
+        return f'Rebuild not started, the analytics tables are held by another writer: {e}'
+    
+    summary = f"""
+    Rebuild Complete:
+    =================
+    Athletes rebuilt: {len(athlete_ids) - len(skipped)}
+    Athletes skipped, no usable data: {skipped}
     Total processing time: {time.time() - start_time:.2f} seconds
+    {format_reports(reports)}
     """
-    return summary
\ No newline at end of file
+    logger.info(summary)
+    return summary
@@ -1,4 +1,5 @@
-from sql_methods import db, get_db_connection
+from sql_methods import db, cached_read_db
+from cohort_stats import table_row_count, athlete_last_block, block_pb_date, cohort_means
 import datetime
 import pandas as pd
 import io
@@ -67,67 +68,38 @@ def athletevsbest(athlete_id):
         logger.info(f"Starting visualization for athlete {athlete_id}")
         
         with current_app.app_context():
-            engine = get_db_connection()
-            
-            # Get features blocks for this athlete
-            features_blocks = pd.read_sql(
-                "SELECT * FROM features_blocks",
-                engine
-            )
-            logger.info(f"Found {len(features_blocks)} total feature blocks")
-            logger.info(f"Features blocks columns: {features_blocks.columns.tolist()}")
-            logger.info(f"Sample athlete_ids in features_blocks: {features_blocks['athlete_id'].head().tolist()}")
-            logger.info(f"athlete_id type in features_blocks: {features_blocks['athlete_id'].dtype}")
-            
-            # Convert athlete_id column to string for comparison
-            features_blocks['athlete_id'] = features_blocks['athlete_id'].astype(str)
-            
-            if len(features_blocks) == 0:
+            # Cohort statistics are queried from a snapshot of features_blocks
+            total_blocks = table_row_count('features_blocks')
+            logger.info(f"Found {total_blocks} total feature blocks")
+            
+            if total_blocks == 0:
                 logger.error(f"No feature blocks found in database")
                 return None
-                
-            # Get metadata blocks
-            metadata_blocks = pd.read_sql(
-                "SELECT * FROM metadata_blocks",
-                engine
-            )
-            logger.info(f"Found {len(metadata_blocks)} metadata blocks")
             
             # Get model outputs (this can be empty, we'll handle it)
-            try:
-                model_outputs = pd.read_sql(
-                    "SELECT * FROM model_outputs",
-                    engine
-                )
-            except:
+            model_outputs = cached_read_db('model_outputs')
+            if model_outputs.empty:
                 logger.warning("Could not read model_outputs table, using default values")
                 model_outputs = pd.DataFrame(columns=['y_name', 'feature_name', 'importance'])
             
             logger.info(f"Found {len(model_outputs)} model outputs")
             
             # Get this athlete's last block
-            this_athlete_blocks = features_blocks[features_blocks['athlete_id']==athlete_id]
-            logger.info(f"Found {len(this_athlete_blocks)} blocks for athlete {athlete_id}")
-            if len(this_athlete_blocks) > 0:
-                logger.info(f"Sample of athlete's block data: {this_athlete_blocks.iloc[-1].to_dict()}")
-            
-            if len(this_athlete_blocks) == 0:
+            this_athlete_last_block = athlete_last_block(athlete_id)
+            if this_athlete_last_block is None:
                 logger.warning(f"No blocks found for athlete {athlete_id}, using empty values")
-                this_athlete_last_block = pd.Series(0.0, index=features_blocks.columns)
+                this_athlete_last_block = pd.Series(dtype=float)
             else:
-                this_athlete_last_block = this_athlete_blocks.iloc[-1]
+                logger.info(f"Sample of athlete's block data: {this_athlete_last_block.to_dict()}")
             
             # Get block dates
-            try:
-                block_metadata = metadata_blocks[
-                    metadata_blocks['block_id'] == this_athlete_last_block['block_id']
-                ].iloc[0]
-                end_date = block_metadata['pb_date']
-                start_date = end_date - datetime.timedelta(days=91)
-            except (KeyError, IndexError):
+            end_date = None
+            if 'block_id' in this_athlete_last_block:
+                end_date = block_pb_date(this_athlete_last_block['block_id'])
+            if end_date is None or pd.isna(end_date):
                 logger.warning("Could not find block metadata, using current date")
                 end_date = datetime.datetime.now()
-                start_date = end_date - datetime.timedelta(days=91)
+            start_date = end_date - datetime.timedelta(days=91)
             
             # Get feature importance for vdot
             if 'y_name' in model_outputs.columns and len(model_outputs) > 0:
@@ -156,23 +128,8 @@ def athletevsbest(athlete_id):
             
             logger.info(f"Processing features: {list(features['feature_name'])[:5]}")  # Show first 5 features
             
-            # Get top and bottom performers
-            if 'y_vdot' in features_blocks.columns:
-                # Sort by vdot and ensure we have valid values
-                valid_blocks = features_blocks[features_blocks['y_vdot'].notna()]
-                if len(valid_blocks) > 0:
-                    top_ten_percent = valid_blocks.sort_values(['y_vdot'], ascending=[False]).head(max(1, round(0.1*len(valid_blocks))))
-                    bottom_ten_percent = valid_blocks.sort_values(['y_vdot'], ascending=[True]).head(max(1, round(0.1*len(valid_blocks))))
-                else:
-                    # If no valid vdot values, use empty DataFrames
-                    top_ten_percent = features_blocks.head(0)
-                    bottom_ten_percent = features_blocks.head(0)
-            else:
-                # If no y_vdot column, use empty DataFrames with same columns
-                top_ten_percent = features_blocks.head(0)
-                bottom_ten_percent = features_blocks.head(0)
-            
-            logger.info(f"Found {len(top_ten_percent)} blocks in top 10% and {len(bottom_ten_percent)} blocks in bottom 10%")
+            # Mean of each charted feature over the top and bottom 10% of performers
+            cohort = cohort_means('y_vdot', list(features['feature_name'].head(20)))
             
             visualisation_outputs = pd.DataFrame()
             processed_features = 0
@@ -195,8 +152,8 @@ def athletevsbest(athlete_id):
                     logger.debug(f"Error getting score for {feature_name}, using 0.0")
                     
                 try:
-                    top_ten_percent_value = top_ten_percent[feature_name].mean() if feature_name in top_ten_percent else 0.0
-                    bottom_ten_percent_value = bottom_ten_percent[feature_name].mean() if feature_name in bottom_ten_percent else 0.0
+                    top_ten_percent_value = cohort.at[feature_name, 'top'] if feature_name in cohort.index else 0.0
+                    bottom_ten_percent_value = cohort.at[feature_name, 'bottom'] if feature_name in cohort.index else 0.0
                     logger.debug(f"Feature {feature_name} - top: {top_ten_percent_value}, bottom: {bottom_ten_percent_value}")
                 except KeyError:
                     top_ten_percent_value = 0.0
@@ -317,67 +274,38 @@ def athletevsbestimprovement(athlete_id):
         logger.info(f"Starting improvement visualization for athlete {athlete_id}")
         
         with current_app.app_context():
-            engine = get_db_connection()
-            
-            # Get features blocks for this athlete
-            features_blocks = pd.read_sql(
-                "SELECT * FROM features_blocks",
-                engine
-            )
-            logger.info(f"Found {len(features_blocks)} total feature blocks")
-            logger.info(f"Features blocks columns: {features_blocks.columns.tolist()}")
-            logger.info(f"Sample athlete_ids in features_blocks: {features_blocks['athlete_id'].head().tolist()}")
-            logger.info(f"athlete_id type in features_blocks: {features_blocks['athlete_id'].dtype}")
-            
-            # Convert athlete_id column to string for comparison
-            features_blocks['athlete_id'] = features_blocks['athlete_id'].astype(str)
-            
-            if len(features_blocks) == 0:
+            # Cohort statistics are queried from a snapshot of features_blocks
+            total_blocks = table_row_count('features_blocks')
+            logger.info(f"Found {total_blocks} total feature blocks")
+            
+            if total_blocks == 0:
                 logger.error(f"No feature blocks found in database")
                 return None
-                
-            # Get metadata blocks
-            metadata_blocks = pd.read_sql(
-                "SELECT * FROM metadata_blocks",
-                engine
-            )
-            logger.info(f"Found {len(metadata_blocks)} metadata blocks")
             
             # Get model outputs (this can be empty, we'll handle it)
-            try:
-                model_outputs = pd.read_sql(
-                    "SELECT * FROM model_outputs",
-                    engine
-                )
-            except:
+            model_outputs = cached_read_db('model_outputs')
+            if model_outputs.empty:
                 logger.warning("Could not read model_outputs table, using default values")
                 model_outputs = pd.DataFrame(columns=['y_name', 'feature_name', 'importance'])
             
             logger.info(f"Found {len(model_outputs)} model outputs")
             
             # Get this athlete's last block
-            this_athlete_blocks = features_blocks[features_blocks['athlete_id']==athlete_id]
-            logger.info(f"Found {len(this_athlete_blocks)} blocks for athlete {athlete_id}")
-            if len(this_athlete_blocks) > 0:
-                logger.info(f"Sample of athlete's block data: {this_athlete_blocks.iloc[-1].to_dict()}")
-            
-            if len(this_athlete_blocks) == 0:
+            this_athlete_last_block = athlete_last_block(athlete_id)
+            if this_athlete_last_block is None:
                 logger.warning(f"No blocks found for athlete {athlete_id}, using empty values")
-                this_athlete_last_block = pd.Series(0.0, index=features_blocks.columns)
+                this_athlete_last_block = pd.Series(dtype=float)
             else:
-                this_athlete_last_block = this_athlete_blocks.iloc[-1]
+                logger.info(f"Sample of athlete's block data: {this_athlete_last_block.to_dict()}")
             
             # Get block dates
-            try:
-                block_metadata = metadata_blocks[
-                    metadata_blocks['block_id'] == this_athlete_last_block['block_id']
-                ].iloc[0]
-                end_date = block_metadata['pb_date']
-                start_date = end_date - datetime.timedelta(days=91)
-            except (KeyError, IndexError):
+            end_date = None
+            if 'block_id' in this_athlete_last_block:
+                end_date = block_pb_date(this_athlete_last_block['block_id'])
+            if end_date is None or pd.isna(end_date):
                 logger.warning("Could not find block metadata, using current date")
                 end_date = datetime.datetime.now()
-                start_date = end_date - datetime.timedelta(days=91)
+            start_date = end_date - datetime.timedelta(days=91)
             
             # Get feature importance for vdot_delta
             if 'y_name' in model_outputs.columns and len(model_outputs) > 0:
@@ -406,23 +334,8 @@ def athletevsbestimprovement(athlete_id):
             
             logger.info(f"Processing features: {list(features['feature_name'])[:5]}")  # Show first 5 features
             
-            # Get top and bottom improvers
-            if 'y_vdot_delta' in features_blocks.columns:
-                # Sort by vdot_delta and ensure we have valid values
-                valid_blocks = features_blocks[features_blocks['y_vdot_delta'].notna()]
-                if len(valid_blocks) > 0:
-                    top_ten_percent = valid_blocks.sort_values(['y_vdot_delta'], ascending=[False]).head(max(1, round(0.1*len(valid_blocks))))
-                    bottom_ten_percent = valid_blocks.sort_values(['y_vdot_delta'], ascending=[True]).head(max(1, round(0.1*len(valid_blocks))))
-                else:
-                    # If no valid vdot_delta values, use empty DataFrames
-                    top_ten_percent = features_blocks.head(0)
-                    bottom_ten_percent = features_blocks.head(0)
-            else:
-                # If no y_vdot_delta column, use empty DataFrames with same columns
-                top_ten_percent = features_blocks.head(0)
-                bottom_ten_percent = features_blocks.head(0)
-            
-            logger.info(f"Found {len(top_ten_percent)} blocks in top 10% and {len(bottom_ten_percent)} blocks in bottom 10%")
+            # Mean of each charted feature over the top and bottom 10% of improvers
+            cohort = cohort_means('y_vdot_delta', list(features['feature_name'].head(20)))
             
             visualisation_outputs = pd.DataFrame()
             
@@ -441,12 +354,12 @@ def athletevsbestimprovement(athlete_id):
                     athlete_score = 0.0
                     
                 try:
-                    top_ten_percent_value = top_ten_percent[feature_name].mean() if feature_name in top_ten_percent else 0.0
+                    top_ten_percent_value = cohort.at[feature_name, 'top'] if feature_name in cohort.index else 0.0
                 except KeyError:
                     top_ten_percent_value = 0.0
                     
                 try:
-                    bottom_ten_percent_value = bottom_ten_percent[feature_name].mean() if feature_name in bottom_ten_percent else 0.0
+                    bottom_ten_percent_value = cohort.at[feature_name, 'bottom'] if feature_name in cohort.index else 0.0
                 except KeyError:
                     bottom_ten_percent_value = 0.0
                 
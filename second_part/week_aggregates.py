@@ -0,0 +1,160 @@
+"""
+Weekly training aggregates computed in the database.
+
+aggregate_weeks() is the database counterpart of extract_weeks_features: a
+single GROUP BY week_id over one athlete's rows of an activity feature table
+returns the counts, sums and means for every week, and a vectorized pass in
+pandas turns them into the same f_* columns.
+
+extract_weeks_features only averages a column once some activity in the block,
+up to and including that week, has produced it (otherwise the feature is 0.0).
+The query counts non-null values per week so that rule can be replayed with a
+cumulative sum.
+"""
+import logging
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from sqlalchemy import case, column, func, select, table
+
+logger = logging.getLogger(__name__)
+
+RUN_TYPE = 2
+
+# Summed per week with mean and sample stdev, for runs and non-runs
+WEEK_STAT_COLUMNS = ['distance', 'elapsed_time']
+
+ZONE_COLUMNS = [f'time_in_z{zone}' for zone in range(1, 6)]
+
+# Feature -> activity column averaged over the week's runs
+RUN_MEAN_FEATURES = {
+    'f_run_mean_hr': 'mean_hr',
+    'f_run_stdev_hr': 'stdev_hr',
+    'f_run_freq_hr': 'freq_hr',
+    'f_mean_elevation': 'elevation',
+    'f_stdev_elevation': 'stdev_elevation',
+    'f_freq_elevation': 'freq_elevation',
+    'f_pace': 'pace',
+    'f_stdev_pace': 'stdev_pace',
+    'f_freq_pace': 'freq_pace',
+    'f_cadence': 'cadence',
+    'f_athlete_count': 'athlete_count'
+}
+
+# Feature -> activity column summed over the week's runs
+RUN_SUM_FEATURES = {'f_sum_elevation': 'elevation'}
+
+# Feature -> activity column averaged over the week's non-runs
+NON_RUN_MEAN_FEATURES = {
+    'f_non_run_mean_hr': 'mean_hr',
+    'f_non_run_stdev_hr': 'stdev_hr',
+    'f_non_run_freq_hr': 'freq_hr'
+}
+
+OPTIONAL_COLUMNS = sorted(
+    set(ZONE_COLUMNS) | set(RUN_MEAN_FEATURES.values()) | set(NON_RUN_MEAN_FEATURES.values())
+)
+
+def build_week_aggregate_query(table_name: str, athlete_id, columns: List[str], non_run_types: List[int]):
+    """One GROUP BY week_id returning the raw weekly aggregates for an athlete."""
+    optional = [col for col in OPTIONAL_COLUMNS if col in columns]
+    t = table(table_name, *[column(name) for name in
+                            ['athlete_id', 'week_id', 'activity_type'] + WEEK_STAT_COLUMNS + optional])
+    groups = {'run': t.c.activity_type == RUN_TYPE, 'non_run': t.c.activity_type != RUN_TYPE}
+
+    aggregates = []
+    for group, is_group in groups.items():
+        aggregates.append(func.count(case((is_group, 1))).label(f'n_{group}'))
+        for col in WEEK_STAT_COLUMNS:
+            value = case((is_group, t.c[col]))
+            aggregates += [
+                func.sum(value).label(f'{group}_sum_{col}'),
+                func.count(value).label(f'{group}_count_{col}'),
+                func.sum(value * value).label(f'{group}_sumsq_{col}')
+            ]
+        for col in optional:
+            aggregates.append(func.avg(case((is_group, t.c[col]))).label(f'{group}_avg_{col}'))
+    for col in optional:
+        aggregates.append(func.count(t.c[col]).label(f'present_{col}'))
+    for col in RUN_SUM_FEATURES.values():
+        if col in optional:
+            aggregates.append(func.sum(case((groups['run'], t.c[col]))).label(f'run_sum_{col}'))
+    for activity_type in non_run_types:
+        aggregates.append(
+            func.count(case((t.c.activity_type == activity_type, 1))).label(f'type_{activity_type}')
+        )
+
+    return (
+        select(t.c.week_id, *aggregates)
+        .where(t.c.athlete_id == str(athlete_id))
+        .group_by(t.c.week_id)
+    )
+
+def aggregate_weeks(conn, table_name: str, athlete_id, weeks: pd.DataFrame, activities: pd.DataFrame) -> pd.DataFrame:
+    """Weekly features for the weeks in `weeks` from the athlete's rows in table_name.
+
+    weeks holds the athlete_id, block_id and week_id of every week in processing
+    order, including weeks without activities; activities is the frame that was
+    written to table_name and only decides which columns exist.
+    """
+    if weeks.empty:
+        return weeks
+
+    columns = list(activities.columns)
+    non_run_types = []
+    if 'activity_type' in columns:
+        types = activities.loc[activities['activity_type'] != RUN_TYPE, 'activity_type'].dropna().unique()
+        non_run_types = sorted(int(activity_type) for activity_type in types)
+
+    query = build_week_aggregate_query(table_name, athlete_id, columns, non_run_types)
+    agg = pd.DataFrame(conn.execute(query).mappings().all())
+    agg = (agg.set_index('week_id') if not agg.empty else pd.DataFrame(columns=query.selected_columns.keys()[1:]))
+    agg = agg.reindex(weeks['week_id']).reset_index(drop=True).astype(float)
+    logger.info(f"Aggregated {len(agg)} weeks of {table_name} for athlete {athlete_id} in SQL")
+
+    counts = [col for col in agg.columns if col.startswith(('n_', 'present_', 'type_')) or '_count_' in col]
+    agg[counts] = agg[counts].fillna(0)
+    block_ids = weeks['block_id'].to_numpy()
+
+    def when_present(col, values):
+        """values where col existed in the block's activities by that week, else 0.0."""
+        if f'present_{col}' not in agg:
+            return pd.Series(0.0, index=agg.index)
+        return values.where(agg[f'present_{col}'].groupby(block_ids).cumsum() > 0, 0.0)
+
+    features: Dict[str, pd.Series] = {
+        'athlete_id': weeks['athlete_id'].reset_index(drop=True),
+        'block_id': weeks['block_id'].reset_index(drop=True),
+        'week_id': weeks['week_id'].reset_index(drop=True),
+        'f_total_runs': agg['n_run'].astype(int)
+    }
+
+    for group in ['run', 'non_run']:
+        has_rows = agg[f'n_{group}'] > 0
+        if not has_rows.any():
+            continue
+        for col in WEEK_STAT_COLUMNS:
+            total = agg[f'{group}_sum_{col}']
+            count = agg[f'{group}_count_{col}']
+            variance = (agg[f'{group}_sumsq_{col}'] - total ** 2 / count) / (count - 1)
+            features[f'f_{group}_total_{col}'] = total.fillna(0).where(has_rows)
+            features[f'f_{group}_avg_{col}'] = (total / count).where(has_rows & (count > 0))
+            features[f'f_{group}_stdev_{col}'] = np.sqrt(variance.clip(lower=0)).where(count > 1)
+
+    for suffix, group in [('runs', 'run'), ('non_runs', 'non_run')]:
+        for col in ZONE_COLUMNS:
+            features[f'f_{col}_{suffix}'] = when_present(col, agg.get(f'{group}_avg_{col}'))
+
+    for activity_type in non_run_types:
+        type_counts = agg[f'type_{activity_type}']
+        if (type_counts > 0).any():
+            features[f'f_activity_type_{activity_type}'] = type_counts.where(type_counts > 0)
+
+    for feature, col in RUN_MEAN_FEATURES.items():
+        features[feature] = when_present(col, agg.get(f'run_avg_{col}'))
+    for feature, col in RUN_SUM_FEATURES.items():
+        features[feature] = when_present(col, agg.get(f'run_sum_{col}', pd.Series(dtype=float)).fillna(0.0))
+    for feature, col in NON_RUN_MEAN_FEATURES.items():
+        features[feature] = when_present(col, agg.get(f'non_run_avg_{col}'))
+
+    return pd.DataFrame(features)
@@ -0,0 +1,262 @@
+"""
+Weekly cube of running totals, for training-window queries.
+
+athlete_weekly_cube holds one row per week of an athlete's block '0' (the
+weeks of all_athlete_weeks) with the totals of every week up to and
+including it (cum_*):
+    run_distance, run_time, non_run_distance, non_run_time
+        - summed distance and elapsed time of the week's activities
+    runs, non_runs            - number of activities
+    *_sq                      - summed squares of each activity's distance
+                                and time, for their spread
+    run_z1_time .. run_z5_time - seconds of running in each HR zone
+                                (time_in_zN x elapsed_time)
+    run_hr, run_hr_count      - summed mean HR of the runs that have one
+    *_week_sq, *_week_t       - the weekly total squared, and times the week
+                                number, for the spread and slope of weekly
+                                totals
+    type_<activity_type>      - number of activities of each type, added as
+                                columns on demand
+Any window of whole weeks is then the difference of two rows, so its
+totals, means, spreads, ramp slope and taper factor cost the same for four
+weeks as for four years, without reprocessing the athlete. Windows are
+weeks of the athlete's week grid, starting on week_start, so a window
+ending on a date covers the whole week that date falls in.
+"""
+import logging
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+RUN_TYPE = 2
+
+# Weeks at the end of a window compared with the ones before it, as for the PB blocks
+TAPER_WEEKS = 2
+
+ZONES = range(1, 6)
+
+# Weekly totals whose spread, slope and taper factor are available
+TREND_VALUES = ['run_distance', 'run_time', 'non_run_distance', 'non_run_time']
+
+# Summed per week
+SUM_VALUES = (TREND_VALUES
+              + [f'{name}_sq' for name in TREND_VALUES]
+              + [f'run_z{zone}_time' for zone in ZONES]
+              + ['run_hr'])
+COUNT_VALUES = ['runs', 'non_runs', 'run_hr_count']
+MOMENT_VALUES = [f'{name}_week_{moment}' for name in TREND_VALUES for moment in ('sq', 't')]
+
+TYPE_PREFIX = 'type_'
+
+def week_number(week_id: str) -> int:
+    """k of a block '0' week id '0_k'."""
+    return int(week_id.rsplit('_', 1)[1])
+
+def activity_values(activities: pd.DataFrame, name: str) -> np.ndarray:
+    """A column of activity rows as float64, NaN where missing."""
+    if name not in activities.columns:
+        return np.full(len(activities), np.nan)
+    return activities[name].to_numpy(dtype='float64', na_value=np.nan)
+
+def week_totals(activities: pd.DataFrame, week_ids: List[str]) -> pd.DataFrame:
+    """SUM_VALUES, COUNT_VALUES and type counts of each of week_ids, over the activity rows."""
+    if activities.empty:
+        totals = {name: np.zeros(len(week_ids)) for name in SUM_VALUES}
+        totals.update({name: np.zeros(len(week_ids), dtype='int64') for name in COUNT_VALUES})
+        return pd.DataFrame(totals, index=week_ids)
+
+    weeks = pd.Categorical(activities['week_id'].astype(str), categories=week_ids).codes
+    in_weeks = weeks >= 0
+    weeks = weeks[in_weeks]
+    activities = activities[in_weeks]
+
+    types = activity_values(activities, 'activity_type')
+    is_run = types == RUN_TYPE
+    distance = np.nan_to_num(activity_values(activities, 'distance'))
+    elapsed_time = np.nan_to_num(activity_values(activities, 'elapsed_time'))
+    mean_hr = activity_values(activities, 'mean_hr')
+    has_hr = is_run & ~np.isnan(mean_hr)
+
+    values = {}
+    for group, in_group in (('run', is_run), ('non_run', ~is_run)):
+        values[f'{group}_distance'] = np.where(in_group, distance, 0.0)
+        values[f'{group}_time'] = np.where(in_group, elapsed_time, 0.0)
+    for name in TREND_VALUES:
+        values[f'{name}_sq'] = values[name] ** 2
+    for zone in ZONES:
+        share = np.nan_to_num(activity_values(activities, f'time_in_z{zone}'))
+        values[f'run_z{zone}_time'] = np.where(is_run, share * elapsed_time, 0.0)
+    values['run_hr'] = np.where(has_hr, mean_hr, 0.0)
+
+    def count(rows: np.ndarray) -> np.ndarray:
+        return np.bincount(weeks[rows], minlength=len(week_ids)).astype('int64')
+
+    totals = {name: np.bincount(weeks, weights=values[name], minlength=len(week_ids)) for name in SUM_VALUES}
+    totals.update(runs=count(is_run), non_runs=count(~is_run), run_hr_count=count(has_hr))
+    for activity_type in np.unique(types[~np.isnan(types)]):
+        totals[f'{TYPE_PREFIX}{int(activity_type)}'] = count(types == activity_type)
+    return pd.DataFrame(totals, index=week_ids)
+
+def cumulative_cube(totals: pd.DataFrame, start_day: int, athlete_id) -> pd.DataFrame:
+    """The cube rows of weekly totals (week_totals, or its chunks concatenated) of weeks starting on start_day."""
+    if totals.empty:
+        return pd.DataFrame()
+
+    week_index = np.array([week_number(week_id) for week_id in totals.index])
+    type_columns = sorted((col for col in totals.columns if col.startswith(TYPE_PREFIX)),
+                          key=lambda col: int(col[len(TYPE_PREFIX):]))
+    totals = totals.assign(**{col: totals[col].fillna(0).astype('int64') for col in type_columns})
+    for name in TREND_VALUES:
+        totals[f'{name}_week_sq'] = totals[name] ** 2
+        totals[f'{name}_week_t'] = week_index * totals[name]
+
+    running = totals[SUM_VALUES + MOMENT_VALUES + COUNT_VALUES + type_columns].cumsum()
+    cube = pd.DataFrame({
+        'athlete_id': str(athlete_id),
+        'week_id': totals.index,
+        'week_index': week_index,
+        'week_start': pd.to_datetime([date.fromordinal(start_day + 7 * int(k)) for k in week_index])
+    })
+    return pd.concat([cube, running.add_prefix('cum_').reset_index(drop=True)], axis=1)
+
+def build_weekly_cube(activities: pd.DataFrame, week_ids: List[str], start_day: Optional[int],
+                      athlete_id) -> pd.DataFrame:
+    """athlete_weekly_cube rows of block '0', from its activity rows and week ids."""
+    if not week_ids or start_day is None:
+        return pd.DataFrame()
+    return cumulative_cube(week_totals(activities, week_ids), start_day, athlete_id)
+
+def finite(value: float) -> Optional[float]:
+    """value as a float, None where it is undefined."""
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+def sample_stdev(n: float, total: float, squares: float) -> float:
+    """Sample standard deviation of n values from their sum and sum of squares; NaN below two values."""
+    if n < 2:
+        return np.nan
+    return float(np.sqrt(max(squares - total * total / n, 0.0) / (n - 1)))
+
+class WeeklyCube:
+    """One athlete's athlete_weekly_cube rows, answering window queries.
+
+    Windows are given as the first and last week number, both included.
+    """
+
+    def __init__(self, cube: pd.DataFrame):
+        cube = cube.sort_values('week_index')
+        week_index = cube['week_index'].to_numpy(dtype='int64')
+        if not np.array_equal(week_index, np.arange(len(cube))):
+            raise ValueError("Weekly cube rows are not consecutive weeks from 0")
+        self.n_weeks = len(cube)
+        self.start = pd.Timestamp(cube['week_start'].iloc[0]).date() if len(cube) else None
+        # Running totals with a zero row in front, so week k's total is running[k + 1] - running[k]
+        self.running = {
+            col[len('cum_'):]: np.concatenate([[0.0], cube[col].fillna(0).to_numpy(dtype='float64')])
+            for col in cube.columns if col.startswith('cum_')
+        }
+
+    def __len__(self) -> int:
+        return self.n_weeks
+
+    def total(self, name: str, first: int, last: int) -> float:
+        """Sum of a cube value over the weeks first to last."""
+        running = self.running.get(name)
+        if running is None:
+            return 0.0
+        return float(running[last + 1] - running[first])
+
+    def week_of(self, day: date) -> int:
+        """Number of the week day falls in."""
+        return (day - self.start).days // 7
+
+    def last_weeks(self, n_weeks: int, end: Optional[date] = None) -> Tuple[int, int]:
+        """First and last week of the n_weeks up to the week of end, or up to the last week."""
+        if n_weeks < 1:
+            raise ValueError("A window needs at least one week")
+        last = len(self) - 1 if end is None else min(self.week_of(end), len(self) - 1)
+        if last < 0:
+            raise ValueError(f"No weeks up to {end}")
+        return max(0, last - n_weeks + 1), last
+
+    def slope(self, name: str, first: int, last: int) -> float:
+        """Least-squares slope of a weekly total against the week number; NaN below two weeks.
+
+        With m weeks centred on their mean week t, the slope is
+        (sum(t * y) - t * sum(y)) / (m * (m ** 2 - 1) / 12).
+        """
+        m = last - first + 1
+        if m < 2:
+            return np.nan
+        centre = (first + last) / 2
+        return ((self.total(f'{name}_week_t', first, last) - centre * self.total(name, first, last))
+                / (m * (m ** 2 - 1) / 12))
+
+    def weekly_stdev(self, name: str, first: int, last: int) -> float:
+        """Sample standard deviation of a weekly total."""
+        return sample_stdev(last - first + 1, self.total(name, first, last), self.total(f'{name}_week_sq', first, last))
+
+    def taper_factor(self, name: str, first: int, last: int, taper_weeks: int = TAPER_WEEKS) -> float:
+        """Mean weekly total of the last taper_weeks over that of the weeks before; 0 if that is 0."""
+        split = last - taper_weeks
+        if split < first:
+            return np.nan
+        mean_before = self.total(name, first, split) / (split - first + 1)
+        mean_taper = self.total(name, split + 1, last) / taper_weeks
+        return mean_taper / mean_before if mean_before else 0
+
+    def window(self, first: int, last: int, taper_weeks: int = TAPER_WEEKS) -> Dict:
+        """Aggregates of the weeks first to last, None where undefined."""
+        first, last = int(first), int(last)
+        if not 0 <= first <= last < len(self):
+            raise ValueError(f"Weeks {first} to {last} are outside the cube's {len(self)} weeks")
+        m = last - first + 1
+        summary = {
+            'first_week': first,
+            'last_week': last,
+            'weeks': m,
+            'start_date': (self.start + timedelta(weeks=first)).isoformat(),
+            'end_date': (self.start + timedelta(weeks=last + 1, days=-1)).isoformat()
+        }
+
+        for name in TREND_VALUES:
+            total = self.total(name, first, last)
+            summary[f'total_{name}'] = total
+            summary[f'mean_weekly_{name}'] = total / m
+            summary[f'stdev_weekly_{name}'] = finite(self.weekly_stdev(name, first, last))
+            summary[f'slope_{name}_before_taper'] = finite(self.slope(name, first, last - taper_weeks))
+            summary[f'taper_factor_{name}'] = finite(self.taper_factor(name, first, last, taper_weeks))
+
+        for group, count in (('run', 'runs'), ('non_run', 'non_runs')):
+            n = self.total(count, first, last)
+            summary[count] = int(n)
+            for measure in ('distance', 'time'):
+                total = self.total(f'{group}_{measure}', first, last)
+                summary[f'mean_{group}_{measure}'] = total / n if n else None
+                summary[f'stdev_{group}_{measure}'] = finite(
+                    sample_stdev(n, total, self.total(f'{group}_{measure}_sq', first, last)))
+
+        hr_count = self.total('run_hr_count', first, last)
+        summary['mean_run_hr'] = self.total('run_hr', first, last) / hr_count if hr_count else None
+        run_time = self.total('run_time', first, last)
+        for zone in ZONES:
+            summary[f'time_in_z{zone}_runs'] = self.total(f'run_z{zone}_time', first, last) / run_time if run_time else 0.0
+
+        summary['activity_types'] = {
+            name[len(TYPE_PREFIX):]: int(self.total(name, first, last))
+            for name in self.running if name.startswith(TYPE_PREFIX) and self.total(name, first, last)
+        }
+        return summary
+
+def load_weekly_cube(athlete_id) -> Optional[WeeklyCube]:
+    """The athlete's cube from athlete_weekly_cube, None if the athlete has none."""
+    from sql_methods import cached_read_db
+    cube = cached_read_db(
+        'athlete_weekly_cube',
+        'SELECT * FROM athlete_weekly_cube WHERE athlete_id = :athlete_id',
+        {'athlete_id': str(athlete_id)}
+    )
+    return WeeklyCube(cube) if not cube.empty else None
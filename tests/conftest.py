@@ -0,0 +1,9 @@
+# tests/conftest.py
+
+# The app's modules import each other by flat name, as they do when run from
+# second_part; tests of those modules import them the same way, so each is
+# loaded once.
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'second_part'))
@@ -0,0 +1,65 @@
+# tests/synthetic.py
+
+"""A synthetic athlete for the transform tests, written where transform_athlete_data reads it."""
+import json
+import random
+from datetime import datetime, timedelta
+import pandas as pd
+from sqlalchemy import inspect
+
+ATHLETE_ID = 5
+
+ZONES = {'heart_rate': {'zones': [{'min': 0, 'max': 130}, {'min': 130, 'max': 145}, {'min': 145, 'max': 160},
+                                  {'min': 160, 'max': 175}, {'min': 175, 'max': -1}]}}
+
+def make_activities(n_days, seed=0):
+    """Synthetic activities, newest first: mostly runs with laps and best efforts, some without HR."""
+    r = random.Random(seed)
+    activities = []
+    for day in range(n_days):
+        if r.random() > 0.6:
+            continue
+        activity_id = 1000 + day
+        start_date = (datetime(2023, 1, 1) + timedelta(days=day)).strftime('%Y-%m-%dT07:00:00Z')
+        kind = r.choices(['Run', 'Ride', 'Swim'], [6, 2, 1])[0]
+        distance = r.uniform(3000, 22000)
+        speed = r.uniform(2.5, 4.2) * (1 + day / 2000)
+        activity = {'id': activity_id, 'type': kind, 'start_date': start_date,
+                    'elapsed_time': int(distance / speed), 'distance': distance, 'average_speed': speed}
+        has_hr = r.random() < 0.8
+        if has_hr:
+            activity['average_heartrate'] = 120 + speed * 10 + r.uniform(-5, 5)
+        if kind == 'Run':
+            activity.update(average_cadence=r.uniform(80, 90), elev_high=r.uniform(50, 200),
+                            elev_low=r.uniform(0, 50), athlete_count=r.choice([1, 1, 2]))
+            activity['laps'] = [
+                {'total_elevation_gain': r.uniform(0, 20), 'average_speed': speed * r.uniform(0.9, 1.1),
+                 **({'average_heartrate': activity['average_heartrate'] + r.uniform(-10, 10)} if has_hr else {})}
+                for _ in range(max(1, int(distance // 1000)))
+            ]
+            activity['best_efforts'] = [
+                {'distance': effort, 'elapsed_time': int(effort / (speed * r.uniform(1.0, 1.08))),
+                 'start_date': start_date, 'activity': {'id': activity_id}}
+                for effort in (400, 1000, 5000, 10000) if distance >= effort
+            ]
+        activities.append(activity)
+    activities.reverse()
+    return activities
+
+def write_athlete(batches, athlete_id=ATHLETE_ID):
+    """Write ./data/athlete_<id>_activities.json with the athlete, zones and stats, and the activity batches."""
+    data = {'20240101_000000_athlete': [{'id': athlete_id, 'sex': 'M', 'weight': 70.0}],
+            '20240101_000000_zones': [ZONES], '20240101_000000_stats': [{}]}
+    with open(f'data/athlete_{athlete_id}_activities.json', 'w') as f:
+        json.dump({**data, **batches}, f)
+
+def read_tables(engine, table_names):
+    """The tables' rows without their surrogate key, in a fixed order, for comparing two transforms."""
+    present = inspect(engine).get_table_names()
+    tables = {}
+    for name in table_names:
+        df = pd.read_sql_table(name, engine) if name in present else pd.DataFrame()
+        df = df.drop(columns=['id'], errors='ignore')
+        keys = [col for col in ('athlete_id', 'block_id', 'week_id', 'activity_id') if col in df.columns]
+        tables[name] = df.sort_values(keys, kind='stable').reset_index(drop=True) if keys else df
+    return tables
@@ -0,0 +1,96 @@
+# tests/test_activity_cache.py
+
+import json
+import pytest
+import activity_cache
+
+def make_activity(activity_id, start_date, **extra):
+    return {'id': activity_id, 'type': 'Run', 'start_date': start_date, 'elapsed_time': 1500,
+            'distance': 5000.0, 'average_speed': 3.3, **extra}
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    monkeypatch.setattr(activity_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    filename = tmp_path / 'athlete_7_activities.json'
+    filename.write_text(json.dumps({
+        '20240101_000000_athlete': [{'id': 7, 'sex': 'F', 'weight': 55.0}],
+        '20240101_000000_zones': [{'heart_rate': {'zones': []}}],
+        '20240101_000000_stats': [{}],
+        '20240101_000000_detailed': [
+            make_activity(1, '2024-01-01T07:00:00Z', laps=[{'average_speed': 3.2}, {'average_speed': 3.4}],
+                          best_efforts=[{'distance': 400, 'elapsed_time': 100,
+                                         'start_date': '2024-01-01T07:00:00Z', 'activity': {'id': 1}}]),
+            make_activity(2, '2024-01-03T07:00:00Z', errors=['bad'])
+        ]
+    }))
+    return str(filename)
+
+def test_cached_athlete_data_round_trips(source):
+    athlete_data = activity_cache.load_cached_athlete_data(7, source)
+
+    assert athlete_data['sex'] == 'F'
+    assert [a['id'] for a in athlete_data['_Activities']] == [2, 1]
+    errored, run = athlete_data['_Activities']
+    assert errored['errors'] and 'laps' not in errored
+    assert run['laps'] == [{'average_speed': 3.2}, {'average_speed': 3.4}]
+    assert run['best_efforts'][0]['activity'] == {'id': 1}
+    assert 'average_heartrate' not in run
+
+    activities = activity_cache.read_activities(7, columns=['id', 'distance'])
+    assert list(activities.columns) == ['id', 'distance']
+
+def test_append_batch_merges_by_activity_id(source):
+    activity_cache.load_cached_athlete_data(7, source)
+
+    previous = activity_cache.source_signature(source)
+    all_data = json.loads(open(source).read())
+    batch = [make_activity(1, '2024-01-01T07:00:00Z', distance=6000.0), make_activity(3, '2024-01-05T07:00:00Z')]
+    all_data['20240102_000000_detailed'] = batch
+    with open(source, 'w') as f:
+        f.write(json.dumps(all_data, indent=2))
+    activity_cache.append_batch(7, source, '20240102_000000_detailed', batch, previous)
+
+    assert activity_cache.read_manifest(7)['source'] == activity_cache.source_signature(source)
+    activities = activity_cache.read_activities(7).set_index('id')
+    assert sorted(activities.index) == [1, 2, 3]
+    assert activities.loc[1, 'distance'] == 6000.0
+    assert activity_cache.read_activities(7, name='laps').empty
+
+def test_cached_activities_converts_only_the_positions_asked_for(source):
+    activity_cache.load_cached_athlete_data(7, source)
+    cached = activity_cache.CachedActivities(7)
+
+    order = cached.transform_order()
+    assert [cached.dicts([p])[0]['id'] for p in order] == [1]  # errored activity 2 left out
+
+    run, = cached.dicts(order)
+    assert run == activity_cache.cached_activity_dicts(7)[0]
+    light, = cached.dicts(order, laps=False, best_efforts=False)
+    assert 'laps' not in light and 'best_efforts' not in light
+    assert light['distance'] == 5000.0
+
+def test_fractional_times_survive_the_cache(source):
+    all_data = json.loads(open(source).read())
+    all_data['20240101_000000_detailed'][0].update(elapsed_time=1500.5, athlete_count=2)
+    all_data['20240101_000000_detailed'][0]['best_efforts'][0]['elapsed_time'] = 99.75
+    with open(source, 'w') as f:
+        f.write(json.dumps(all_data))
+
+    run = activity_cache.load_cached_athlete_data(7, source)['_Activities'][1]
+
+    assert run['elapsed_time'] == 1500.5
+    assert run['athlete_count'] == 2 and isinstance(run['athlete_count'], int)
+    assert run['best_efforts'][0]['elapsed_time'] == 99.75
+
+def test_cache_of_another_version_is_rebuilt(source):
+    activity_cache.load_cached_athlete_data(7, source)
+    manifest = activity_cache.read_manifest(7)
+    manifest['version'] = activity_cache.CACHE_VERSION - 1
+    with open(activity_cache.cache_path(7, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    assert activity_cache.read_manifest(7) is None
+
+    athlete_data = activity_cache.load_cached_athlete_data(7, source)
+
+    assert [a['id'] for a in athlete_data['_Activities']] == [2, 1]
+    assert activity_cache.read_manifest(7)['version'] == activity_cache.CACHE_VERSION
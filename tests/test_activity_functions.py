@@ -0,0 +1,47 @@
+# tests/test_activity_functions.py
+
+from statistics import stdev
+import numpy as np
+from sklearn.linear_model import LinearRegression
+from activity_functions import calculate_time_in_zones, get_run_activity_data, hr_estimator
+
+ZONES = [120, 140, 160, 175]
+
+def test_run_data_estimates_missing_lap_hr():
+    regressor = LinearRegression().fit(np.array([[2.5], [3.0], [3.5]]), np.array([[130.0], [145.0], [160.0]]))
+    laps = [
+        {'average_speed': 3.0, 'total_elevation_gain': 5.0, 'average_heartrate': 150.0},
+        {'average_speed': 3.4, 'total_elevation_gain': 12.0},
+        {'average_speed': 2.8, 'total_elevation_gain': 3.0, 'average_heartrate': 118.0},
+        {'average_speed': 3.6, 'total_elevation_gain': 9.0, 'average_heartrate': 178.0}
+    ]
+    activity = {'id': 1, 'type': 'Run', 'elapsed_time': 1800, 'distance': 6000.0, 'average_speed': 3.2,
+                'elev_high': 40.0, 'elev_low': 10.0, 'laps': laps}
+
+    run = get_run_activity_data(activity, ZONES, regressor)
+
+    hr = [150.0, regressor.predict([[3.4]])[0][0], 118.0, 178.0]
+    assert run.mean_hr == regressor.predict([[3.2]])[0][0]
+    assert np.isclose(run.stdev_hr, stdev(hr))
+    assert np.isclose(run.stdev_elevation, stdev([5.0, 12.0, 3.0, 9.0]))
+    assert run.elevation == 30.0
+    assert run.time_in_zones == [0.25, 0.0, 0.5, 0.0, 0.25]
+    assert run[:5] == (1, 2, 1800, 6000.0, run.mean_hr)
+
+    without_regressor = get_run_activity_data(activity, ZONES, None)
+    assert without_regressor.mean_hr is None
+    assert without_regressor.time_in_zones == [0.33, 0.0, 0.33, 0.0, 0.33]
+
+def test_time_in_zones_bounds():
+    assert calculate_time_in_zones(np.array([119, 120, 140, 159.5, 160, 175, np.nan, 200]), ZONES) == \
+        [0.12, 0.12, 0.25, 0.12, 0.38]
+    assert calculate_time_in_zones(np.array([]), ZONES) == [0] * 5
+
+def test_hr_estimator_matches_regressor_predictions():
+    regressor = LinearRegression().fit(np.array([[2.5], [3.0], [3.5], [4.1]]), np.array([[130.0], [145.0], [160.0], [171.0]]))
+    speeds = np.array([2.2, 3.1, 3.37, 4.8])
+
+    estimator = hr_estimator(regressor)
+
+    assert np.array_equal(estimator.predict(speeds), regressor.predict(speeds.reshape(-1, 1)).ravel())
+    assert hr_estimator(estimator) is estimator and hr_estimator(None) is None
@@ -0,0 +1,47 @@
+# tests/test_athlete_data_transformer.py
+
+import warnings
+import numpy as np
+import pandas as pd
+from scipy.stats import linregress
+from frame_dtypes import compact_frame
+from athlete_data_transformer import TAPER_WEEKS, before_taper_slopes, build_features_blocks
+
+def test_block_too_short_for_a_week_does_not_fail_the_transform():
+    metadata_blocks = pd.DataFrame({'athlete_id': '7', 'block_id': ['7_1', '7_2'],
+                                    'vdot': [50.0, 51.0], 'vdot_delta': [0.0, 1.0]})
+    # 7_2 has no weeks; the Int16 count of 7_1's weeks is all NA
+    features_weeks = compact_frame(pd.DataFrame({
+        'athlete_id': '7', 'block_id': '7_1', 'week_id': ['7_1_0', '7_1_1'],
+        'f_total_runs': pd.array([pd.NA, pd.NA], dtype='Int16'),
+        'f_run_total_distance': [0.0, 0.0]
+    }))
+    empty = pd.DataFrame({'athlete_id': pd.Series(dtype=str), 'block_id': pd.Series(dtype=str)})
+
+    blocks = build_features_blocks(metadata_blocks, features_weeks, features_weeks.iloc[:0],
+                                   empty, empty, '7')
+
+    assert '7_2' not in set(blocks.get('block_id', []))
+
+def test_before_taper_slopes_match_linregress_per_block():
+    rng = np.random.default_rng(0)
+    # Blocks of 3 to 10 weeks, so 1 to 8 weeks before the taper, one with a missing week
+    blocks = {f'7_{i}': n_weeks for i, n_weeks in enumerate(range(3, 11))}
+    features_weeks = pd.DataFrame({
+        'block_id': np.repeat(list(blocks), list(blocks.values())),
+        'f_run_total_distance': rng.uniform(0, 50000, sum(blocks.values())),
+        'f_run_mean_hr': rng.uniform(120, 170, sum(blocks.values()))
+    })
+    features_weeks.loc[features_weeks['block_id'] == '7_5', 'f_run_mean_hr'] = [150.0, np.nan] + [140.0] * 6
+    columns = ['f_run_total_distance', 'f_run_mean_hr']
+
+    slopes = before_taper_slopes(features_weeks, columns)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for block_id, weeks in features_weeks.groupby('block_id'):
+            for col in columns:
+                values = list(weeks[col][:-TAPER_WEEKS])
+                expected = linregress(range(len(values)), values).slope
+                assert np.isclose(slopes.loc[block_id, col], expected, rtol=1e-9, equal_nan=True), (block_id, col)
+    assert np.isnan(slopes.loc['7_0']).all() and np.isnan(slopes.loc['7_5', 'f_run_mean_hr'])
@@ -0,0 +1,75 @@
+# tests/test_cohort_stats.py
+
+import numpy as np
+import pandas as pd
+import pytest
+import cohort_stats
+import sql_methods
+
+pytest.importorskip('duckdb')
+
+@pytest.fixture
+def tables(monkeypatch, tmp_path):
+    """features_blocks and metadata_blocks in SQLite, with snapshots taken under tmp_path."""
+    monkeypatch.setenv('DATABASE_URL', f'sqlite:///{tmp_path}/test.db')
+    monkeypatch.setattr(cohort_stats, 'SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    monkeypatch.setattr(cohort_stats, '_snapshot_versions', {})
+    sql_methods.clear_read_cache()
+    r = np.random.default_rng(0)
+    # Athletes' blocks interleave, so an athlete's last block is not the table's last row
+    athlete_ids = [str(athlete_id) for athlete_id in r.choice([7, 8, 10], size=30)]
+    features_blocks = pd.DataFrame({
+        'athlete_id': athlete_ids,
+        'block_id': [f'{athlete_id}_{i}' for i, athlete_id in enumerate(athlete_ids)],
+        'y_vdot': r.permutation(np.linspace(40.0, 60.0, 30)),
+        'f_slope_run_distance': r.normal(size=30),
+        'f_extra': r.normal(size=30)
+    })
+    features_blocks.loc[[3, 11, 12, 25], 'y_vdot'] = np.nan
+    features_blocks.loc[[4, 11], 'f_extra'] = np.nan
+    metadata_blocks = pd.DataFrame({
+        'athlete_id': ['7', '7', '8', '7'],
+        'block_id': ['7_1', '7_2', '8_1', '7_1'],
+        'pb_date': pd.to_datetime(['2024-01-01', '2024-02-01', '2024-03-01', '2024-04-01'])
+    })
+    sql_methods.write_tables_atomic({'features_blocks': features_blocks, 'metadata_blocks': metadata_blocks})
+    return features_blocks
+
+def both_ways(monkeypatch, query):
+    """query() from the DuckDB snapshots and from the pandas fallback."""
+    with_duckdb = query()
+    monkeypatch.setattr(cohort_stats, 'duckdb', None)
+    return with_duckdb, query()
+
+@pytest.mark.parametrize('target, features', [
+    ('y_vdot', ['f_slope_run_distance', 'f_extra', 'f_absent']),
+    ('f_extra', ['y_vdot']),
+    ('y_absent', ['f_slope_run_distance', 'f_extra']),
+    ('y_vdot', ['f_absent'])
+])
+def test_cohort_means_match_pandas(tables, monkeypatch, target, features):
+    duckdb_means, pandas_means = both_ways(monkeypatch, lambda: cohort_stats.cohort_means(target, features, 0.2))
+
+    expected = cohort_stats.cohort_means_pandas(sql_methods.read_db('features_blocks'), target, features, 0.2)
+    pd.testing.assert_frame_equal(pandas_means, expected)
+    if expected.empty:
+        assert duckdb_means.empty
+    else:
+        pd.testing.assert_frame_equal(duckdb_means, expected)
+
+def test_last_block_and_pb_date_match_pandas(tables, monkeypatch):
+    def lookups():
+        return ([cohort_stats.athlete_last_block(athlete_id) for athlete_id in (7, '8', '10', '9')],
+                [cohort_stats.block_pb_date(block_id) for block_id in ('7_1', '8_1', '9_1')])
+    (duckdb_blocks, duckdb_dates), (pandas_blocks, pandas_dates) = both_ways(monkeypatch, lookups)
+
+    for athlete_id, duckdb_block, pandas_block in zip((7, '8', '10'), duckdb_blocks, pandas_blocks):
+        expected = tables[tables['athlete_id'] == str(athlete_id)].iloc[-1]
+        assert pandas_block['block_id'] == duckdb_block['block_id'] == expected['block_id']
+        pd.testing.assert_series_equal(duckdb_block, pandas_block, check_dtype=False, check_names=False)
+    assert duckdb_blocks[-1] is None and pandas_blocks[-1] is None
+
+    # The first of the duplicated 7_1 rows wins
+    assert duckdb_dates == pandas_dates[:2] + [None]
+    assert duckdb_dates[:2] == [pd.Timestamp('2024-01-01'), pd.Timestamp('2024-03-01')]
+    assert pandas_dates[-1] is None
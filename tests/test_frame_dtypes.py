@@ -0,0 +1,34 @@
+# tests/test_frame_dtypes.py
+
+import numpy as np
+import pandas as pd
+from frame_dtypes import compact_frame
+
+def test_compact_frame_applies_policy():
+    df = pd.DataFrame({
+        'athlete_id': ['1', '1'],
+        'week_id': ['0_0', '0_1'],
+        'activity_id': [123456789012, 123456789013],
+        'f_total_runs': [2, 0],
+        'f_activity_type_4': [1.0, np.nan],
+        'distance': [5000.5, 7000.25],
+        'y_vdot': [50.123456789, 51.0],
+        'sex': ['M', 'M']
+    })
+
+    compact = compact_frame(df)
+
+    assert compact['athlete_id'].dtype == 'category'
+    assert compact['week_id'].dtype == 'category'
+    assert compact['activity_id'].dtype == 'Int64'
+    assert compact['f_total_runs'].dtype == 'Int16'
+    assert compact['f_activity_type_4'].dtype == 'Int16' and compact['f_activity_type_4'].isna()[1]
+    assert compact['distance'].dtype == np.float32
+    assert compact['y_vdot'].dtype == np.float64
+    assert compact['sex'].dtype == object
+
+    many = pd.concat([df] * 500, ignore_index=True)
+    assert compact_frame(many).memory_usage(deep=True).sum() * 2 < many.memory_usage(deep=True).sum()
+
+def test_compact_frame_keeps_empty_frames():
+    assert compact_frame(pd.DataFrame()).empty
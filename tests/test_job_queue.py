@@ -0,0 +1,31 @@
+# tests/test_job_queue.py
+
+import time
+import pytest
+from sql_methods import get_db_connection
+from models import ProcessingStatus
+from job_queue import LeaseKeeper, STATUS_NONE, STATUS_PROCESSED, claim_next, enqueue_athlete, get_status, release
+
+@pytest.fixture
+def queue(monkeypatch, tmp_path):
+    """An empty processing_status table in a fresh SQLite database."""
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path}/queue.db")
+    ProcessingStatus.__table__.create(get_db_connection())
+    enqueue_athlete(1, 'bearer', 'refresh')
+    enqueue_athlete(2, 'bearer', 'refresh')
+
+def test_lease_keeper_holds_leases_past_their_length(queue):
+    with LeaseKeeper('w1', lease_seconds=1, interval=0.1) as leases:
+        row = claim_next([STATUS_NONE], 'w1', lease_seconds=1, exclude=['2'])
+        leases.hold(row['athlete_id'])
+        time.sleep(1.5)
+        assert claim_next([STATUS_NONE], 'w2', exclude=['2']) is None
+        assert leases.release(row['athlete_id'], STATUS_PROCESSED)
+    assert get_status(1) == STATUS_PROCESSED
+
+def test_release_reports_a_lost_lease(queue):
+    claim_next([STATUS_NONE], 'w1', lease_seconds=0, exclude=['2'])
+    time.sleep(0.1)
+    assert claim_next([STATUS_NONE], 'w2', exclude=['2'])['athlete_id'] == '1'
+    assert not release(1, 'w1', STATUS_PROCESSED)
+    assert get_status(1) == STATUS_NONE
@@ -0,0 +1,31 @@
+# tests/test_migrations.py
+
+import pandas as pd
+from sqlalchemy import inspect
+import migrations
+import sql_methods
+
+def test_legacy_tables_are_rebuilt_with_keys_once(monkeypatch, tmp_path):
+    monkeypatch.setenv('DATABASE_URL', f'sqlite:///{tmp_path}/test.db')
+    engine = sql_methods.get_db_connection()
+    # As write_db_replace left it: no key, no indexes, and a column the declaration does not have
+    legacy = pd.DataFrame({'athlete_id': ['7', '7', '8'], 'block_id': ['7_1', '7_2', '8_1'],
+                           'vdot': [50.0, 51.5, None], 'f_extra': [1.0, 2.0, 3.0]})
+    legacy.to_sql('metadata_blocks', engine, index=False)
+
+    assert migrations.run_migrations(engine) == len(migrations.MIGRATIONS)
+
+    inspector = inspect(engine)
+    assert inspector.get_pk_constraint('metadata_blocks')['constrained_columns'] == ['id']
+    declared = {index.name for index in sql_methods.get_managed_table('metadata_blocks').indexes}
+    assert declared <= {index['name'] for index in inspector.get_indexes('metadata_blocks')}
+    assert not [name for name in inspector.get_table_names()
+                if name.endswith((migrations.REBUILD_SUFFIX, migrations.RETIRED_SUFFIX))]
+    rows = pd.read_sql('SELECT * FROM metadata_blocks ORDER BY block_id', engine)
+    pd.testing.assert_frame_equal(rows[legacy.columns], legacy)
+
+    assert migrations.run_migrations(engine) == 0
+    # Repeating the migration itself, as after an interrupted run on MySQL, leaves the keyed table alone
+    with engine.begin() as conn:
+        migrations.create_analytics_schema(conn)
+    pd.testing.assert_frame_equal(pd.read_sql('SELECT * FROM metadata_blocks ORDER BY block_id', engine), rows)
@@ -0,0 +1,144 @@
+# tests/test_running_functions.py
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+from athlete_data_transformer import calculate_relative_proportion, get_outlier_metrics
+from running_functions import OUTLIER_TYPES, WEEK_METRICS, WEEK_STAT_COLUMNS, extract_weeks_features, run_outlier_counts
+
+def per_week_features(activities, week_id, columns, athlete_id, block_id):
+    """A week's features from its own frame, as extract_week_features computed them one week at a time."""
+    week = activities[activities['week_id'] == week_id][columns]
+    is_run = week['activity_type'] == 2
+    runs, non_runs = week[is_run], week[~is_run]
+    features = {'athlete_id': athlete_id, 'block_id': block_id, 'week_id': week_id, 'f_total_runs': len(runs)}
+    for prefix, group in (('f_run', runs), ('f_non_run', non_runs)):
+        for col in WEEK_STAT_COLUMNS:
+            if not group[col].empty:
+                features.update({f'{prefix}_total_{col}': group[col].sum(),
+                                 f'{prefix}_avg_{col}': group[col].mean(),
+                                 f'{prefix}_stdev_{col}': group[col].std()})
+    for suffix, group in (('runs', runs), ('non_runs', non_runs)):
+        for zone in range(1, 6):
+            col = f'time_in_z{zone}'
+            features[f'f_time_in_z{zone}_{suffix}'] = group[col].mean() if col in group.columns else 0.0
+    for activity_type, count in non_runs['activity_type'].value_counts().items():
+        features[f'f_activity_type_{int(activity_type)}'] = count
+    for suffix, group in (('runs', runs), ('non_runs', non_runs)):
+        for name, (col, how) in WEEK_METRICS[suffix].items():
+            features[name] = group[col].agg(how) if col in group.columns else 0.0
+    return features
+
+def test_grouped_week_features_match_per_week_ones():
+    # Week 1 is empty, week 2 only has non-runs, and zones and cadence only appear from week 3 on
+    activities = pd.DataFrame([
+        {'week_id': '7_0', 'activity_type': 2, 'distance': 5000.0, 'elapsed_time': 1500.0, 'mean_hr': 150.0, 'pace': 5.0},
+        {'week_id': '7_0', 'activity_type': 2, 'distance': 8000.0, 'elapsed_time': 2500.0, 'pace': 5.2},
+        {'week_id': '7_0', 'activity_type': 1, 'distance': 20000.0, 'elapsed_time': 3600.0, 'mean_hr': 130.0},
+        {'week_id': '7_2', 'activity_type': 3, 'distance': 1500.0, 'elapsed_time': 2000.0},
+        {'week_id': '7_2', 'activity_type': 1, 'distance': 30000.0, 'elapsed_time': 4000.0},
+        {'week_id': '7_2', 'activity_type': 3, 'distance': 1000.0, 'elapsed_time': 1500.0},
+        {'week_id': '7_3', 'activity_type': 2, 'distance': 10000.0, 'elapsed_time': 3000.0, 'mean_hr': 155.0,
+         'time_in_z1': 0.25, 'time_in_z2': 0.75, 'cadence': 86.0, 'pace': 5.0},
+        {'week_id': '7_3', 'activity_type': 2, 'distance': 12000.0, 'elapsed_time': 3700.0, 'pace': 5.1},
+    ])
+    base = ['week_id', 'activity_type', 'distance', 'elapsed_time', 'mean_hr', 'pace']
+    week_ids = ['7_0', '7_1', '7_2', '7_3']
+    week_columns = [base, base, base, base + ['time_in_z1', 'time_in_z2', 'cadence']]
+
+    weeks = extract_weeks_features(activities, week_ids, week_columns, '7', '7')
+
+    for week, week_id, columns in zip(weeks, week_ids, week_columns):
+        expected = per_week_features(activities, week_id, columns, '7', '7')
+        assert list(week) == list(expected)
+        for name, value in expected.items():
+            if isinstance(value, str):
+                assert week[name] == value
+            else:
+                assert np.isclose(week[name], value, equal_nan=True), (week_id, name)
+
+def per_block_outliers(all_activities, block_id, athlete_id):
+    """A block's distance, intensity and interval outliers, as get_run_outliers found them one block at a time."""
+    runs = all_activities[all_activities['activity_type'] == 2]
+    block_activities = runs[runs['block_id'] == block_id]
+    athlete_activities = runs[runs['athlete_id'] == athlete_id]
+    distance_outliers = intensity_outliers = interval_outliers = pd.DataFrame()
+    try:
+        athlete_mean_distance = athlete_activities['distance'].mean()
+        distance_outliers = athlete_activities[
+            (np.abs(stats.zscore(athlete_activities['distance'])) >= 1.2) &
+            (athlete_activities['distance'] >= athlete_mean_distance) &
+            (athlete_activities['block_id'] == block_id)
+        ]
+        if athlete_activities['mean_hr'].sum() != 0:
+            hr_activities = athlete_activities[athlete_activities['mean_hr'].notna()]
+            intensity_outliers = pd.concat([intensity_outliers, hr_activities[
+                (np.abs(stats.zscore(hr_activities['mean_hr'])) >= 1.2) &
+                (hr_activities['distance'] >= athlete_mean_distance) &
+                (hr_activities['mean_hr'] >= hr_activities['mean_hr'].mean()) &
+                (hr_activities['block_id'] == block_id)
+            ]])
+        if athlete_activities['pace'].sum() != 0:
+            pace_activities = athlete_activities[athlete_activities['pace'].notna()]
+            intensity_outliers = pd.concat([intensity_outliers, pace_activities[
+                (np.abs(stats.zscore(pace_activities['pace'])) >= 1.5) &
+                (pace_activities['distance'] >= 1000) &
+                (pace_activities['pace'] >= pace_activities['pace'].mean()) &
+                (pace_activities['block_id'] == block_id)
+            ]])
+        if not athlete_activities['stdev_hr'].isna().all():
+            interval_outliers = block_activities[
+                (block_activities['stdev_hr'].notna()) &
+                (block_activities['distance'] >= 1000) &
+                (block_activities['stdev_hr'] >= athlete_activities['stdev_hr'].mean())
+            ]
+    except Exception:
+        pass
+    return distance_outliers.drop_duplicates(), intensity_outliers.drop_duplicates(), interval_outliers.drop_duplicates()
+
+def outlier_activities(r, athlete_id, n, nan_distances):
+    """Runs and rides of one athlete, some of them without mean_hr, pace or stdev_hr."""
+    activities = pd.DataFrame({
+        'athlete_id': athlete_id,
+        'activity_type': r.choice([2, 2, 2, 1], size=n),
+        'distance': r.lognormal(9, 0.5, size=n).round(),
+        'mean_hr': r.normal(150, 12, size=n).round(),
+        'pace': r.normal(5.5, 0.6, size=n),
+        'stdev_hr': r.gamma(2, 4, size=n)
+    })
+    for col, share in (('mean_hr', 0.3), ('pace', 0.2), ('stdev_hr', 0.4)) + ((('distance', 0.1),) if nan_distances else ()):
+        activities.loc[r.random(n) < share, col] = np.nan
+    return activities
+
+@pytest.mark.parametrize('nan_distances, drop_pace', [(False, False), (True, False), (False, True)])
+def test_outlier_metrics_match_per_block_outliers(nan_distances, drop_pace):
+    r = np.random.default_rng(1)
+    athlete = outlier_activities(r, '7', 80, nan_distances)
+    # PB blocks overlap, another athlete's runs share the frame and a run is listed twice in its block
+    blocks = [athlete.sample(30, random_state=seed).assign(block_id=f'7_{seed}') for seed in range(4)]
+    other = outlier_activities(r, '8', 20, nan_distances).assign(block_id='7_1')
+    features_activities = pd.concat(blocks + [other, blocks[0].head(1)], ignore_index=True)
+    all_athlete_activities = athlete.assign(block_id='0')
+    if drop_pace:
+        features_activities = features_activities.drop(columns='pace')
+        all_athlete_activities = all_athlete_activities.drop(columns='pace')
+
+    counts = run_outlier_counts(features_activities, '7')
+    outlier_counts = {}
+    for block_id in ['7_0', '7_1', '7_2', '7_3', '7_9']:
+        expected_outliers = per_block_outliers(features_activities, block_id, '7')
+        assert [counts[outlier_type].get(block_id, 0) for outlier_type in OUTLIER_TYPES] == \
+               [len(outliers) for outliers in expected_outliers], block_id
+
+        total_outliers = per_block_outliers(all_athlete_activities, '0', '7')
+        expected = {}
+        for outliers, total, outlier_type in zip(expected_outliers, total_outliers, OUTLIER_TYPES):
+            f_prop = round(len(outliers) / 30, 2)
+            total_prop = round(len(total) / len(all_athlete_activities), 2)
+            expected.update({f'f_proportion_{outlier_type}_activities': f_prop,
+                             f'proportion_{outlier_type}_activities': total_prop,
+                             f'r_proportion_{outlier_type}_activities': calculate_relative_proportion(f_prop, total_prop)})
+        assert get_outlier_metrics(features_activities, all_athlete_activities, block_id, '7', 30,
+                                   outlier_counts) == expected
+    assert counts.to_numpy().sum() > 0
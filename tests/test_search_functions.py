@@ -0,0 +1,32 @@
+# tests/test_search_functions.py
+
+from datetime import datetime, timedelta
+from search_functions import ActivityIndex, get_block, get_weeks
+
+def make_activities(start, day_offsets):
+    return [{'id': i, 'type': 'Run', 'start_date': (start + timedelta(days=d)).strftime('%Y-%m-%dT07:00:00Z')}
+            for i, d in enumerate(day_offsets)]
+
+def test_block_is_the_window_up_to_the_date():
+    start = datetime(2024, 1, 1)
+    activities = make_activities(start, [0, 5, 9, 9, 10, 100, 101])
+    activities.insert(3, {'id': 'bad', 'type': 'Run', 'start_date': 'not a date'})
+    activities.insert(4, {'id': 'untyped', 'start_date': '2024-01-10T07:00:00Z'})
+
+    block = get_block(activities, start + timedelta(days=100), duration_days=91)
+    assert [a['id'] for a in block] == [4, 5]
+
+    index = ActivityIndex(activities)
+    block, days = index.block(start + timedelta(days=9))
+    assert [a['id'] for a in block] == [0, 1, 2, 3]
+    assert days == [(start + timedelta(days=d)).toordinal() for d in [0, 5, 9, 9]]
+    assert index.block(start - timedelta(days=1))[0] == []
+
+def test_weeks_from_parsed_days_match_parsing():
+    start = datetime(2024, 1, 1)
+    activities = make_activities(start, [0, 1, 15, 16, 30, 44])
+
+    weeks = get_weeks(activities, duration_days=0)
+    assert [[a['id'] for a in week] for week in weeks] == [[0, 1], [], [2, 3], [], [4], []]
+    assert get_weeks(activities, duration_days=0, days=ActivityIndex(activities).days) == weeks
+    assert [[a['id'] for a in week] for week in get_weeks(activities, duration_days=21)] == [[4], [], []]
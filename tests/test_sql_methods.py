@@ -0,0 +1,101 @@
+# tests/test_sql_methods.py
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+import sql_methods
+from sql_methods import get_database_url, get_db_connection, cached_read_db, bump_table_version
+
+@pytest.fixture
+def clean_db_env(monkeypatch):
+    """Remove every database-related environment variable."""
+    for name in ["DATABASE_URL", "SQLALCHEMY_DATABASE_URI", "DB_USER", "DB_PASS", "DB_HOST", "DB_NAME"]:
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+def test_database_url_prefers_database_url(clean_db_env):
+    clean_db_env.setenv("DATABASE_URL", "mysql+pymysql://u:p@db/strava")
+    clean_db_env.setenv("DB_HOST", "other")
+    assert get_database_url() == "mysql+pymysql://u:p@db/strava"
+
+def test_database_url_builds_mysql_from_db_vars(clean_db_env):
+    clean_db_env.setenv("DB_USER", "u")
+    clean_db_env.setenv("DB_PASS", "p")
+    clean_db_env.setenv("DB_HOST", "db")
+    clean_db_env.setenv("DB_NAME", "strava")
+    assert get_database_url() == "mysql+pymysql://u:p@db/strava"
+
+def test_database_url_defaults_to_absolute_sqlite(clean_db_env, tmp_path):
+    clean_db_env.chdir(tmp_path)
+    url = get_database_url()
+    assert url == f"sqlite:///{tmp_path}/data/strava.db"
+    assert (tmp_path / "data").is_dir()
+
+def test_sqlite_engine_is_tuned_and_shared(clean_db_env, tmp_path):
+    clean_db_env.setenv("DATABASE_URL", f"sqlite:///{tmp_path}/test.db")
+    engine = get_db_connection()
+    assert get_db_connection() is engine
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+
+def test_sqlite_transaction_rolls_back_ddl(clean_db_env, tmp_path):
+    clean_db_env.setenv("DATABASE_URL", f"sqlite:///{tmp_path}/test.db")
+    engine = get_db_connection()
+    with pytest.raises(RuntimeError):
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE scratch (x INTEGER)"))
+            raise RuntimeError("abort")
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM sqlite_master WHERE name = 'scratch'")).scalar() == 0
+
+def test_sqlite_hooks_only_reach_the_configured_engine(clean_db_env, tmp_path):
+    clean_db_env.setenv("DATABASE_URL", f"sqlite:///{tmp_path}/test.db")
+    engine = get_db_connection()
+    sql_methods.configure_sqlite_engine(engine)
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE scratch (x INTEGER)"))
+
+    other = create_engine(f"sqlite:///{tmp_path}/other.db")
+    with other.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "delete"
+
+@pytest.fixture
+def scores_table(clean_db_env, tmp_path):
+    """A small table in a fresh SQLite database, with an empty read cache."""
+    clean_db_env.setenv("DATABASE_URL", f"sqlite:///{tmp_path}/test.db")
+    sql_methods.clear_read_cache()
+    pd.DataFrame({"athlete_id": ["1", "2"], "score": [1.0, 2.0]}).to_sql(
+        "scores", get_db_connection(), index=False)
+    return get_db_connection()
+
+def test_cached_read_serves_copies_until_version_bump(scores_table):
+    first = cached_read_db("scores")
+    first.loc[0, "score"] = 99.0
+    with scores_table.begin() as conn:
+        conn.execute(text("UPDATE scores SET score = 5.0 WHERE athlete_id = '1'"))
+    assert cached_read_db("scores")["score"].tolist() == [1.0, 2.0]
+    bump_table_version("scores")
+    assert cached_read_db("scores")["score"].tolist() == [5.0, 2.0]
+
+def test_cached_read_evicts_least_recently_used(scores_table, monkeypatch):
+    cached_read_db("scores", "SELECT * FROM scores WHERE athlete_id = :id", {"id": "1"})
+    entry_bytes = sql_methods._read_cache_bytes
+    monkeypatch.setattr(sql_methods, "READ_CACHE_MAX_BYTES", entry_bytes * 2)
+    cached_read_db("scores", "SELECT * FROM scores WHERE athlete_id = :id", {"id": "2"})
+    cached_read_db("scores", "SELECT * FROM scores WHERE athlete_id = :id", {"id": "1"})
+    cached_read_db("scores", "SELECT * FROM scores WHERE score > :score", {"score": 1.5})
+    assert [key[2] for key in sql_methods._read_cache] == [(("id", "1"),), (("score", 1.5),)]
+    assert sql_methods._read_cache_bytes <= entry_bytes * 2
+
+def test_write_db_replace_swaps_in_a_complete_table(scores_table, monkeypatch):
+    monkeypatch.setattr(sql_methods, "get_managed_table", lambda table_name: None)
+    replacement = pd.DataFrame({"athlete_id": ["3"], "score": [3.0]})
+    with scores_table.connect() as reader:
+        with reader.begin():
+            assert reader.execute(text("SELECT COUNT(*) FROM scores")).scalar() == 2
+            sql_methods.write_db_replace(replacement, "scores")
+            # An open read keeps its snapshot of the old table
+            assert reader.execute(text("SELECT COUNT(*) FROM scores")).scalar() == 2
+        assert reader.execute(text("SELECT athlete_id FROM scores")).scalars().all() == ["3"]
+        assert reader.execute(text("SELECT COUNT(*) FROM sqlite_master WHERE name LIKE '%shadow%'")).scalar() == 0
@@ -0,0 +1,55 @@
+# tests/test_streaming_transform.py
+
+import pandas as pd
+import activity_cache
+import athlete_data_transformer
+import sql_methods
+import streaming_transform
+from synthetic import ATHLETE_ID, make_activities, read_tables, write_athlete
+
+def test_streamed_transform_matches_the_default_one(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+    monkeypatch.setattr(activity_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setenv('DATABASE_URL', f'sqlite:///{tmp_path}/test.db')
+    monkeypatch.setattr(athlete_data_transformer, 'WEEK_AGGREGATES_IN_SQL', False)
+    # Weeks close across many chunks; cadence only shows up a few chunks in, and is missing
+    # again for whole chunks later on
+    monkeypatch.setattr(streaming_transform, 'STREAM_CHUNK_WEEKS', 3)
+    activities = make_activities(900)
+    for activity in activities[-40:] + activities[300:360]:
+        activity.pop('average_cadence', None)
+    write_athlete({'20240101_000000_detailed': activities})
+
+    chunks, spans, forgotten = [], [], []
+    flush = streaming_transform.StreamedBlock.flush
+    add, forget = streaming_transform.StreamedPBBlocks.add, streaming_transform.ActivityFeatureMemo.forget
+    def flush_and_count(self):
+        chunks.append(len(self.week_ids))
+        flush(self)
+    def add_and_measure(self, activity, day):
+        add(self, activity, day)
+        spans.append(day - self.window[0][0])
+    def forget_and_count(self, activity_id):
+        forgotten.append(activity_id)
+        forget(self, activity_id)
+    monkeypatch.setattr(streaming_transform.StreamedBlock, 'flush', flush_and_count)
+    monkeypatch.setattr(streaming_transform.StreamedPBBlocks, 'add', add_and_measure)
+    monkeypatch.setattr(streaming_transform.ActivityFeatureMemo, 'forget', forget_and_count)
+
+    engine = sql_methods.get_db_connection()
+    tables = {}
+    for stream in (True, False):
+        monkeypatch.setattr(athlete_data_transformer, 'STREAM_TRANSFORM', stream)
+        assert athlete_data_transformer.transform_athlete_data(ATHLETE_ID, populate_all_from_files=1)
+        tables[stream] = read_tables(engine, streaming_transform.STREAMED_TABLES)
+
+    # Block '0' went out a chunk at a time, and the PB blocks kept one block's window and dropped
+    # the records of what fell out of it
+    assert max(chunks) == 3 and sum(chunks) == (tables[False]['all_athlete_weeks']['block_id'] == '0').sum()
+    assert spans and max(spans) == streaming_transform.BLOCK_DAYS - 1
+    assert len(forgotten) > len(activities) // 2
+    assert len(tables[False]['metadata_blocks']) > 2
+    for name in streaming_transform.STREAMED_TABLES:
+        assert len(tables[False][name]) > 0, name
+        pd.testing.assert_frame_equal(tables[True][name], tables[False][name], obj=name)
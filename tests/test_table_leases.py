@@ -0,0 +1,61 @@
+# tests/test_table_leases.py
+
+import pytest
+import update_data
+from job_queue import STATUS_NONE, STATUS_PROCESSED, enqueue_athlete, get_status
+from migrations import ANALYTICS_TABLES
+from models import ProcessingStatus
+from sql_methods import get_db_connection
+from table_leases import (
+    GRANTED, QUEUED, REFUSED, HeldTables, release_tables, request_tables, tables_contended
+)
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path}/leases.db")
+
+def test_exclusive_request_waits_for_shared_holders_and_shuts_out_new_ones(database):
+    tables = ['features_blocks', 'metadata_blocks']
+    assert request_tables(tables, 'transform-1') == GRANTED
+    assert request_tables(tables[:1], 'transform-2') == GRANTED
+
+    assert request_tables(tables, 'rebuild', exclusive=True) == QUEUED
+    assert tables_contended(tables, 'transform-1') and not tables_contended(tables, 'rebuild')
+    assert request_tables(tables[1:], 'transform-3') == REFUSED
+    assert request_tables(tables, 'publish', exclusive=True) == REFUSED
+    assert request_tables(['daily_limit'], 'publish', exclusive=True) == GRANTED
+
+    release_tables(tables, 'transform-1')
+    assert request_tables(tables, 'rebuild', exclusive=True) == QUEUED
+    release_tables(tables, 'transform-2')
+    assert request_tables(tables, 'rebuild', exclusive=True) == GRANTED
+
+    # A holder whose lease ran out, as after a crash, stands in nobody's way
+    release_tables(tables, 'rebuild')
+    assert request_tables(tables, 'crashed', exclusive=True, lease_seconds=-1) == GRANTED
+    assert request_tables(tables, 'transform-1') == GRANTED
+
+def test_processing_stops_claiming_once_a_rebuild_asks_for_the_tables(database, monkeypatch):
+    ProcessingStatus.__table__.create(get_db_connection())
+    for athlete_id in (1, 2, 3):
+        enqueue_athlete(athlete_id, 'bearer', 'refresh')
+
+    def transform_reports(athlete_ids):
+        for athlete_id in athlete_ids:
+            # A rebuild asks for the tables while the first athlete is transformed
+            assert request_tables(ANALYTICS_TABLES, 'rebuild', exclusive=True) == QUEUED
+            yield {'athlete_id': athlete_id, 'transformed': True, 'error': None, 'seconds': 0.0, 'max_rss_mb': 0}
+    monkeypatch.setattr(update_data, 'transform_reports', transform_reports)
+
+    assert 'Athletes processed: 1' in update_data.process_stored_data()
+    assert [get_status(athlete_id) for athlete_id in (1, 2, 3)] == [STATUS_PROCESSED, STATUS_NONE, STATUS_NONE]
+    # The transform has left, so the rebuild gets the tables, and processing waits for it
+    assert request_tables(ANALYTICS_TABLES, 'rebuild', exclusive=True) == GRANTED
+    assert update_data.process_stored_data().startswith('Processing skipped')
+
+def test_rebuild_is_not_started_while_another_writer_holds_the_tables(database, monkeypatch):
+    monkeypatch.setattr(update_data, 'LEASE_WAIT_SECONDS', 0)
+    with HeldTables(['features_blocks'], owner='transform'):
+        assert update_data.rebuild_analytics_tables().startswith('Rebuild not started')
+    # The abandoned request does not keep processing out
+    assert request_tables(ANALYTICS_TABLES, 'transform') == GRANTED
@@ -0,0 +1,63 @@
+# tests/test_transform_pool.py
+
+import functools
+import os
+import pandas as pd
+import sql_methods
+import transform_pool
+from sql_methods import cached_read_db
+
+# Stand-ins for transform_report, run in the worker processes
+
+def report_pid(athlete_id, shadow=False):
+    return {'athlete_id': athlete_id, 'transformed': True, 'error': None, 'seconds': 0.0,
+            'max_rss_mb': 0, 'pid': os.getpid()}
+
+def die_on_first_athlete(athlete_id, shadow=False):
+    if athlete_id == 1:
+        os._exit(1)
+    return report_pid(athlete_id, shadow)
+
+def test_pool_is_recycled_after_its_budget(monkeypatch):
+    monkeypatch.setattr(transform_pool, 'transform_report', report_pid)
+    monkeypatch.setattr(transform_pool, 'TRANSFORM_ATHLETES_PER_WORKER', 1)
+
+    reports = list(transform_pool.transform_reports(range(1, 7), workers=2))
+
+    assert sorted(r['athlete_id'] for r in reports) == [1, 2, 3, 4, 5, 6]
+    pids = [r['pid'] for r in reports]
+    # Three pools of at most two athletes each, none of them the parent
+    assert len(set(pids)) >= 3 and os.getpid() not in pids
+    assert max(pids.count(pid) for pid in pids) <= 2
+
+def test_dead_worker_fails_only_the_athletes_of_its_pool(monkeypatch):
+    monkeypatch.setattr(transform_pool, 'transform_report', die_on_first_athlete)
+
+    reports = {r['athlete_id']: r for r in transform_pool.transform_reports(range(1, 6), workers=2)}
+
+    assert sorted(reports) == [1, 2, 3, 4, 5]
+    failed = {athlete_id for athlete_id, r in reports.items() if r['error']}
+    # At most the other athlete running when the worker died goes down with it
+    assert 1 in failed and len(failed) <= 2
+    assert all(reports[athlete_id]['error'].startswith('worker failed') for athlete_id in failed)
+    assert all(reports[athlete_id]['transformed'] for athlete_id in reports.keys() - failed)
+    assert 'Athlete 1 failed: worker failed' in transform_pool.format_reports(list(reports.values()))
+
+def write_block(database_url, athlete_id, shadow=False):
+    os.environ['DATABASE_URL'] = database_url
+    blocks = pd.DataFrame({'athlete_id': [str(athlete_id)], 'block_id': [f'{athlete_id}_1'], 'vdot': [50.0]})
+    sql_methods.write_tables_atomic({'metadata_blocks': blocks}, athlete_id=athlete_id)
+    return report_pid(athlete_id, shadow)
+
+def test_parent_reads_what_the_workers_wrote(monkeypatch, tmp_path):
+    database_url = f'sqlite:///{tmp_path}/test.db'
+    monkeypatch.setenv('DATABASE_URL', database_url)
+    sql_methods.clear_read_cache()
+    sql_methods.get_managed_table('metadata_blocks').create(sql_methods.get_db_connection())
+    assert cached_read_db('metadata_blocks').empty
+    monkeypatch.setattr(transform_pool, 'transform_report', functools.partial(write_block, database_url))
+
+    reports = list(transform_pool.transform_reports([1, 2], workers=2))
+
+    assert all(r['transformed'] and r['pid'] != os.getpid() for r in reports)
+    assert sorted(cached_read_db('metadata_blocks')['athlete_id']) == ['1', '2']
@@ -0,0 +1,103 @@
+# tests/test_transform_state.py
+
+import copy
+import pickle
+import pandas as pd
+import pytest
+import activity_cache
+import athlete_data_transformer
+import transform_state
+from synthetic import ATHLETE_ID, make_activities, write_athlete
+
+@pytest.fixture
+def athlete(tmp_path, monkeypatch):
+    """Runs the transform on a JSON file in tmp_path and returns the frames it would save."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+    monkeypatch.setattr(activity_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(athlete_data_transformer, 'read_db', lambda name: pd.DataFrame())
+    saved, states = {}, []
+    monkeypatch.setattr(athlete_data_transformer, 'save_dataframes_to_db',
+                        lambda frames, **kwargs: saved.update(frames=frames))
+    def load_state(*args):
+        states.append(transform_state.load_transform_state(*args))
+        return states[-1]
+    monkeypatch.setattr(athlete_data_transformer, 'load_transform_state', load_state)
+
+    class Athlete:
+        state_path = tmp_path / 'cache' / str(ATHLETE_ID) / 'transform_state.pkl'
+
+        def write(self, batches):
+            write_athlete(batches)
+
+        def transform(self, incremental):
+            monkeypatch.setattr(athlete_data_transformer, 'INCREMENTAL_TRANSFORM', incremental)
+            assert athlete_data_transformer.transform_athlete_data(ATHLETE_ID, populate_all_from_files=1)
+            return saved.pop('frames')
+
+        @property
+        def state(self):
+            return states[-1]
+
+    return Athlete()
+
+def assert_same_frames(incremental, full):
+    assert list(incremental) == list(full)
+    for name in full:
+        pd.testing.assert_frame_equal(incremental[name].reset_index(drop=True), full[name].reset_index(drop=True),
+                                      check_exact=True, obj=name)
+
+def test_incremental_transform_matches_a_full_one(athlete):
+    activities = make_activities(240)
+    athlete.write({'20240101_000000_detailed': activities[1:]})
+    athlete.transform(incremental=True)
+
+    edited = copy.deepcopy(next(a for a in activities[len(activities) // 2:] if a['type'] == 'Run'))
+    edited['distance'] += 500
+    edited['laps'][0]['average_speed'] *= 1.1
+    athlete.write({'20240101_000000_detailed': activities[1:],
+                   '20240102_000000_detailed': [activities[0], edited]})
+    incremental = athlete.transform(incremental=True)
+
+    assert 0 < athlete.state.reused_records < len(activities)
+    assert 0 < athlete.state.reused_weeks
+    assert_same_frames(incremental, athlete.transform(incremental=False))
+
+def poison_state(path, keep, weeks=True, **changes):
+    """Corrupt the stored records not kept (and the weeks), and apply changes to the stored state."""
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    for activity_id, record in state['records'].items():
+        if record is not None and not keep(activity_id, state):
+            record['distance'] = -1.0
+    if weeks:
+        state['weeks'] = {block_id: [(ids, {**features, 'f_poisoned': 1.0}) for ids, features in block_weeks]
+                          for block_id, block_weeks in state['weeks'].items()}
+    state.update(changes)
+    with open(path, 'wb') as f:
+        pickle.dump(state, f)
+
+def test_state_of_another_version_is_not_reused(athlete):
+    athlete.write({'20240101_000000_detailed': make_activities(240)})
+    athlete.transform(incremental=True)
+    poison_state(athlete.state_path, keep=lambda activity_id, state: False,
+                 version=transform_state.TRANSFORM_STATE_VERSION - 1)
+
+    incremental = athlete.transform(incremental=True)
+
+    assert athlete.state.reused_records == athlete.state.reused_weeks == 0
+    assert_same_frames(incremental, athlete.transform(incremental=False))
+
+def test_new_regressor_recomputes_the_records_that_used_it(athlete):
+    athlete.write({'20240101_000000_detailed': make_activities(240)})
+    athlete.transform(incremental=True)
+    # Only the records of runs whose HR came from the regressor are corrupted
+    poison_state(athlete.state_path, keep=lambda activity_id, state: not state['fingerprints'][activity_id][1],
+                 weeks=False, regressor=(0.0, 0.0))
+
+    incremental = athlete.transform(incremental=True)
+
+    depends = sum(uses for _, uses in athlete.state.fingerprints.values())
+    assert depends > 0
+    assert athlete.state.reused_records == len(athlete.state.fingerprints) - depends
+    assert_same_frames(incremental, athlete.transform(incremental=False))
@@ -103,3 +103,23 @@ def test_fetch_strava_data_rate_limit(api_calls, mock_requests_get):
             # Just check that we don't get the limit error here.
             result = fetch_strava_data()
             assert "api limit exceeded" not in result
+
+@pytest.mark.parametrize("report, published", [
+    ({'transformed': False, 'error': None}, True),
+    ({'transformed': False, 'error': 'boom'}, False),
+])
+def test_rebuild_is_only_abandoned_for_errors(report, published, monkeypatch):
+    import update_data
+    calls = []
+    reports = [{'athlete_id': 1, 'transformed': True, 'error': None, 'seconds': 1.0, 'max_rss_mb': 100},
+               {'athlete_id': 2, 'seconds': 1.0, 'max_rss_mb': 100, **report}]
+    monkeypatch.setattr(update_data, 'list_jobs', lambda states: [{'athlete_id': '1'}, {'athlete_id': '2'}])
+    monkeypatch.setattr(update_data, 'transform_reports', lambda athlete_ids, shadow: iter(reports))
+    for name in ['create_shadow_tables', 'drop_shadow_tables', 'swap_shadow_tables']:
+        monkeypatch.setattr(update_data, name, lambda tables, name=name: calls.append(name))
+
+    summary = update_data.rebuild_analytics_tables()
+
+    assert ('swap_shadow_tables' in calls) == published
+    assert ('drop_shadow_tables' in calls) != published
+    assert ('skipped, no usable data: [2]' in summary) == published
@@ -0,0 +1,42 @@
+# tests/test_upsert_rows.py
+
+from datetime import datetime
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from models import Activity
+from sql_methods import db, get_managed_table, upsert_rows
+
+def activity_row(activity_id, name, distance=5000.0, elapsed_time=1500):
+    return {'id': activity_id, 'athlete_id': '7', 'name': name, 'distance': distance, 'moving_time': elapsed_time,
+            'elapsed_time': elapsed_time, 'total_elevation_gain': None, 'type': 'Run',
+            'start_date': datetime(2024, 1, activity_id), 'average_speed': 3.3, 'max_speed': 4.0,
+            'average_heartrate': None, 'max_heartrate': None}
+
+def activities_engine(existing):
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine, tables=[get_managed_table('activities')])
+    with Session(engine) as session:
+        session.add_all(Activity(**row) for row in existing)
+        session.commit()
+    return engine
+
+def test_upsert_rows_matches_per_row_merge():
+    existing = [activity_row(1, 'old'), activity_row(2, 'old')]
+    # Activity 2 is updated and 3 arrives twice, in different batches; the later copy wins
+    rows = [activity_row(2, 'edited', distance=5100.0), activity_row(3, 'first'), activity_row(4, 'new'),
+            activity_row(3, 'second', elapsed_time=1600), activity_row(5, 'new')]
+
+    merged = activities_engine(existing)
+    with Session(merged) as session:
+        for row in rows:
+            session.merge(Activity(**row))
+        session.commit()
+
+    upserted = activities_engine(existing)
+    with upserted.begin() as conn:
+        counts = upsert_rows(conn, 'activities', rows, batch_size=2)
+
+    assert counts == (3, 2)
+    query = 'SELECT * FROM activities ORDER BY id'
+    pd.testing.assert_frame_equal(pd.read_sql(query, upserted), pd.read_sql(query, merged))
@@ -0,0 +1,36 @@
+# tests/test_weekly_cube.py
+
+from datetime import date
+import numpy as np
+import pandas as pd
+from weekly_cube import WeeklyCube, build_weekly_cube
+
+def test_cube_windows_match_the_weeks_they_cover():
+    activities = pd.DataFrame([
+        {'week_id': '0_0', 'activity_type': 2, 'distance': 5000.0, 'elapsed_time': 1500.0, 'mean_hr': 150.0, 'time_in_z1': 0.5},
+        {'week_id': '0_0', 'activity_type': 1, 'distance': 20000.0, 'elapsed_time': 3600.0},
+        {'week_id': '0_2', 'activity_type': 2, 'distance': 10000.0, 'elapsed_time': 3000.0},
+        {'week_id': '0_2', 'activity_type': 2, 'distance': 8000.0, 'elapsed_time': 2400.0, 'mean_hr': 160.0},
+        {'week_id': '0_3', 'activity_type': 2, 'distance': 12000.0, 'elapsed_time': 3600.0},
+    ])
+    start = date(2024, 1, 1).toordinal()
+
+    cube = build_weekly_cube(activities, ['0_0', '0_1', '0_2', '0_3'], start, 7)
+
+    assert cube['week_start'].dt.date.tolist() == [date(2024, 1, 1), date(2024, 1, 8), date(2024, 1, 15), date(2024, 1, 22)]
+    assert cube['cum_run_distance'].tolist() == [5000.0, 5000.0, 23000.0, 35000.0]
+    assert cube['cum_type_1'].tolist() == [1, 1, 1, 1]
+
+    weekly = np.array([5000.0, 0.0, 18000.0, 12000.0])
+    window = WeeklyCube(cube).window(0, 3)
+    assert window['total_run_distance'] == weekly.sum()
+    assert np.isclose(window['stdev_weekly_run_distance'], weekly.std(ddof=1))
+    assert np.isclose(window['slope_run_distance_before_taper'], -5000.0)
+    assert window['taper_factor_run_distance'] == 15000.0 / 2500.0
+    assert np.isclose(window['stdev_run_distance'], np.std([5000.0, 10000.0, 8000.0, 12000.0], ddof=1))
+    assert window['mean_run_hr'] == 155.0
+    assert window['time_in_z1_runs'] == 750.0 / 10500.0
+    assert window['activity_types'] == {'1': 1, '2': 4}
+
+    assert WeeklyCube(cube).last_weeks(2, end=date(2024, 1, 17)) == (1, 2)
+    assert WeeklyCube(cube).window(2, 3)['slope_run_distance_before_taper'] is None